@@ -1,15 +1,18 @@
-import requests
 import json
 from config import COUNTRIES_NAMES_TO_CODES, API, OK_STATUS
+from http_client import get_default_client
+from metrics import API_SECONDS, timed
 
 
-def api_query(**kwargs):
+@timed(API_SECONDS)
+def api_query(client=None, **kwargs):
     """
     get the transmission type for each country.
     the types are ordered like this:
     0 = "Community transmission", 1 = "Local transmission", 2 = "Imported cases only",
     3 = "Under investigation", 4 = "Interrupted transmission", 5 = "Sporadic cases",
     6 = "Clusters of cases", 7 = "No cases".
+    :param client: the HTTP client to query with. if not given, the shared default client is used.
     :param kwargs: optional parameters to query the API. if not given specificlly,
     the API will be queried on all the relevant data
     :return: a nested dictionary with country code as primary key,
@@ -25,7 +28,9 @@ def api_query(**kwargs):
         'x-rapidapi-host': "who-covid-19-data.p.rapidapi.com"
     }
 
-    response = requests.request("GET", API, headers=headers, params=querystring)
+    if client is None:
+        client = get_default_client()
+    response = client.request("GET", API, headers=headers, params=querystring)
     data_json = json.loads(response.text)
 
     transmission = dict()
@@ -38,13 +43,16 @@ def api_query(**kwargs):
     return transmission
 
 
-def api_request(api):
+def api_request(api, client=None):
     """
     This function returns a json response if the status code is OK.
     :param api: an api URL.
+    :param client: the HTTP client to query with. if not given, the shared default client is used.
     :return: a json response.
     """
-    response = requests.get(api)
+    if client is None:
+        client = get_default_client()
+    response = client.get(api)
     if response.status_code == OK_STATUS:
         return response.json()
 
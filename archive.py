@@ -0,0 +1,106 @@
+import os
+import json
+import zlib
+import time
+import threading
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Response headers kept in the archive
+ARCHIVED_HEADERS = ['Content-Type', 'ETag', 'Last-Modified', 'Date']
+
+
+class PageArchive:
+    """
+    Class PageArchive. A compressed, indexed archive of HTTP responses for offline runs.
+    In 'record' mode every response is appended, zlib compressed, to a data file, and a json line with its url,
+    timestamp, status and location in the data file is appended to an index file.
+    In 'replay' mode the archived responses are served back in the order they were recorded, without network:
+    every request of a url returns the url's next recorded response, and the last one repeats.
+    """
+    DATA_FILE = 'pages.dat'
+    INDEX_FILE = 'index.jsonl'
+
+    def __init__(self, directory, mode):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown archive mode: {mode}')
+        self.directory = directory
+        self.mode = mode
+        self.lock = threading.Lock()
+        data_path = os.path.join(directory, self.DATA_FILE)
+        index_path = os.path.join(directory, self.INDEX_FILE)
+
+        if mode == 'record':
+            os.makedirs(directory, exist_ok=True)
+            self.data_file = open(data_path, 'ab')
+            self.index_file = open(index_path, 'a')
+        else:
+            self.data_file = open(data_path, 'rb')
+            self.index_file = None
+            # url -> list of index records in recording order, and the position of the next one to replay
+            self.records = {}
+            self.cursors = {}
+            with open(index_path, 'r') as file:
+                for line in file:
+                    if line.strip():
+                        record = json.loads(line)
+                        self.records.setdefault(record['url'], []).append(record)
+
+    @staticmethod
+    def full_url(method, url, params=None):
+        """
+        :param method: the HTTP method.
+        :param url: the url address.
+        :param params: optional query string parameters.
+        :return: the url with its query string, used as the archive key.
+        """
+        return requests.Request(method, url, params=params).prepare().url
+
+    def record(self, url, response):
+        """
+        Appends a response to the archive.
+        :param url: the full url of the request (see full_url).
+        :param response: the requests response.
+        """
+        body = zlib.compress(response.content)
+        headers = {name: response.headers[name] for name in ARCHIVED_HEADERS if name in response.headers}
+        with self.lock:
+            offset = self.data_file.tell()
+            self.data_file.write(body)
+            self.data_file.flush()
+            record = {'url': url, 'timestamp': time.time(), 'status': response.status_code,
+                      'encoding': response.encoding, 'headers': headers, 'offset': offset, 'length': len(body)}
+            self.index_file.write(json.dumps(record) + '\n')
+            self.index_file.flush()
+
+    def replay(self, url):
+        """
+        Returns the next archived response of a url.
+        :param url: the full url of the request (see full_url).
+        :return: a requests response built from the archive.
+        """
+        with self.lock:
+            if url not in self.records:
+                raise ValueError(f'{url} is not in the archive {self.directory}')
+            records = self.records[url]
+            cursor = self.cursors.get(url, 0)
+            record = records[min(cursor, len(records) - 1)]
+            self.cursors[url] = cursor + 1
+            self.data_file.seek(record['offset'])
+            body = self.data_file.read(record['length'])
+
+        response = requests.models.Response()
+        response.status_code = record['status']
+        response._content = zlib.decompress(body)
+        response.headers = CaseInsensitiveDict(record['headers'])
+        response.encoding = record['encoding']
+        response.url = url
+        return response
+
+    def close(self):
+        """
+        Closes the archive files.
+        """
+        self.data_file.close()
+        if self.index_file is not None:
+            self.index_file.close()
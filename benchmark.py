@@ -0,0 +1,357 @@
+"""
+Benchmark suite for the parsing and database writing hot paths of the web scraper.
+The pages are synthetic worldometers-like html fixtures, generated once per size and stored in a fixtures
+directory, and the database is an in-memory SQLite stand-in for the MySQL server.
+Every size is a number of countries times a number of days of history, e.g. 200x400.
+
+usage: benchmark.py [-h] [--sizes SIZES [SIZES ...]] [--repeat N] [--fixtures DIR]
+                    [--output results.json] [--compare results.json]
+"""
+from coronavirus import Coronavirus
+from creating_db_scraper_api import *
+from history_store import HistoryStore
+from config import *
+from datetime import date, timedelta
+import argparse
+import platform
+import tracemalloc
+import logging
+import random
+import tempfile
+import shutil
+import json
+import time
+import os
+
+CONTINENTS = ['Europe', 'Asia', 'North America', 'South America', 'Africa', 'Australia/Oceania']
+CHARTS = [('coronavirus-cases-linear', 'Total Cases', 'Cases'),
+          ('graph-cases-daily', 'Daily New Cases', 'Daily Cases'),
+          ('graph-active-cases-total', 'Active Cases', 'Currently Infected'),
+          ('coronavirus-deaths-linear', 'Total Deaths', 'Deaths'),
+          ('graph-deaths-daily', 'Daily Deaths', 'Daily Deaths')]
+DEFAULT_SIZES = ['50x100', '200x400']
+
+
+def benchmark_countries(number):
+    """
+    :param number: the number of countries.
+    :return: a list of country names with a 3-letter code, one name per code.
+    """
+    names = {}
+    for name, code in COUNTRIES_NAMES_TO_CODES.items():
+        names.setdefault(code, name)
+    names = list(names.values())
+    if number > len(names):
+        raise ValueError(f'There are only {len(names)} countries with a code')
+    return names[:number]
+
+
+def synthetic_main_page(countries, seed=0):
+    """
+    Builds a main page with the world counters and a countries table.
+    :param countries: a list of country names.
+    :param seed: the random seed of the cell values.
+    :return: the html code of the page.
+    """
+    rand = random.Random(seed)
+    rows = []
+    for i, country in enumerate(countries):
+        cells = [str(i + 1), f'<a class="mt_a" href="country/{country.lower().replace(" ", "-")}/">{country}</a>']
+        for _ in range(13):
+            cells.append(rand.choice(['', 'N/A', f'+{rand.randint(1, 9999):,}', f'{rand.randint(0, 10 ** 7):,}',
+                                      f'{rand.random() * 1000:,.1f}']))
+        cells.append(CONTINENTS[i % len(CONTINENTS)])
+        rows.append('<tr style="">' + ''.join(f'<td>{cell}</td>' for cell in cells) + '</tr>')
+    continents = ''.join(f'<tr class="total_row_world"><td></td><td><nobr>{continent}</nobr></td>' + '<td>1</td>' * 13 +
+                         f'<td>{continent}</td></tr>' for continent in CONTINENTS[:-1])
+    counters = ''.join(f'<div id="maincounter-wrap"><h1>{title}:</h1><div class="maincounter-number">'
+                       f'<span>{rand.randint(0, 10 ** 8):,}</span></div></div>'
+                       for title in ['Coronavirus Cases', 'Deaths', 'Recovered'])
+    return (f'<html><head><title>Coronavirus</title></head><body>{counters}'
+            f'<table id="main_table_countries_today"><thead><tr><th>#</th><th>Country</th></tr></thead>'
+            f'<tbody>{continents}{"".join(rows)}</tbody>'
+            f'<tfoot><tr><td></td><td>Total:</td>{"<td>1</td>" * 14}</tr></tfoot></table></body></html>')
+
+
+def synthetic_country_page(days, seed=0):
+    """
+    Builds a country page with the 5 history charts.
+    :param days: the number of days of history.
+    :param seed: the random seed of the series values.
+    :return: the html code of the page.
+    """
+    rand = random.Random(seed)
+    first = date(HISTORY_FIRST_YEAR, 2, 15)
+    categories = ','.join(f'"{(first + timedelta(days=day)).strftime("%b %d")}"' for day in range(days))
+    scripts = []
+    for chart_id, title, name in CHARTS:
+        data = ','.join(rand.choice(['null', str(rand.randint(0, 10 ** 5))]) for _ in range(days))
+        scripts.append(f"<script type=\"text/javascript\">\nHighcharts.chart('{chart_id}', {{\n"
+                       f"chart: {{ type: 'line' }},\ntitle: {{ text: '{title}' }},\n"
+                       f"xAxis: {{ categories: [{categories}] }},\n"
+                       f"series: [{{ name: '{name}', color: '#666666', lineWidth: 5, data: [{data}] }}],\n}});\n"
+                       f"</script>")
+    return f'<html><body><div>{"x" * 20000}</div>{"".join(scripts)}</body></html>'
+
+
+def load_fixtures(directory, countries_number, days):
+    """
+    Returns the fixtures of a size, generating and storing them in the fixtures directory on first use.
+    :param directory: the fixtures directory.
+    :param countries_number: the number of countries.
+    :param days: the number of days of history.
+    :return: the main page, and a dictionary with the country page of each country.
+    """
+    countries = benchmark_countries(countries_number)
+    size_directory = os.path.join(directory, f'{countries_number}x{days}')
+    main_path = os.path.join(size_directory, 'main.html')
+    if not os.path.exists(main_path):
+        os.makedirs(size_directory, exist_ok=True)
+        for i, country in enumerate(countries):
+            with open(os.path.join(size_directory, f'country_{i}.html'), 'w', encoding='utf-8') as file:
+                file.write(synthetic_country_page(days, seed=i))
+        with open(main_path, 'w', encoding='utf-8') as file:
+            file.write(synthetic_main_page(countries))
+
+    with open(main_path, 'r', encoding='utf-8') as file:
+        main_page = file.read()
+    country_pages = {}
+    for i, country in enumerate(countries):
+        with open(os.path.join(size_directory, f'country_{i}.html'), 'r', encoding='utf-8') as file:
+            country_pages[country] = file.read()
+    return main_page, country_pages
+
+
+def local_database():
+    """
+    Creates an in-memory SQLite database with the countries and history tables.
+    :return: the engine, the connection, the countries table and the history table.
+    """
+    engine = create_engine('sqlite://')
+    connection = create_connection(engine)
+    countries, _ = create_or_use(engine, 'countries')
+    history, _ = create_or_use(engine, 'history')
+    return engine, connection, countries, history
+
+
+def close_database(engine, connection):
+    """
+    Closes a database of local_database, and drops its schema registry.
+    :param engine: the engine of the database.
+    :param connection: the connection to the database.
+    """
+    connection.close()
+    release_registry(engine)
+    engine.dispose()
+
+
+def history_head(country_history):
+    """
+    :param country_history: a country's history, as returned by parsing_country_history.
+    :return: the first half of the days of every graph, in the same format.
+    """
+    return {graph: {key: values[:len(series['dates']) // 2] for key, values in series.items()}
+            for graph, series in country_history.items()}
+
+
+def count_rows(connection, table):
+    """
+    :param connection: the direct connection to the database.
+    :param table: a table.
+    :return: the number of rows in the table.
+    """
+    return connection.execute(select([func.count()]).select_from(table)).scalar()
+
+
+def checked_rows(name, before, after):
+    """
+    Checks that a timed write added rows, so a write that does nothing can't report a throughput.
+    :param name: the name of the benchmark.
+    :param before: the number of rows in the table before the write.
+    :param after: the number of rows in the table after the write.
+    :return: the number of added rows.
+    """
+    if after <= before:
+        raise ValueError(f'{name} wrote no rows ({before} rows before, {after} after)')
+    return after - before
+
+
+def measure(function, repeat):
+    """
+    Runs a function `repeat` times and measures it.
+    :param function: a function without arguments. it is called again for every run, so it must prepare its
+    own state (e.g. a fresh database).
+    note that tracemalloc traces Python allocations only, not the memory of the lxml C library.
+    :return: the best run time in seconds and the peak memory in bytes (of a separate traced run).
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_size(cv, main_page, country_pages, repeat):
+    """
+    Benchmarks all the hot paths for one size of fixtures.
+    :param cv: a Coronavirus object.
+    :param main_page: the main page fixture.
+    :param country_pages: the country pages fixtures.
+    :param repeat: the number of runs of each benchmark.
+    :return: a list of results, (name, seconds, pages, rows, peak memory).
+    """
+    countries_info = cv.parsing_country_page(main_page)
+    history_info = {country: cv.parsing_country_history(page) for country, page in country_pages.items()}
+    history_rows_number = sum(len(history_rows(COUNTRIES_NAMES_TO_CODES[country], history))
+                              for country, history in history_info.items())
+
+    def parse_history():
+        for page in country_pages.values():
+            cv.parsing_country_history(page)
+
+    def insert_countries():
+        engine, connection, countries, history = local_database()
+        before = count_rows(connection, countries)
+        start = time.perf_counter()
+        inserting_country_info(countries_info, countries, connection, {})
+        seconds = time.perf_counter() - start
+        rows = checked_rows('inserting_country_info', before, count_rows(connection, countries))
+        close_database(engine, connection)
+        return seconds, rows
+
+    def insert_history():
+        engine, connection, countries, history = local_database()
+        inserting_country_info(countries_info, countries, connection, {})
+        before = count_rows(connection, history)
+        start = time.perf_counter()
+        inserting_history_info(history_info, history, connection, engine, countries)
+        seconds = time.perf_counter() - start
+        rows = checked_rows('inserting_history_info', before, count_rows(connection, history))
+        close_database(engine, connection)
+        return seconds, rows
+
+    def update_history():
+        # Store the first half of the days, and time appending the second half
+        engine, connection, countries, history = local_database()
+        inserting_country_info(countries_info, countries, connection, {})
+        inserting_history_info({country: history_head(values) for country, values in history_info.items()},
+                               history, connection, engine, countries)
+        before = count_rows(connection, history)
+        start = time.perf_counter()
+        for country, values in history_info.items():
+            history_update(country, history, values, connection, engine, countries)
+        seconds = time.perf_counter() - start
+        rows = checked_rows('history_update', before, count_rows(connection, history))
+        close_database(engine, connection)
+        return seconds, rows
+
+    def store_history():
+        directory = tempfile.mkdtemp()
+        try:
+            store = HistoryStore(directory)
+            start = time.perf_counter()
+            written = store.store_history(history_info)
+            seconds = time.perf_counter() - start
+            store.close()
+        finally:
+            shutil.rmtree(directory)
+        return seconds, checked_rows('history_store_write', 0, written)
+
+    store_directory = tempfile.mkdtemp()
+    store = HistoryStore(store_directory)
+    store.store_history(history_info)
+    store_codes = store.countries()
+
+    def read_history_store():
+        for code in store_codes:
+            store.read(code)
+
+    benchmarks = [('parsing_main_data', lambda: cv.parsing_main_data(main_page), 1, 1),
+                  ('parsing_country_page', lambda: cv.parsing_country_page(main_page), 1, len(countries_info)),
+                  ('get_countries_links', lambda: cv.get_countries_links(main_page), 1, len(countries_info)),
+                  ('parsing_main_page', lambda: cv.parsing_main_page(main_page), 1, len(countries_info)),
+                  ('parsing_country_history', parse_history, len(country_pages), history_rows_number),
+                  ('history_store_read', read_history_store, 0, history_rows_number)]
+    results = []
+    for name, function, pages, rows in benchmarks:
+        seconds, peak = measure(function, repeat)
+        results.append((name, seconds, pages, rows, peak))
+    store.close()
+    shutil.rmtree(store_directory)
+
+    # The writes that need a prepared database or directory time only their own part
+    for name, function in [('inserting_country_info', insert_countries), ('inserting_history_info', insert_history),
+                           ('history_update', update_history), ('history_store_write', store_history)]:
+        seconds, rows = min(function() for _ in range(repeat))
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results.append((name, seconds, 0, rows, peak))
+    return results
+
+
+def get_parser():
+    """
+    This function set arguments for the parser from the argparse package.
+    :return: a parser.
+    """
+    parser = argparse.ArgumentParser(description='Data Mining Project benchmarks.')
+    parser.add_argument('--sizes', metavar='COUNTRIESxDAYS', nargs='+', default=DEFAULT_SIZES,
+                        help=f'sizes of the fixtures (default: {" ".join(DEFAULT_SIZES)})')
+    parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                        help='number of runs of every benchmark, the best run is reported (default: 3)')
+    parser.add_argument('--fixtures', metavar='DIR', type=str, default='benchmark_fixtures',
+                        help='A directory for the stored html fixtures (default: benchmark_fixtures).')
+    parser.add_argument('--output', metavar='results.json', type=str,
+                        help='A file to save the results to, as json.')
+    parser.add_argument('--compare', metavar='results.json', type=str,
+                        help='A results file of a previous run to compare with.')
+    return parser
+
+
+def main():
+    """
+    Runs the benchmarks for every size, prints the results and saves them as json.
+    """
+    args = get_parser().parse_args()
+    logger = logging.getLogger('benchmark')
+    cv = Coronavirus(URL, logger)
+
+    previous = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as file:
+            for result in json.load(file)['results']:
+                previous[(result['name'], result['countries'], result['days'])] = result['seconds']
+
+    results = []
+    for size in args.sizes:
+        countries_number, days = [int(number) for number in size.lower().split('x')]
+        main_page, country_pages = load_fixtures(args.fixtures, countries_number, days)
+        for name, seconds, pages, rows, peak in run_size(cv, main_page, country_pages, args.repeat):
+            result = {'name': name, 'countries': countries_number, 'days': days, 'seconds': seconds,
+                      'pages_per_s': pages / seconds if pages and seconds else None,
+                      'rows_per_s': rows / seconds if rows and seconds else None,
+                      'peak_memory_bytes': peak}
+            results.append(result)
+            line = (f'{name:<25}{size:>10}{seconds * 1000:>12.2f} ms'
+                    f'{result["rows_per_s"] or 0:>14.0f} rows/s{peak / 2 ** 20:>10.2f} MiB')
+            if (name, countries_number, days) in previous:
+                line += f'{previous[(name, countries_number, days)] / seconds:>8.2f}x'
+            print(line)
+
+    if args.output is not None:
+        meta = {'timestamp': time.time(), 'python': platform.python_version(), 'platform': platform.platform(),
+                'repeat': args.repeat}
+        with open(args.output, 'w') as file:
+            json.dump({'meta': meta, 'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
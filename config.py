@@ -8,14 +8,79 @@ URL = "https://www.worldometers.info/coronavirus/"
 # The URL to fetch USA states data from
 USA_URL = "https://www.worldometers.info/coronavirus/country/us/"
 
-# Update time list - fetch data at the time items in the list
+# Update time list - fetch data at the time items in the list. an item is a time of day (HH:MM:SS), an interval
+# (e.g. '@every 15m') or a cron expression (e.g. '*/15 * * * *')
 UPDATE_TIME = ['08:00:00', '16:00:00', '00:00:00']
+
+# Scheduler - the policy of scheduled runs that were missed ('coalesce': run once, 'catch-up': run each of them,
+# up to SCHEDULE_MAX_CATCH_UP), the longest sleep between checks of the clock (seconds), and the lag (seconds)
+# after a deadline that is logged as a warning
+SCHEDULE_POLICY = 'coalesce'
+SCHEDULE_MAX_CATCH_UP = 3
+SCHEDULE_MAX_SLEEP = 60
+SCHEDULE_LAG_WARNING = 5
+
+# Per-table schedules - every table is refreshed on its own schedules, instead of all of them on the update times,
+# e.g. {'countries': ['@every 15m'], 'history': ['@daily'], 'api': ['@weekly']}. empty: use the update times
+SCHEDULED_TABLES = ['countries', 'history', 'api', 'world']
+TABLE_SCHEDULES = {}
 # Countries to fetch - empty list: fetch all countries
 COUNTRIES_FETCH = []
 
+# Number of country pages to fetch in parallel - 1: fetch one country at a time
+FETCH_WORKERS = 1
+
+# HTTP client - number of pooled keep-alive connections per host and timeouts (seconds)
+HTTP_POOL_SIZE = 10
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 30
+
+# HTTP rate limiter - requests per second per host: initial, minimal and maximal rate, and the bucket size
+RATE_LIMIT_INITIAL = 5
+RATE_LIMIT_MIN = 0.5
+RATE_LIMIT_MAX = 50
+RATE_LIMIT_BURST = 5
+# The rate grows by about RATE_LIMIT_INCREASE every second without errors, and is multiplied by
+# RATE_LIMIT_DECREASE on an error or when a response takes longer than RATE_LIMIT_LATENCY seconds
+RATE_LIMIT_INCREASE = 0.5
+RATE_LIMIT_DECREASE = 0.5
+RATE_LIMIT_LATENCY = 5
+
+# HTTP retries - number of retries for a failed request, the backoff of the first retry and the maximal backoff
+RETRY_TIMES = 4
+RETRY_BACKOFF = 0.5
+RETRY_BACKOFF_MAX = 30
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+# HTTP response cache - maximal size in bytes of the compressed pages kept on disk
+HTTP_CACHE_MAX_BYTES = 200 * 1024 * 1024
+
+# History graphs of a country's webpage and their columns in the history table
+HISTORY_GRAPHS = {'Total Cases': 'total_cases', 'Daily New Cases': 'daily_cases', 'Active Cases': 'active_cases',
+                  'Total Deaths': 'total_deaths', 'Daily Deaths': 'daily_deaths'}
+# The year of the first history date, for dates without a year
+HISTORY_FIRST_YEAR = 2020
+# Number of days in a block of the compact history store
+HISTORY_STORE_BLOCK_DAYS = 128
+# The history store is compacted when more than this part of its data file is replaced blocks
+HISTORY_STORE_MAX_DEAD_RATIO = 0.5
+
+# Metrics endpoint - histogram buckets (seconds) and the host to listen on
+METRICS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300]
+METRICS_HOST = '127.0.0.1'
+
+# Query API - the host to listen on, the number of cached responses and the default and maximal top-N
+QUERY_API_HOST = '127.0.0.1'
+QUERY_CACHE_ENTRIES = 1024
+QUERY_TOP_DEFAULT = 10
+QUERY_TOP_MAX = 250
+
 # Error message printed when failing to fetch data
 ERR_MSG_FETCH = 'Failed to fetch data. Check HTML code and URL address'
 
+# Error message printed when failing to write a refresh cycle to the database
+ERR_MSG_DB = 'Failed to write data to the database, the cycle was rolled back.'
+
 # Error messages printed when failing to open a file and writing to a file
 ERR_FILE_OPEN = 'Failed to open a file!'
 ERR_FILE_WRITE = 'Failed to write to a file!'
@@ -30,9 +95,51 @@ USER_NAME = 'root'
 PASSWORD = 'nofaranderan'
 HOST = 'localhost'
 
+# Embedded SQLite backend - the database file and the pragmas of every connection
+SQLITE_PATH = 'corona.db'
+SQLITE_PRAGMAS = ['journal_mode=WAL', 'synchronous=NORMAL', 'temp_store=MEMORY', 'cache_size=-65536',
+                  'busy_timeout=5000']
+
+# The key columns of every table, used to update existing rows on insert
+UPSERT_KEYS = {'countries': ['id'], 'history': ['country_id', 'date'], 'states': ['id'],
+               'rollup_country_daily': ['country_id', 'date'], 'rollup_country_weekly': ['country_id', 'week'],
+               'rollup_continent_daily': ['continent', 'date']}
+
+# The aggregate tables maintained after every cycle, the days of the rolling averages and the name of the
+# world totals in the continents rollup
+ROLLUP_TABLES = ['rollup_country_daily', 'rollup_country_weekly', 'rollup_continent_daily']
+ROLLUP_WINDOW_DAYS = 7
+WORLD = 'World'
+
+# Maximal number of rows sent to the database in one batched statement
+INSERT_CHUNK_SIZE = 500
+# Maximal number of rows written in one transaction when loading the full history
+TRANSACTION_CHUNK_SIZE = 20000
+
+# Pipeline - maximal number of parsed pages waiting for the database writer, and the seconds between checks
+# that the writer is still running while the queue is full
+PIPELINE_QUEUE_SIZE = 64
+PIPELINE_PUT_TIMEOUT = 1
+
+# Sharded history jobs (--coordinator and --worker) - the seconds a worker holds a leased job, the jobs leased at
+# once, the attempts of a job before it fails, the seconds between a worker's checks of the queue, the maximal
+# seconds the coordinator waits for the jobs of a cycle, and the schedule of the coordinator's checks of the jobs
+JOB_LEASE_SECONDS = 300
+JOB_LEASE_BATCH = 8
+JOB_MAX_ATTEMPTS = 3
+JOB_POLL_SECONDS = 2
+JOB_WAIT_SECONDS = 1800
+JOB_COLLECT_SCHEDULE = '@every 30s'
+
+# Name of the unique key of the history table on (country_id, date)
+HISTORY_UNIQUE_KEY = 'uq_history_country_date'
+# Number of future months the monthly partitions of the history table are created ahead for (MySQL)
+PARTITION_MONTHS_AHEAD = 3
+
 ## The API address:
 API = "https://who-covid-19-data.p.rapidapi.com/api/data"
 OK_STATUS = 200
+NOT_MODIFIED_STATUS = 304
 
 COUNTRIES_NAMES_TO_CODES = {
   "Afghanistan": "AFG",
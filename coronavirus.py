@@ -1,17 +1,51 @@
-from bs4 import BeautifulSoup
+from lxml import etree, html as lxml_html
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from datetime import date
+from array import array
+import re
 from config import *
-import requests
+from http_client import get_default_client
+from metrics import FETCH_SECONDS, PARSE_SECONDS, FETCHES, timed
+from countries_snapshot import CountriesSnapshot, PARSED_COLUMNS
+
+# Precompiled XPath expressions for the main page
+MAIN_COUNTERS_XPATH = etree.XPath('//div[@id="maincounter-wrap"]')
+COUNTER_TITLE_XPATH = etree.XPath('.//h1')
+COUNTER_NUMBER_XPATH = etree.XPath('.//span')
+MAIN_TABLE_XPATH = etree.XPath('//table[@id="main_table_countries_today"]')
+ROWS_XPATH = etree.XPath('.//tr')
+CELLS_XPATH = etree.XPath('./td')
+LINKS_XPATH = etree.XPath('.//a')
+# The cells of the main table row with the values of PARSED_COLUMNS (the new recovered cell is skipped)
+PARSED_CELLS = [2, 3, 4, 5, 6, 8, 9, 10, 11, 12, 13, 14]
+
+# Compiled patterns for the Highcharts scripts of a country page
+CHART_PATTERN = re.compile(r'Highcharts\.chart\(')
+TITLE_PATTERN = re.compile(r"title:\s*\{\s*text:\s*['\"]([^'\"]*)['\"]")
+CATEGORIES_PATTERN = re.compile(r'categories:\s*\[([^\]]*)\]')
+SERIES_PATTERN = re.compile(r"name:\s*['\"]([^'\"]*)['\"][^\[\]]*?data:\s*\[([^\]]*)\]")
+CATEGORY_PATTERN = re.compile(r'"([^"]*)"')
+MONTHS = {'Jan': 1, 'Feb': 2, 'Mar': 3, 'Apr': 4, 'May': 5, 'Jun': 6,
+          'Jul': 7, 'Aug': 8, 'Sep': 9, 'Oct': 10, 'Nov': 11, 'Dec': 12}
 
 
 class Coronavirus:
     """
     Class Coronavirus. Initiate a coronavirus object with a url and a logger file.
+    The number of workers sets how many country pages are fetched and parsed in parallel (1 = serial).
+    Pages are fetched with the given HTTP client, or with the shared default client if none is given.
+    If an HttpCache is given, pages are revalidated with conditional GET requests and unchanged pages are
+    read from the cache.
     """
-    def __init__(self, url, logger):
+    def __init__(self, url, logger, workers=FETCH_WORKERS, client=None, cache=None):
         self.url = url
         self.logger = logger
+        self.workers = max(1, workers)
+        self.client = client if client is not None else get_default_client()
+        self.cache = cache
         self.world = {}
-        self.countries = []
+        self.countries = CountriesSnapshot()
         self.history = {}
 
     def get_global(self):
@@ -36,14 +70,120 @@ class Coronavirus:
         """
         Function html
         Receives a url address and returns its html code.
+        When the object has a cache, a cached page is revalidated and read from disk if it didn't change.
         :param url: the url to parse.
         :return: html page code.
         """
-        page = requests.get(url)
-        txt = page.text
+        with FETCH_SECONDS.time(url=url):
+            if self.cache is None:
+                page = self.client.get(url)
+                FETCHES.inc(status=page.status_code)
+                txt = page.text
+                self.logger.info(f'{url} was successfully parsed')
+                return txt
+
+            page = self.client.get(url, headers=self.cache.conditional_headers(url))
+            FETCHES.inc(status=page.status_code)
+            if page.status_code == NOT_MODIFIED_STATUS:
+                txt = self.cache.load(url)
+                if txt is not None:
+                    self.logger.info(f'{url} was not modified, using the cached page')
+                    return txt
+                # The cached page is gone, fetch it again without validators
+                page = self.client.get(url)
+                FETCHES.inc(status=page.status_code)
+            if page.status_code == OK_STATUS:
+                self.cache.store(url, page)
+            txt = page.text
         self.logger.info(f'{url} was successfully parsed')
         return txt
 
+    @staticmethod
+    def main_page_tree(txt):
+        """
+        Builds the lxml tree of the main page. The tree can be shared by all the main page parsing functions,
+        so the page is parsed only once.
+        :param txt: the html code (string) of the main page.
+        :return: the root element of the page.
+        """
+        return lxml_html.fromstring(txt)
+
+    @staticmethod
+    def numeric_value(text):
+        """
+        Converts the text of a table cell to a number. Empty and 'N/A' cells are converted to -1
+        (instead of None, for database insertion sake).
+        :param text: the text of the cell, e.g. '+1,234', '12.5' or 'N/A'.
+        :return: the value as an integer (rounded if needed).
+        """
+        text = text.strip().replace(',', '')
+        try:
+            return int(text)
+        except ValueError:
+            pass
+        try:
+            return round(float(text))
+        except ValueError:
+            return -1
+
+    def main_data_from_tree(self, tree):
+        """
+        Extracts the main titles data ('Coronavirus Cases', 'Deaths' and 'Recovered') from the main page tree.
+        :param tree: the main page tree, as returned by main_page_tree.
+        :return: the data as a dictionary, titles as keys and numbers as values.
+        """
+        global_info = {}
+        for data in MAIN_COUNTERS_XPATH(tree):
+            title = COUNTER_TITLE_XPATH(data)
+            number = COUNTER_NUMBER_XPATH(data)
+            if title and number:
+                global_info[title[0].text_content()[:-1]] = int(number[0].text_content().replace(',', ''))
+        return global_info
+
+    def countries_from_tree(self, tree):
+        """
+        Extracts both the countries data and the countries links from the countries table of the main page tree,
+        in one pass over the table rows.
+        :param tree: the main page tree, as returned by main_page_tree.
+        :return: the countries snapshot (see parsing_country_page) and a dictionary with a URL link for each
+        country to its webpage (see get_countries_links).
+        """
+        countries = CountriesSnapshot()
+        country_link_dict = {}
+        tables = MAIN_TABLE_XPATH(tree)
+        if not tables:
+            raise ValueError(ERR_MSG_FETCH)
+
+        for table_row in ROWS_XPATH(tables[0]):  # tr = table row in html
+            for link in LINKS_XPATH(table_row):
+                country_link = link.get('href')
+                if country_link is not None and 'country' in country_link:
+                    country_link_dict[link.text_content().strip()] = country_link
+
+            cells = CELLS_XPATH(table_row)  # td = table column in html
+            if len(cells) > 0:
+                country_name = cells[1].text_content().strip()
+                if country_name in ['Total:', 'World', 'North America',
+                                    'Asia', 'South America', 'Europe', 'Africa', 'Oceania', '']:
+                    continue
+
+                countries.append(country_name,
+                                 [self.numeric_value(cells[i].text_content()) for i in PARSED_CELLS],
+                                 cells[15].text_content().strip() or None if len(cells) > 15 else None)
+
+        return countries, country_link_dict
+
+    @timed(PARSE_SECONDS, page='main')
+    def parsing_main_page(self, txt):
+        """
+        Parses the main page once and extracts the global data, the countries data and the countries links.
+        :param txt: the html code (string) of the main page.
+        :return: the global data dictionary, the countries snapshot and the countries links dictionary.
+        """
+        tree = self.main_page_tree(txt)
+        countries, country_link_dict = self.countries_from_tree(tree)
+        return self.main_data_from_tree(tree), countries, country_link_dict
+
     def parsing_main_data(self, txt):
         """
         the main_data function attract the main titles data from the url page,
@@ -54,52 +194,89 @@ class Coronavirus:
         :param txt: the readable textual given data from URL
         :return: the data as a dictionary
         """
+        return self.main_data_from_tree(self.main_page_tree(txt))
 
-        soup = BeautifulSoup(txt, features="lxml")
-
-        titles_list = []
-        numbers_list = []
-
-        center_data = soup.select('#maincounter-wrap')
-
-        for data in center_data:
-            titles_list.append(data.select('h1')[0].text[:-1])
-            numbers_list.append(int(data.select('span')[0].text.replace(',', "")))
-        global_info = dict(zip(titles_list, numbers_list))
-        return global_info
+    @staticmethod
+    def parsing_series_values(data):
+        """
+        Converts the data array of a Highcharts series to typed values.
+        :param data: the text inside the series data brackets, e.g. '0,3,null,12'.
+        :return: an array of integer values and a missing-value mask (1 where the value is missing, with value 0).
+        """
+        items = [item.strip() for item in data.split(',')]
+        missing = bytearray(item in ('null', '') for item in items)
+        try:
+            values = array('q', [0 if is_missing else int(item) for item, is_missing in zip(items, missing)])
+        except ValueError:
+            # Some series have fractional values (e.g. moving averages) or unknown values
+            values = array('q')
+            for i, item in enumerate(items):
+                try:
+                    values.append(0 if missing[i] else round(float(item)))
+                except ValueError:
+                    values.append(0)
+                    missing[i] = 1
+        return values, missing
 
+    @staticmethod
+    def parsing_series_dates(categories):
+        """
+        Converts the categories of a Highcharts x axis to dates. The categories are either in the format
+        'Feb 15, 2020' or 'Feb 15'. Dates without a year start at HISTORY_FIRST_YEAR, and move to the next year
+        whenever the month goes backwards.
+        :param categories: the text inside the categories brackets, e.g. '"Feb 15","Feb 16"'.
+        :return: a list of dates.
+        """
+        dates = []
+        year = HISTORY_FIRST_YEAR
+        last_month = 0
+        for category in CATEGORY_PATTERN.findall(categories):
+            month_day, _, category_year = category.partition(',')
+            month_name, _, day = month_day.strip().partition(' ')
+            month = MONTHS[month_name]
+            if category_year:
+                year = int(category_year)
+            elif month < last_month:
+                year += 1
+            last_month = month
+            dates.append(date(year, month, int(day)))
+        return dates
+
+    @timed(PARSE_SECONDS, page='country')
     def parsing_country_history(self, txt):
         """
         Function parsing_country_history.
         This function receives an html string of a specific country and returns its coronavirus daily history
-        to the current day. The history contains 5 cases: Total Cases, Daily New Cases, Active Cases, Total Deaths and
-        Daily Deaths. If the country does not have a case or cases of some kind, for example, Total Deaths = 0,
-        It will return a blank list of lists for that case.
+        to the current day. The page is scanned once: every Highcharts chart is found in order, and the categories
+        and the named series of each chart are extracted from it. The first series of a chart is saved under the
+        chart title (e.g. Total Cases, Daily New Cases, Active Cases, Total Deaths and Daily Deaths), other series
+        of the same chart are saved as 'title (series name)', e.g. 'Daily New Cases (7-day moving average)'.
+        If the country does not have one of the 5 main graphs, for example, Total Deaths = 0,
+        It will return a blank dictionary for that graph.
         :param txt: the html code (string) of the country's webpage.
-        :return: a dictionary of 6 key cases: name and 5 graphs info. each graph  in a key and it value
-        is another dictionary, which had 2 key-value pair, containing list of dates and list of number of instances
+        :return: a dictionary with a key for each graph. its value is another dictionary with a list of dates,
+        an array of integer instances and a missing-value mask of the instances.
         """
-        starting_index = 0
-        country_history = {}
-        graph_list = ['Total Cases', 'Daily New Cases', 'Active Cases', 'Total Deaths', 'Daily Deaths']
+        country_history = {graph: dict() for graph in HISTORY_GRAPHS}
+        charts = [match.end() for match in CHART_PATTERN.finditer(txt)]
+        # Charts of the same page usually share their categories, so their dates are parsed once
+        parsed_dates = {}
 
-        for graph in graph_list:
+        for i, chart_start in enumerate(charts):
+            chart_end = charts[i + 1] if i + 1 < len(charts) else len(txt)
 
-            if txt.find(graph) == -1:
-                country_history[graph] = dict()
+            title = TITLE_PATTERN.search(txt, chart_start, chart_end)
+            categories = CATEGORIES_PATTERN.search(txt, chart_start, chart_end)
+            if title is None or categories is None:
                 continue
+            if categories.group(1) not in parsed_dates:
+                parsed_dates[categories.group(1)] = self.parsing_series_dates(categories.group(1))
+            dates = parsed_dates[categories.group(1)]
 
-            starting_index = starting_index + txt[starting_index:].find(graph)
-
-            starting_index = starting_index + txt[starting_index:].find('categories: [')
-            ending_index = starting_index + txt[starting_index:].find(']')
-            categories_list = txt[starting_index + len('categories: [') + 1:ending_index - 1].split('\",\"')
-
-            starting_index = starting_index + txt[starting_index:].find('data: [')
-            ending_index = starting_index + txt[starting_index:].find(']')
-            data_list = txt[starting_index + len('data: ['):ending_index].split(',')
-
-            country_history[graph] = {'dates': categories_list, 'instances': data_list}
+            for j, series in enumerate(SERIES_PATTERN.finditer(txt, categories.end(), chart_end)):
+                graph = title.group(1) if j == 0 else f'{title.group(1)} ({series.group(1)})'
+                instances, missing = self.parsing_series_values(series.group(2))
+                country_history[graph] = {'dates': dates, 'instances': instances, 'missing': missing}
 
         return country_history
 
@@ -109,137 +286,142 @@ class Coronavirus:
         :param txt: the html code (string) of the country's webpage.
         :return: a dictionary with a URL link for each country to its webpage.
         """
-        country_link_dict = {}
-
-        soup = BeautifulSoup(txt, features="lxml")
-
-        table = soup.select('#main_table_countries_today')[0]
-        for link in table.find_all('a'):
-            if 'country' in str(link):
-                country = link.get_text(strip=True)
-                country_link = link.get('href')
-                country_link_dict[country] = country_link
-        return country_link_dict
-
-    def cell_numeric_value(self, cell):
-        """
-         this helper function of parsing_country_page function
-         it helps to edit the values of each dictionary key.
-        :return:
-        """
-        cell_final = cell.text.strip()
-        if '+' in cell:
-            cell_final = int(cell_final[1:].replace(',', ''))
-        elif cell_final == '' or cell_final == 'N/A' or cell_final is None:
-            cell_final = -1    ## insteaCoronavirusd of None (for database insertion sake)
-        else:
-            # print(cell_final, type(cell_final))
-            cell_final = round(float(cell_final.replace(',', '')))
-        return cell_final
+        return self.countries_from_tree(self.main_page_tree(txt))[1]
 
     def parsing_country_page(self, txt_page):
         """
         Searching in the html code for country's relevant data regarding the Coronavirus cases
-        and returning its values in a list of dictionaries, where each dictionary represent a different country.
+        and returning its values as a columnar snapshot, with a row for each country (see CountriesSnapshot).
         :param txt_page: the HTML code.
-        :return: list of countries dictionaries
+        :return: the countries snapshot.
         """
-        soup = BeautifulSoup(txt_page, features="lxml")
-        table = soup.select('#main_table_countries_today')[0]
+        return self.countries_from_tree(self.main_page_tree(txt_page))[0]
 
-        table_list = []
+    @staticmethod
+    def country_update(country_row):
+        """
+        :param country_row: a row of the countries snapshot (see CountryRow).
+        :return: the country name, the parsed values to update (see update_country_info) and the country code,
+        or Nones if the country has no code.
+        """
+        if country_row['id'] is not None:
+            return country_row['name'], {column: country_row[column] for column in PARSED_COLUMNS}, country_row['id']
+        return None, None, None
 
-        for table_row in table.findAll('tr'):  # tr = table row in html
-            cells = table_row.findAll('td')  # td = table column in html
+    def fetch_country_history(self, country_link):
+        """
+        Fetches a single country's webpage and parses its history.
+        :param country_link: the relative link of the country's webpage.
+        :return: the country's history, as returned by parsing_country_history.
+        """
+        txt = self.html(self.url + country_link)
+        return self.parsing_country_history(txt)
 
-            if len(cells) > 0:
-                country_name = cells[1].text.strip()
-                if country_name in ['Total:', 'World', 'North America',
-                                    'Asia', 'South America', 'Europe', 'Africa', 'Oceania', '']:
-                    continue
+    def iter_countries_history(self, countries, country_link_dict, errors=None):
+        """
+        Fetches and parses the history of the given countries, and yields every country as soon as it is parsed.
+        When the object has more than one worker, the country pages are fetched in parallel by a bounded thread
+        pool, at most two pages per worker ahead of the consumer, so a slow consumer holds back the fetching.
+        The countries are yielded in the order of the countries list either way.
+        :param countries: a list of countries names to fetch.
+        :param country_link_dict: a dictionary with a URL link for each country to its webpage.
+        :param errors: optional, a dictionary that collects the exception of every country that failed, which is
+        then skipped. Without it, the first failure is raised.
+        :return: a generator of (country name, history) pairs.
+        """
+        if self.workers > 1 and len(countries) > 1:
+            with ThreadPoolExecutor(max_workers=min(self.workers, len(countries))) as executor:
+                pending = deque()
+                for country in countries:
+                    pending.append((country, executor.submit(self.fetch_country_history, country_link_dict[country])))
+                    if len(pending) >= 2 * self.workers:
+                        yield from self.country_result(*pending.popleft(), errors)
+                while pending:
+                    yield from self.country_result(*pending.popleft(), errors)
+        else:
+            for country in countries:
+                yield from self.country_result(country, None, errors, country_link_dict[country])
 
-                table_dictionaries = {
-                    'country': country_name,
-                    'total cases': self.cell_numeric_value(cells[2]),
-                    'new cases': self.cell_numeric_value(cells[3]),
-                    'total death': self.cell_numeric_value(cells[4]),
-                    'new deaths': self.cell_numeric_value(cells[5]),
-                    'total recovered': self.cell_numeric_value(cells[6]),
-                    'active cases': self.cell_numeric_value(cells[8]),
-                    'critical cases': self.cell_numeric_value(cells[9]),
-                    'cases per 1 million': self.cell_numeric_value(cells[10]),
-                    'deaths per 1 million': self.cell_numeric_value(cells[11]),
-                    'total tests': self.cell_numeric_value(cells[12]),
-                    'test per1 million': self.cell_numeric_value(cells[13]),
-                    'population': self.cell_numeric_value(cells[14])
-                }
-                table_list.append(table_dictionaries)
-
-        return table_list
+    def country_result(self, country, future, errors, country_link=None):
+        """
+        :param country: the country name.
+        :param future: the future of the country's fetch, or None to fetch the country's link now.
+        :param errors: optional, a dictionary that collects the exception of the country instead of raising it.
+        :param country_link: the relative link of the country's webpage, when there is no future.
+        :return: a list with the (country name, history) pair, or an empty list if it failed.
+        """
+        try:
+            history = future.result() if future is not None else self.fetch_country_history(country_link)
+        except Exception as ex:
+            if errors is None:
+                raise
+            errors[country] = ex
+            return []
+        return [(country, history)]
 
-    @staticmethod
-    def country_update(country_dict):
-        if country_dict['country'] in COUNTRIES_NAMES_TO_CODES.keys():
-            country = country_dict['country']
-            country_code = COUNTRIES_NAMES_TO_CODES[country_dict['country']]
-            update_data = {'total_cases': country_dict['total cases'],
-                           'new_cases': country_dict['new cases'],
-                           'total_deaths': country_dict['total death'],
-                           'new_deaths': country_dict['new deaths'],
-                           'total_recovered': country_dict['total recovered'],
-                           'active_cases': country_dict['active cases'],
-                           'critical_cases': country_dict['critical cases'],
-                           'cases_per_1m': country_dict['cases per 1 million'],
-                           'deaths_per_1m': country_dict['deaths per 1 million'],
-                           'total_tests': country_dict['total tests'],
-                           'tests_per_1m': country_dict['test per1 million'],
-                           'population': country_dict['population']}
-
-            return country, update_data, country_code
-        return None, None, None
+    def fetch_countries_history(self, countries, country_link_dict):
+        """
+        Fetches and parses the history of the given countries (see iter_countries_history).
+        :param countries: a list of countries names to fetch.
+        :param country_link_dict: a dictionary with a URL link for each country to its webpage.
+        :return: a dictionary with country name as key and its history as value.
+        """
+        return dict(self.iter_countries_history(countries, country_link_dict))
 
-    def web_scraper(self, table, countries_fetch_list):
+    def web_scraper(self, table, countries_fetch_list, sink=None, dispatch=None):
         """
         Function parsing_data
         Parsing data of Corona virus cases from the given website.
+        If a sink is given, the parsed data is also streamed to it while the next pages are fetched:
+        sink('countries', countries) once the main page is parsed, and sink('history', country, history)
+        for every country page.
+        If a dispatch is given, the country pages aren't fetched here: dispatch(countries, country_link_dict) is
+        called with the countries to fetch instead, e.g. to queue them for the history workers.
         :return: True or False if data fetching succeeded or not.
         """
         txt = self.html(self.url)
-        country_history = {}
 
         try:
+            # Parse the main page once: global data, countries data and the link for each country webpage
+            world, countries, country_link_dict = self.parsing_main_page(txt)
+
+            # the list of countries
+            country_list = countries.names
+
             # Fetching global data and printing to console
             if table == 'all' or table == 'world':
                 # global corona info:
-                self.world = self.parsing_main_data(txt)
+                self.world = world
                 print(self.world)
 
             # Fetching countries data
             if table == 'all' or table == 'countries':
-                self.countries = self.parsing_country_page(txt)
+                self.countries = countries
 
                 # Printing countries data to console
-                for country_dict in self.countries:
+                for country_row in self.countries.rows():
                     # each country corona info
-                    print(country_dict)
+                    print(country_row)
 
-                # the list of countries
-                country_list = [country_dict['country'] for country_dict in self.countries]
                 print(len(country_list), 'countries:', country_list)
+                if sink is not None:
+                    sink('countries', countries)
 
             if table == 'all' or table == 'history':
-                # get link for each country webpage:
-                country_link_dict = self.get_countries_links(txt)
                 if not countries_fetch_list:
                     countries_fetch_list = country_list
 
                 # for each country fetch its history
-                for country in countries_fetch_list:
-                    if country in COUNTRIES_NAMES_TO_CODES.keys():
-                        txt = self.html(self.url + country_link_dict[country])
-                        country_history[country] = self.parsing_country_history(txt)
-                        print(f'{country}\n{country_history[country]}')
-                self.history = country_history
+                countries = [country for country in countries_fetch_list if country in COUNTRIES_NAMES_TO_CODES.keys()]
+                self.history = {}
+                if dispatch is not None:
+                    dispatch(countries, country_link_dict)
+                    return True
+                for country, history in self.iter_countries_history(countries, country_link_dict):
+                    print(f'{country}\n{history}')
+                    self.history[country] = history
+                    if sink is not None:
+                        sink('history', country, history)
 
         except Exception as ex:
             self.logger.error(f'{ERR_MSG_FETCH}')
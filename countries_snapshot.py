@@ -0,0 +1,203 @@
+"""
+A compact columnar snapshot of the countries table. The parser appends every row of the main page table
+straight into typed columns (arrays of integers and floats, with a missing-value mask per column, as in the
+parsed history), instead of building a dictionary per country. The database writer, the diff with the previous
+snapshot and the exports read the columns through row views (CountryRow), so no per-country dictionaries are
+copied on the way.
+"""
+from array import array
+from collections.abc import Mapping, MutableMapping
+from config import COUNTRIES_NAMES_TO_CODES
+
+# The numeric columns parsed from the main page table, in the order of its cells
+PARSED_COLUMNS = ['total_cases', 'new_cases', 'total_deaths', 'new_deaths', 'total_recovered', 'active_cases',
+                  'critical_cases', 'cases_per_1m', 'deaths_per_1m', 'total_tests', 'tests_per_1m', 'population']
+NUMERIC_COLUMNS = PARSED_COLUMNS + ['transmission_type']
+FLOAT_COLUMNS = ['cases_per_1m', 'deaths_per_1m', 'tests_per_1m']
+# The columns of the countries table, in its order
+COLUMNS = ['id', 'name'] + NUMERIC_COLUMNS + ['continent']
+
+
+class CountryRow(MutableMapping):
+    """
+    Class CountryRow. A view of one row of a CountriesSnapshot, as a dictionary of the countries table columns.
+    Reading and writing a column reads and writes the snapshot's columns, nothing is copied.
+    """
+    __slots__ = ('snapshot', 'position')
+
+    def __init__(self, snapshot, position):
+        self.snapshot = snapshot
+        self.position = position
+
+    def __getitem__(self, column):
+        return self.snapshot.value(column, self.position)
+
+    def __setitem__(self, column, value):
+        self.snapshot.set_value(column, self.position, value)
+
+    def __delitem__(self, column):
+        raise TypeError('The columns of a snapshot row can not be deleted')
+
+    def __iter__(self):
+        return iter(COLUMNS)
+
+    def __len__(self):
+        return len(COLUMNS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class CountriesSnapshot(Mapping):
+    """
+    Class CountriesSnapshot. The countries as columns: lists of the ids, names and continents, and an array with a
+    missing-value mask (bytearray, 1 = None) per numeric column. It is a mapping of the country codes to their row
+    views. Every parsed row is kept, in the page order, including the countries without a code (see names), and
+    a code that appears twice under different names (e.g. 'UK' and 'United Kingdom') maps to its first row.
+    """
+    def __init__(self):
+        self.ids = []
+        self.names = []
+        self.continents = []
+        self.columns = {column: array('d' if column in FLOAT_COLUMNS else 'q') for column in NUMERIC_COLUMNS}
+        self.missing = {column: bytearray() for column in NUMERIC_COLUMNS}
+        self.positions = {}
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        :param rows: an iterable of rows (mappings) of the countries table, e.g. from a query.
+        :return: the snapshot of the rows.
+        """
+        snapshot = cls()
+        for row in rows:
+            snapshot.append(row['name'], [row[column] for column in PARSED_COLUMNS], row['continent'], row['id'],
+                            row['transmission_type'])
+        return snapshot
+
+    def append(self, name, values, continent=None, country_code=None, transmission_type=-1):
+        """
+        Appends a row.
+        :param name: the country name.
+        :param values: the values of PARSED_COLUMNS, in their order. None for a missing value.
+        :param continent: the continent of the country.
+        :param country_code: the country_id, looked up by the name if not given (None if it has none).
+        :param transmission_type: the transmission type, -1 if unknown.
+        :return: the position of the row.
+        """
+        position = len(self.names)
+        if country_code is None:
+            country_code = COUNTRIES_NAMES_TO_CODES.get(name)
+        self.ids.append(country_code)
+        self.names.append(name)
+        self.continents.append(continent)
+        for column, value in zip(NUMERIC_COLUMNS, (*values, transmission_type)):
+            self.columns[column].append(0 if value is None else value)
+            self.missing[column].append(value is None)
+        if country_code is not None:
+            self.positions.setdefault(country_code, position)
+        return position
+
+    def value(self, column, position):
+        """
+        :param column: a column of the countries table.
+        :param position: the position of a row.
+        :return: the value of the column in the row.
+        """
+        if column == 'id':
+            return self.ids[position]
+        if column == 'name':
+            return self.names[position]
+        if column == 'continent':
+            return self.continents[position]
+        if self.missing[column][position]:
+            return None
+        return self.columns[column][position]
+
+    def set_value(self, column, position, value):
+        """
+        :param column: a column of the countries table, except the id.
+        :param position: the position of a row.
+        :param value: the new value of the column in the row.
+        """
+        if column == 'name':
+            self.names[position] = value
+        elif column == 'continent':
+            self.continents[position] = value
+        elif column in self.columns:
+            self.columns[column][position] = 0 if value is None else value
+            self.missing[column][position] = value is None
+        else:
+            raise KeyError(column)
+
+    def __getitem__(self, country_code):
+        return CountryRow(self, self.positions[country_code])
+
+    def __iter__(self):
+        return iter(self.positions)
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __setitem__(self, country_code, row):
+        if country_code in self.positions:
+            position = self.positions[country_code]
+            for column in COLUMNS[1:]:
+                self.set_value(column, position, row[column])
+        else:
+            self.append(row['name'], [row[column] for column in PARSED_COLUMNS], row['continent'], country_code,
+                        row['transmission_type'])
+
+    def update(self, rows):
+        """
+        Writes rows into the snapshot, overwriting the rows of the same countries, as dict.update does.
+        :param rows: a mapping of country codes to rows (e.g. another snapshot).
+        """
+        for country_code, row in rows.items():
+            self[country_code] = row
+
+    def rows(self):
+        """
+        :return: the views of all the parsed rows, in the page order, including the countries without a code.
+        """
+        return [CountryRow(self, position) for position in range(len(self.names))]
+
+    def column(self, column):
+        """
+        A zero-copy view of a column, e.g. for exports.
+        :param column: a column of the countries table.
+        :return: a memoryview of a numeric column (see missing for its None values), or the list of a text column.
+        """
+        if column in self.columns:
+            return memoryview(self.columns[column])
+        return {'id': self.ids, 'name': self.names, 'continent': self.continents}[column]
+
+    def set_transmission(self, transmission):
+        """
+        Writes the transmission types into the transmission column.
+        :param transmission: the transmission types, as returned by api_query. countries without a type get -1.
+        """
+        transmission_types = {code: value['type'] for code, value in transmission.items()}
+        column, missing = self.columns['transmission_type'], self.missing['transmission_type']
+        for country_code, position in self.positions.items():
+            column[position] = transmission_types.get(country_code, -1)
+            missing[position] = False
+
+    def diff(self, previous):
+        """
+        Compares the snapshot with a previous one, column by column.
+        :param previous: the previous snapshot, or a mapping of country codes to rows.
+        :return: the codes of the countries that are new or changed, in the page order.
+        """
+        if not isinstance(previous, CountriesSnapshot):
+            previous = CountriesSnapshot.from_rows(previous.values())
+        changed = []
+        for country_code, position in self.positions.items():
+            other = previous.positions.get(country_code)
+            if other is None or self.names[position] != previous.names[other] or \
+                    self.continents[position] != previous.continents[other] or \
+                    any(self.columns[column][position] != previous.columns[column][other] or
+                        self.missing[column][position] != previous.missing[column][other]
+                        for column in NUMERIC_COLUMNS):
+                changed.append(country_code)
+        return changed
@@ -1,10 +1,13 @@
-from datetime import datetime
-
+import threading
+from datetime import date
 from sqlalchemy_utils.functions import database_exists, create_database
 from sqlalchemy import create_engine, MetaData, Table, Column, Date, Integer, String, Float, ForeignKey, \
-    update, select, schema
+    UniqueConstraint, update, select, schema, text, func, bindparam, event
 from sqlalchemy.dialects.mysql import insert
 from config import *
+from metrics import DB_SECONDS, ROWS_WRITTEN, COUNTRIES_DIFF, timed
+from migrations import migrate, add_history_partitions
+from countries_snapshot import CountriesSnapshot
 
 
 def make_engine(user_name, pswd, host, port=3306, db='corona'):
@@ -27,6 +30,25 @@ def make_engine(user_name, pswd, host, port=3306, db='corona'):
 # engine = make_engine(USER, PASSWORD, HOST)
 
 
+def make_sqlite_engine(path=SQLITE_PATH):
+    """
+    provides an engine of an embedded SQLite database file, for collectors without a MySQL server.
+    every connection is tuned for write throughput with SQLITE_PRAGMAS (WAL journal, relaxed fsync).
+    :param path: the path of the database file. created if it doesn't exist.
+    :return: the engine.
+    """
+    engine = create_engine(f'sqlite:///{path}')
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in SQLITE_PRAGMAS:
+            cursor.execute(f'PRAGMA {pragma}')
+        cursor.close()
+
+    return engine
+
+
 def create_connection(engine):
     """
     connects to an existing/ newly existing mysql database with the engine created
@@ -59,7 +81,7 @@ def create_or_use(engine, variable_table_name):
                   Column('total_recovered', Integer), Column('active_cases', Integer),
                   Column('critical_cases', Integer), Column('cases_per_1m', Float), Column('deaths_per_1m', Float),
                   Column('total_tests', Integer), Column('tests_per_1m', Float), Column('population', Integer),
-                  Column('transmission_type', Integer))
+                  Column('transmission_type', Integer), Column('continent', String(50)))
             # Implement the creation
             metadata.create_all()
 
@@ -70,6 +92,36 @@ def create_or_use(engine, variable_table_name):
                   Column('country_id', String(3), nullable=False),
                   Column('date', Date), Column('total_cases', Integer), Column('daily_cases', Integer),
                   Column('active_cases', Integer), Column('total_deaths', Integer),
+                  Column('daily_deaths', Integer),
+                  UniqueConstraint('country_id', 'date', name=HISTORY_UNIQUE_KEY))
+            # Implement the creation
+            metadata.create_all()
+
+        elif variable_table_name == 'rollup_country_daily':
+            # Rolling 7-day averages of the daily series of every country
+            Table(variable_table_name, metadata,
+                  Column('country_id', String(3), primary_key=True, nullable=False),
+                  Column('date', Date, primary_key=True, nullable=False),
+                  Column('daily_cases_avg7', Float), Column('daily_deaths_avg7', Float))
+            # Implement the creation
+            metadata.create_all()
+
+        elif variable_table_name == 'rollup_country_weekly':
+            # Weekly sums of the daily series of every country, by the Monday of the week
+            Table(variable_table_name, metadata,
+                  Column('country_id', String(3), primary_key=True, nullable=False),
+                  Column('week', Date, primary_key=True, nullable=False),
+                  Column('daily_cases', Integer), Column('daily_deaths', Integer))
+            # Implement the creation
+            metadata.create_all()
+
+        elif variable_table_name == 'rollup_continent_daily':
+            # Daily totals of every continent, and of the world (continent 'World')
+            Table(variable_table_name, metadata,
+                  Column('continent', String(50), primary_key=True, nullable=False),
+                  Column('date', Date, primary_key=True, nullable=False),
+                  Column('countries', Integer), Column('total_cases', Integer), Column('daily_cases', Integer),
+                  Column('active_cases', Integer), Column('total_deaths', Integer),
                   Column('daily_deaths', Integer))
             # Implement the creation
             metadata.create_all()
@@ -96,121 +148,395 @@ def create_or_use(engine, variable_table_name):
     return table_name, table_created
 
 
-# countries = create_or_use(engine, 'countries')
-# history = create_or_use(engine, 'history')
-# states = create_or_use(engine, 'states')
+class SchemaRegistry:
+    """
+    Class SchemaRegistry. Creates or reflects the tables of a database once per process and keeps the Table
+    objects, the statement templates built on them and their compiled forms, so the per-country and per-date
+    queries don't reflect the tables or compile their statements again.
+    Use get_registry to get the registry of an engine.
+    """
+    def __init__(self, engine):
+        self.engine = engine
+        self.tables = {}
+        self.created = {}
+        self.statements = {}
+        self.compiled_cache = {}
+        self.prepared = False
+        self.lock = threading.Lock()
+
+    def prepare(self):
+        """
+        Creates or reflects the countries, history and rollup tables and migrates the database to the latest
+        schema version (see migrations.py). The tables are reflected again if a migration ran, and on MySQL the
+        monthly partitions of history are extended. Called with the lock held, on first use of a table, so the
+        tables are never created in the middle of a cycle's transaction (which locks an SQLite database).
+        """
+        for name in ['countries', 'history'] + ROLLUP_TABLES:
+            self.tables[name], self.created[name] = create_or_use(self.engine, name)
+        if migrate(self.engine):
+            for name in ('countries', 'history'):
+                self.tables[name] = Table(name, MetaData(), autoload=True, autoload_with=self.engine)
+        add_history_partitions(self.engine)
+        self.prepared = True
+
+    def table(self, name):
+        """
+        Returns a table, creating or reflecting it on first use (see create_or_use).
+        The database is prepared and migrated on first use of any table (see prepare).
+        :param name: the table name: 'countries', 'history', 'states' or one of ROLLUP_TABLES.
+        :return: the table, and True if it was created by this process.
+        """
+        with self.lock:
+            if not self.prepared:
+                self.prepare()
+            if name not in self.tables:
+                self.tables[name], self.created[name] = create_or_use(self.engine, name)
+            return self.tables[name], self.created[name]
+
+    def statement(self, key, builder):
+        """
+        Returns a statement template, building it on first use.
+        :param key: the name of the statement.
+        :param builder: a function without arguments that builds the statement (with bind parameters).
+        :return: the statement.
+        """
+        with self.lock:
+            if key not in self.statements:
+                self.statements[key] = builder()
+            return self.statements[key]
+
+    def execute(self, connection, statement, *multiparams, **params):
+        """
+        Executes a statement with the registry's cache of compiled statements.
+        :param connection: the direct connection to the database.
+        :param statement: the statement (usually a template from the statement function).
+        :return: the result proxy.
+        """
+        return connection.execution_options(compiled_cache=self.compiled_cache).execute(statement, *multiparams,
+                                                                                         **params)
+
+
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(engine):
+    """
+    :param engine: the engine connection.
+    :return: the schema registry of the engine, created on first use.
+    """
+    with _registries_lock:
+        if engine not in _registries:
+            _registries[engine] = SchemaRegistry(engine)
+        return _registries[engine]
+
+
+def release_registry(engine):
+    """
+    Drops the schema registry of an engine that is no longer used (e.g. a temporary database), so the registry
+    doesn't keep the engine and its tables alive.
+    :param engine: the engine connection.
+    """
+    with _registries_lock:
+        _registries.pop(engine, None)
+
 
 def query_db_countries(engine, connection, table, where=None):
-    metadata = MetaData()
-    census = Table(table, metadata, autoload=True, autoload_with=engine)
+    """
+    Returns the rows of a country in the countries table.
+    :param engine: the engine connection.
+    :param connection: the direct connection to the database.
+    :param table: the countries table.
+    :param where: the country_id to look for.
+    :return: a list of the matching rows.
+    """
     if where is not None:
-        query = select([table]).where(table.columns.id == where)
-        ResultProxy = connection.execute(query)
-        Result = ResultProxy.fetchall()
-        return Result
+        registry = get_registry(engine)
+        query = registry.statement(f'{table.name}_by_id',
+                                   lambda: select([table]).where(table.c.id == bindparam('country_id')))
+        return registry.execute(connection, query, country_id=where).fetchall()
 
 
 def query_db_history(engine, connection, table, where=None):
-    metadata = MetaData()
-    census = Table(table, metadata, autoload=True, autoload_with=engine)
+    """
+    Returns the history rows of a country in the history table.
+    :param engine: the engine connection.
+    :param connection: the direct connection to the database.
+    :param table: the history table.
+    :param where: the country_id to look for.
+    :return: a list of the matching rows.
+    """
     if where is not None:
-        query = select([table]).where(table.columns.country_id == where)
-        ResultProxy = connection.execute(query)
-        Result = ResultProxy.fetchall()
-        return Result
+        registry = get_registry(engine)
+        query = registry.statement(f'{table.name}_by_country',
+                                   lambda: select([table]).where(table.c.country_id == bindparam('country_id')))
+        return registry.execute(connection, query, country_id=where).fetchall()
+
 
+def query_db_history_range(engine, connection, table, country_code, start=None, end=None):
+    """
+    Returns the history rows of a country in a date range, sorted by date, through the (country_id, date) key.
+    :param engine: the engine connection.
+    :param connection: the direct connection to the database.
+    :param table: the history table.
+    :param country_code: the country_id to look for.
+    :param start: optional, the first date of the range.
+    :param end: optional, the last date of the range (inclusive).
+    :return: a list of the matching rows.
+    """
+    registry = get_registry(engine)
+    query = registry.statement(f'{table.name}_by_country_range',
+                               lambda: select([table]).where(table.c.country_id == bindparam('country_id'))
+                               .where(table.c.date.between(bindparam('start'), bindparam('end')))
+                               .order_by(table.c.date))
+    return registry.execute(connection, query, country_id=country_code, start=start or date.min,
+                            end=end or date.max).fetchall()
+
+
+def query_db_top_countries(engine, connection, table, metric, limit):
+    """
+    Returns the countries with the highest values of a column in the countries table.
+    :param engine: the engine connection.
+    :param connection: the direct connection to the database.
+    :param table: the countries table.
+    :param metric: the name of a numeric column, e.g. 'total_cases'.
+    :param limit: the number of countries.
+    :return: a list of the rows, from the highest value down. countries without a value are left out.
+    """
+    registry = get_registry(engine)
+    query = registry.statement(f'{table.name}_top_{metric}',
+                               lambda: select([table]).where(table.c[metric].isnot(None))
+                               .order_by(table.c[metric].desc()).limit(bindparam('limit')))
+    return registry.execute(connection, query, limit=limit).fetchall()
 
-def inserting_country_info(countries_info, countries_table, connection, transmission):
+
+def country_rows(countries_info, transmission):
+    """
+    Prepares the parsed countries snapshot for the countries table: the transmission types are written into its
+    transmission column, and the rows are views of the snapshot, nothing is copied. Countries without a code are
+    skipped, and a country that appears twice under different names (e.g. 'UK' and 'United Kingdom') is kept once.
+    :param countries_info: the countries snapshot, as returned by parsing_country_page.
+    :param transmission: the transmission types, as returned by api_query (may be empty).
+    :return: a list of rows (views with the countries table columns, see CountryRow).
+    """
+    countries_info.set_transmission(transmission)
+    return list(countries_info.values())
+
+
+@timed(DB_SECONDS, function='inserting_country_info')
+def inserting_country_info(countries_info, countries_table, connection, transmission, chunk_size=INSERT_CHUNK_SIZE):
     """
-    mainly for first usage: to insert the data into the countries table
-    :param countries_info: a list of dictionaries, each represents a country, with the following values:
-    country_name (string), new cases (int), total deaths (int), new deaths (int), total recovered cases (int),
-    active cases (int), crical cases number (int), cases per 1 million population ratio (float),
+    mainly for first usage: to insert the data into the countries table.
+    the rows are sent in chunks of chunk_size rows, each chunk as one batched (executemany) insert.
+    :param countries_info: the countries snapshot, as returned by parsing_country_page, with the following values
+    per country: country_name (string), new cases (int), total deaths (int), new deaths (int), total recovered
+    cases (int), active cases (int), crical cases number (int), cases per 1 million population ratio (float),
     deaths per 1 million population ratio (float), number of tests (int),
     tests that were done per 1 million population ratio (float), total population (int)
     :param countries_table: the table name we want to insert the data to (-> the countries table)
     :param connection: the direct connection to the relevant mysql database.
+    :param transmission: the transmission types, as returned by api_query (may be empty).
+    :param chunk_size: the maximal number of rows in one statement.
+    """
+    rows = country_rows(countries_info, transmission)
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        connection.execute(insert(countries_table), chunk)
+        ROWS_WRITTEN.inc(len(chunk), table='countries')
+
+
+def history_rows(country_code, country_history):
+    """
+    Converts the parsed history of a country to rows of the history table, one row per date.
+    :param country_code: the country_id (3-letter-based string for a specific country).
+    :param country_history: the country's history, as returned by parsing_country_history:
+    {graph_name: {dates: [], instances: array, missing: bytearray}, ...}.
+    :return: a list of rows (dictionaries) sorted by date. missing values are None.
+    """
+    rows = {}
+    for graph, column in HISTORY_GRAPHS.items():
+        series = country_history.get(graph)
+        if not series or 'instances' not in series:
+            continue
+        for day, value, missing in zip(series['dates'], series['instances'], series['missing']):
+            if day not in rows:
+                rows[day] = dict.fromkeys(HISTORY_GRAPHS.values())
+                rows[day]['date'] = day
+                rows[day]['country_id'] = country_code
+            if not missing:
+                rows[day][column] = value
+    return [rows[day] for day in sorted(rows)]
+
+
+def upsert_statement(table, update_columns, dialect_name, insert_columns):
+    """
+    Builds an insert statement that updates the rows that already exist (by the table's UPSERT_KEYS).
+    The statement is executed with a list of rows (executemany), which the MySQL driver sends as one
+    multi-row statement and SQLite runs as one prepared statement.
+    :param table: the table.
+    :param update_columns: the columns to update when a row already exists.
+    :param dialect_name: the name of the database dialect, 'mysql' or 'sqlite'.
+    :param insert_columns: the columns of the rows.
+    :return: an INSERT ... ON DUPLICATE KEY UPDATE statement on MySQL,
+    INSERT ... ON CONFLICT DO UPDATE on SQLite.
+    """
+    if dialect_name == 'mysql':
+        stmt = insert(table)
+        return stmt.on_duplicate_key_update({column: stmt.inserted[column] for column in update_columns})
+    updates = ', '.join(f'{column} = excluded.{column}' for column in update_columns)
+    stmt = text(f'INSERT INTO {table.name} ({", ".join(insert_columns)}) '
+                f'VALUES ({", ".join(":" + column for column in insert_columns)}) '
+                f'ON CONFLICT ({", ".join(UPSERT_KEYS[table.name])}) DO UPDATE SET {updates}')
+    return stmt.bindparams(*[bindparam(column, type_=table.c[column].type) for column in insert_columns])
+
+
+def upsert_rows(connection, table, rows, update_columns, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Inserts or updates rows in chunks of chunk_size rows, each chunk as one batch (see upsert_statement).
+    Running it again with the same rows is safe.
+    :param connection: the direct connection to the relevant database.
+    :param table: the table.
+    :param rows: a list of rows (dictionaries with the same keys).
+    :param update_columns: the columns to update when a row already exists.
+    :param chunk_size: the maximal number of rows in one statement.
+    :return: the number of rows sent.
+    """
+    if not rows:
+        return 0
+    update_columns = list(update_columns)
+    insert_columns = list(rows[0])
+    registry = get_registry(connection.engine)
+    stmt = registry.statement(f'{table.name}_upsert_{",".join(insert_columns)}_{",".join(update_columns)}',
+                              lambda: upsert_statement(table, update_columns, connection.dialect.name,
+                                                       insert_columns))
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        registry.execute(connection, stmt, chunk)
+        ROWS_WRITTEN.inc(len(chunk), table=table.name)
+    return len(rows)
+
+
+def in_transactions(connection, rows, transaction_size, write):
     """
-    for row in countries_info:
-        # Check if a country's name is valid, i.e., have 3-letter code in the config dict
-        if row['country'] in COUNTRIES_NAMES_TO_CODES.keys():
-            # Check if the country has a transmission type (put -1 o.w.)
-            if COUNTRIES_NAMES_TO_CODES[row['country']] in transmission.keys():
-                row['transmission'] = transmission[COUNTRIES_NAMES_TO_CODES[row['country']]]['type']
-            else:
-                row['transmission'] = -1
-
-            stmt = insert(countries_table).values(id=COUNTRIES_NAMES_TO_CODES[row['country']],
-                                                  name=row['country'],
-                                                  total_cases=row['total cases'],
-                                                  new_cases=row['new cases'],
-                                                  total_deaths=row['total death'],
-                                                  new_deaths=row['new deaths'],
-                                                  total_recovered=row['total recovered'],
-                                                  active_cases=row['active cases'],
-                                                  critical_cases=row['critical cases'],
-                                                  cases_per_1m=row['cases per 1 million'],
-                                                  deaths_per_1m=row['deaths per 1 million'],
-                                                  total_tests=row['total tests'],
-                                                  tests_per_1m=row['test per1 million'],
-                                                  population=row['population'],
-                                                  transmission_type=row['transmission']
-                                                  )
-            connection.execute(stmt)
-
-
-def inserting_history_info(history_info, history_table, connection, engine, countries_table):
-    """
-    inserts the data into the history table.
+    Writes rows in size-bounded transactions: every group of transaction_size rows is committed on its own,
+    and a failed group is rolled back.
+    :param connection: the direct connection to the relevant database.
+    :param rows: a list of rows.
+    :param transaction_size: the maximal number of rows in one transaction. if None, the rows are written in
+    the caller's transaction (or autocommit).
+    :param write: a function that writes a list of rows and returns their number.
+    :return: the number of written rows.
+    """
+    if not transaction_size:
+        return write(rows)
+    written = 0
+    for start in range(0, len(rows), transaction_size):
+        with connection.begin():
+            written += write(rows[start:start + transaction_size])
+    return written
+
+
+@timed(DB_SECONDS, function='inserting_history_info')
+def inserting_history_info(history_info, history_table, connection, engine, countries_table,
+                           chunk_size=INSERT_CHUNK_SIZE, transaction_size=None):
+    """
+    inserts the data into the history table, as chunked upserts on the (country_id, date) unique key,
+    so inserting the same history again updates the existing rows instead of duplicating them.
+    only countries that exist in the countries table are inserted.
     :param history_info: a nested dictionary which built in the following format:
-    {country1_name: {graph1_name: {dates:[], instances:[]},...,graph5_name: {dates:[], instances:[]}}, country1_name:...}
-    the graphs names are: 'Total Cases', 'Daily New Cases', 'Active Cases', 'Total Deaths' and 'Daily Deaths'.
+    {country1_name: {graph1_name: {dates:[], instances:[], missing:[]},...}, country2_name:...}
+    the main graphs names are: 'Total Cases', 'Daily New Cases', 'Active Cases', 'Total Deaths' and 'Daily Deaths'.
     :param history_table: the name of the database history table (--> history)
     :param connection: the direct connection to the relevant mysql database.
+    :param chunk_size: the maximal number of rows in one statement.
+    :param transaction_size: the maximal number of rows in one transaction (see in_transactions).
     """
+    existing_codes = {row[0] for row in connection.execute(select([countries_table.c.id]))}
+    rows = []
     for key, value in history_info.items():
-        raw = query_db_countries(engine, connection, countries_table, where=COUNTRIES_NAMES_TO_CODES[key])
-        if len(raw) > 0 or key == 'US':
-            all_dates = []
-            all_values = [history_info[key]['Total Cases'], history_info[key]['Daily New Cases'],
-                          history_info[key]['Active Cases'], history_info[key]['Total Deaths'],
-                          history_info[key]['Daily Deaths']]
-            for lst in all_values:
-                if 'dates' in lst.keys() and len(lst['dates']) > 0:
-                    all_dates.extend(lst['dates'])
-            all_dates = set(all_dates)
-
-            dates = [datetime.strptime(f'{x} 20', '%b %d %y') for x in all_dates]
-
-            for i in range(len(dates) - 1):
-                values = {'date': dates[i], 'country_id': COUNTRIES_NAMES_TO_CODES[key]}
-
-                if 'instances' in history_info[key]['Total Cases'].keys():
-                    if history_info[key]['Total Cases']['instances'][i].isnumeric():
-                        values['total_cases'] = int(history_info[key]['Total Cases']['instances'][i])
-
-                if 'instances' in history_info[key]['Daily New Cases'].keys():
-                    if history_info[key]['Daily New Cases']['instances'][i].isnumeric():
-                        values['daily_cases'] = int(history_info[key]['Daily New Cases']['instances'][i])
-
-                if 'instances' in history_info[key]['Active Cases'].keys():
-                    if history_info[key]['Active Cases']['instances'][i].isnumeric():
-                        values['active_cases'] = int(history_info[key]['Active Cases']['instances'][i])
-
-                if 'instances' in history_info[key]['Total Deaths']:
-                    if history_info[key]['Total Deaths']['instances'][i].isnumeric():
-                        values['total_deaths'] = int(history_info[key]['Total Deaths']['instances'][i])
-
-                if 'instances' in history_info[key]['Daily Deaths'].keys():
-                    if history_info[key]['Daily Deaths']['instances'][i].isnumeric():
-                        values['daily_deaths'] = int(history_info[key]['Daily Deaths']['instances'][i])
-
-                stmt = insert(history_table).values(values)
-                connection.execute(stmt)
-        else:
-            continue
+        country_code = COUNTRIES_NAMES_TO_CODES.get(key)
+        if country_code in existing_codes:
+            rows.extend(history_rows(country_code, value))
+    in_transactions(connection, rows, transaction_size,
+                    lambda chunk: upsert_rows(connection, history_table, chunk, HISTORY_GRAPHS.values(), chunk_size))
+
+
+def query_countries_snapshot(connection, countries_table):
+    """
+    Reads the whole countries table, to be kept in memory as the previous snapshot of the countries.
+    :param connection: the direct connection to the relevant database.
+    :param countries_table: the countries table.
+    :return: the snapshot (see CountriesSnapshot), a mapping of country_id to its row.
+    """
+    return CountriesSnapshot.from_rows(connection.execute(select([countries_table])))
+
+
+def diff_country_rows(snapshot, countries_info):
+    """
+    Compares the new countries snapshot with the previous snapshot, column by column.
+    :param snapshot: the previous snapshot (see query_countries_snapshot).
+    :param countries_info: the new countries snapshot (see country_rows).
+    :return: a list of the rows that are new or changed, and the number of unchanged rows.
+    """
+    changed = [countries_info[country_code] for country_code in countries_info.diff(snapshot)]
+    return changed, len(countries_info) - len(changed)
 
 
+@timed(DB_SECONDS, function='refreshing_country_info')
+def refreshing_country_info(countries_info, countries_table, connection, snapshot, transmission=None,
+                            chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Writes only the countries that changed since the previous snapshot, as one batched upsert.
+    Without transmission types, the stored transmission type of every country is kept.
+    :param countries_info: the countries snapshot, as returned by parsing_country_page.
+    :param countries_table: the countries table.
+    :param connection: the direct connection to the relevant database.
+    :param snapshot: the previous snapshot (see query_countries_snapshot). it is updated in place with the
+    written rows, so it can be kept between cycles.
+    :param transmission: the transmission types, as returned by api_query (optional).
+    :param chunk_size: the maximal number of rows in one statement.
+    :return: the number of changed rows and the number of unchanged rows.
+    """
+    rows = country_rows(countries_info, transmission or {})
+    if not transmission:
+        for row in rows:
+            if row['id'] in snapshot:
+                row['transmission_type'] = snapshot[row['id']]['transmission_type']
+    changed, unchanged = diff_country_rows(snapshot, countries_info)
+    update_columns = [column.name for column in countries_table.columns if column.name != 'id']
+    upsert_rows(connection, countries_table, changed, update_columns, chunk_size)
+    for row in changed:
+        snapshot[row['id']] = row
+    COUNTRIES_DIFF.inc(len(changed), state='changed')
+    COUNTRIES_DIFF.inc(unchanged, state='unchanged')
+    return len(changed), unchanged
+
+
+@timed(DB_SECONDS, function='refreshing_transmission')
+def refreshing_transmission(countries_table, connection, snapshot, transmission, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Writes only the transmission types that changed since the previous snapshot, without scraping the countries.
+    Countries without a transmission type get -1, as in country_rows. Without transmission types nothing is written.
+    :param countries_table: the countries table.
+    :param connection: the direct connection to the relevant database.
+    :param snapshot: the previous snapshot (see query_countries_snapshot). it is updated in place.
+    :param transmission: the transmission types, as returned by api_query.
+    :param chunk_size: the maximal number of rows in one statement.
+    :return: the number of changed countries.
+    """
+    if not transmission:
+        return 0
+    transmission_types = {code: value['type'] for code, value in transmission.items()}
+    changed = [{'id': country_code, 'transmission_type': transmission_types.get(country_code, -1)}
+               for country_code, row in snapshot.items()
+               if row['transmission_type'] != transmission_types.get(country_code, -1)]
+    upsert_rows(connection, countries_table, changed, ['transmission_type'], chunk_size)
+    for row in changed:
+        snapshot[row['id']]['transmission_type'] = row['transmission_type']
+    return len(changed)
+
+
+@timed(DB_SECONDS, function='update_country_info')
 def update_country_info(countries_table, country_code, values_to_update, connection):
     """
     update an existing value, by explicitly give the specific country_id.
@@ -223,46 +549,131 @@ def update_country_info(countries_table, country_code, values_to_update, connect
     if country_code in COUNTRIES_NAMES_TO_CODES.keys():
         stmt = update(countries_table).where(countries_table.c.id == country_code).values(values_to_update)
         connection.execute(stmt)
+        ROWS_WRITTEN.inc(table='countries')
 
 
 # update_country_info(countries, 'SRB',{'new_cases':2}, connection)
-def history_update(country, history_table, values_to_add, connection, engine, countries_table):
-    """
-    Function that updates the history for each country.
-    :param country:
-    :param history_table:
-    :param values_to_add:
-    :param connection:
-    :param engine:
-    :param countries_table:
-    :return:
+def query_last_history_dates(connection, history_table, country_code=None):
+    """
+    Returns the last stored date (the watermark) of every country in the history table, in one query.
+    :param connection: the direct connection to the relevant database.
+    :param history_table: the history table.
+    :param country_code: optional, return only the watermark of this country.
+    :return: a dictionary with country_id as key and its last date as value.
+    """
+    query = select([history_table.c.country_id, func.max(history_table.c.date)])
+    if country_code is not None:
+        query = query.where(history_table.c.country_id == country_code)
+    query = query.group_by(history_table.c.country_id)
+    return {country_id: last_date for country_id, last_date in connection.execute(query) if last_date is not None}
+
+
+def new_history_rows(country_code, country_history, last_date):
+    """
+    Returns the history rows of a country from its watermark on. The watermark day itself is included,
+    since the last day of a page may have been written before the day was complete.
+    :param country_code: the country_id (3-letter-based string for a specific country).
+    :param country_history: the country's history, as returned by parsing_country_history.
+    :param last_date: the last stored date of the country, or None if none is stored.
+    :return: a list of rows (dictionaries) sorted by date.
+    """
+    rows = history_rows(country_code, country_history)
+    if last_date is None:
+        return rows
+    return [row for row in rows if row['date'] >= last_date]
+
+
+@timed(DB_SECONDS, function='appending_history_info')
+def appending_history_info(history_info, history_table, connection, watermarks=None, chunk_size=INSERT_CHUNK_SIZE,
+                           affected=None):
+    """
+    Incremental history update: appends only the days after each country's watermark (see new_history_rows),
+    as chunked upserts. the work depends on the number of new days, not on the length of the stored history.
+    :param history_info: a nested dictionary of countries histories (see inserting_history_info).
+    :param history_table: the history table.
+    :param connection: the direct connection to the relevant database.
+    :param watermarks: the last stored date of every country (see query_last_history_dates). it is updated in
+    place with the appended dates, so it can be kept between cycles. queried from the table if not given.
+    :param chunk_size: the maximal number of rows in one statement.
+    :param affected: optional, a dictionary that is filled with the first written date of every written country
+    (see refreshing_rollups).
+    :return: the number of appended (or refreshed) rows.
+    """
+    if watermarks is None:
+        watermarks = query_last_history_dates(connection, history_table)
+    rows = []
+    for key, value in history_info.items():
+        country_code = COUNTRIES_NAMES_TO_CODES.get(key)
+        if country_code is None:
+            continue
+        country_rows = new_history_rows(country_code, value, watermarks.get(country_code))
+        if country_rows:
+            rows.extend(country_rows)
+            watermarks[country_code] = country_rows[-1]['date']
+            if affected is not None:
+                affected[country_code] = min(affected.get(country_code, country_rows[0]['date']),
+                                             country_rows[0]['date'])
+    return upsert_rows(connection, history_table, rows, HISTORY_GRAPHS.values(), chunk_size)
+
+
+@timed(DB_SECONDS, function='history_update')
+def history_update(country, history_table, values_to_add, connection, engine, countries_table,
+                   chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Function that updates the history of one country: appends the days from its last stored date on.
+    :param country: the country name.
+    :param history_table: the history table.
+    :param values_to_add: the country's history, as returned by parsing_country_history.
+    :param connection: the direct connection to the relevant database.
+    :param engine: the engine connection.
+    :param countries_table: the countries table.
+    :param chunk_size: the maximal number of rows in one statement.
+    :return: the number of appended (or refreshed) rows.
     """
     if country in COUNTRIES_NAMES_TO_CODES.keys():
         country_code = COUNTRIES_NAMES_TO_CODES[country]
-        if 'dates' in values_to_add.keys():
-            for date in values_to_add['dates']:
-                add_new_history_info(history_table, country_code, values_to_add,
-                                     date, connection, engine, countries_table)
-
-def add_new_history_info(history_table, country_code, values_to_add, date, connection, engine, countries_table):
-    """
-    when it comes to the history table, data is only added and not updated,
-    so in this case, given a specific date and country code where we what to add data.
-    if the it is a new data, it will have a new date, so we will call the insert function.
-    in case that the date already excist, we will print to the user a message concerning that issue.
-    :param history_table: the name of the history table (--> history)
-    :param country_code: the country_id (3-letter-based string for a specific country,
-    which is a universal convention instead of numeric id).
-    :param values_to_add: what are the new values we want to see the table.
-    :param date: the date where we want to see the new value
-    :param connection: the direct connection to the relevant mysql database.
+        last_date = query_last_history_dates(connection, history_table, country_code).get(country_code)
+        rows = new_history_rows(country_code, values_to_add, last_date)
+        return upsert_rows(connection, history_table, rows, HISTORY_GRAPHS.values(), chunk_size)
+    return 0
+
+
+@timed(DB_SECONDS, function='syncing_databases')
+def syncing_databases(source_engine, target_engine, chunk_size=INSERT_CHUNK_SIZE,
+                      transaction_size=TRANSACTION_CHUNK_SIZE):
+    """
+    Copies the countries and history tables of one database into another in bulk, e.g. from the SQLite database
+    of an edge collector into the central MySQL. the countries are upserted in one transaction, and only the
+    history from each country's watermark in the target database on is streamed and upserted, in transactions
+    of transaction_size rows. running it again is safe.
+    :param source_engine: the engine of the database to copy from.
+    :param target_engine: the engine of the database to copy into.
+    :param chunk_size: the maximal number of rows in one statement.
+    :param transaction_size: the maximal number of history rows in one transaction.
+    :return: the number of countries rows and history rows that were copied.
     """
-    row = query_db_history(engine, connection, history_table, where=country_code)
-    if len(row) > 0:
-        stmt = select([history_table]).where((history_table.c.country_id == country_code) &
-                                       (history_table.c.date == datetime.strptime(f'{date} 2020', '%b %d %Y')))
-        result = connection.execute(stmt).fetchall()
-        if len(result) == 0:
-            inserting_history_info(values_to_add, history_table, connection, engine, countries_table)
-        else:
-            print('that entry is already exist')
+    source, target = get_registry(source_engine), get_registry(target_engine)
+    source_countries, source_history = source.table('countries')[0], source.table('history')[0]
+    target_countries, target_history = target.table('countries')[0], target.table('history')[0]
+    history_columns = [column for column in source_history.columns if column.name != 'id']
+
+    with source_engine.connect() as source_connection, target_engine.connect() as target_connection:
+        countries_rows = list(query_countries_snapshot(source_connection, source_countries).values())
+        with target_connection.begin():
+            upsert_rows(target_connection, target_countries, countries_rows,
+                        [column.name for column in target_countries.columns if column.name != 'id'], chunk_size)
+
+        watermarks = query_last_history_dates(target_connection, target_history)
+        result = source_connection.execute(select(history_columns).order_by(source_history.c.country_id,
+                                                                            source_history.c.date))
+        history_synced = 0
+        while True:
+            batch = result.fetchmany(transaction_size)
+            if not batch:
+                break
+            rows = [dict(row) for row in batch
+                    if row['country_id'] not in watermarks or row['date'] >= watermarks[row['country_id']]]
+            with target_connection.begin():
+                history_synced += upsert_rows(target_connection, target_history, rows, HISTORY_GRAPHS.values(),
+                                              chunk_size)
+    return len(countries_rows), history_synced
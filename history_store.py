@@ -0,0 +1,379 @@
+import os
+import json
+import zlib
+import bisect
+import threading
+from array import array
+from datetime import date
+from itertools import accumulate
+from contextlib import contextmanager
+from config import HISTORY_GRAPHS, HISTORY_STORE_BLOCK_DAYS, COUNTRIES_NAMES_TO_CODES
+
+# Processes that share a store directory lock it with flock, which is only available on Unix
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+def encode_varints(values, out):
+    """
+    Appends integers to a buffer as zigzag varints, so small negative and positive numbers take one byte.
+    :param values: an iterable of integers.
+    :param out: a bytearray to append to.
+    """
+    for value in values:
+        value = (value << 1) ^ (value >> 63)
+        while value >= 0x80:
+            out.append((value & 0x7f) | 0x80)
+            value >>= 7
+        out.append(value)
+
+
+def decode_varints(data, pos, count):
+    """
+    Reads zigzag varints from a buffer.
+    :param data: the buffer.
+    :param pos: the position of the first varint.
+    :param count: the number of varints to read.
+    :return: an array of the integers, and the position after the last varint.
+    """
+    values = array('q')
+    append = values.append
+    for _ in range(count):
+        byte = data[pos]
+        pos += 1
+        result = byte & 0x7f
+        shift = 7
+        while byte & 0x80:
+            byte = data[pos]
+            pos += 1
+            result |= (byte & 0x7f) << shift
+            shift += 7
+        append((result >> 1) ^ -(result & 1))
+    return values, pos
+
+
+def deltas(values):
+    """
+    :param values: a sequence of integers.
+    :return: the differences of every value from the previous one (the first from 0).
+    """
+    return [value - previous for previous, value in zip([0] + list(values[:-1]), values)]
+
+
+def history_columns(country_history):
+    """
+    Converts the parsed history of a country to columns, one value per date of any of the 5 main graphs.
+    :param country_history: the country's history, as returned by parsing_country_history.
+    :return: a sorted list of date ordinals, and a dictionary with the values of each history column,
+    None for a missing value.
+    """
+    columns = {}
+    for graph, column in HISTORY_GRAPHS.items():
+        series = country_history.get(graph)
+        if not series or 'instances' not in series:
+            continue
+        columns[column] = {day.toordinal(): None if missing else value
+                           for day, value, missing in zip(series['dates'], series['instances'], series['missing'])}
+    ordinals = sorted(set().union(*columns.values()))
+    return ordinals, {column: [columns.get(column, {}).get(ordinal) for ordinal in ordinals]
+                      for column in HISTORY_GRAPHS.values()}
+
+
+def encode_block(ordinals, columns):
+    """
+    Encodes a block of days of a country: the number of days, the first date and the gaps between the dates,
+    then for every history column a bitmap of its present values and the deltas between them. all the
+    numbers are zigzag varints, and the block is zlib compressed.
+    :param ordinals: the sorted date ordinals of the block.
+    :param columns: a dictionary with a list of values per history column, None for a missing value.
+    :return: the encoded block.
+    """
+    out = bytearray()
+    encode_varints([len(ordinals), ordinals[0]], out)
+    encode_varints(deltas(ordinals)[1:], out)
+    for column in HISTORY_GRAPHS.values():
+        bitmap = bytearray((len(ordinals) + 7) // 8)
+        present = []
+        for i, value in enumerate(columns[column]):
+            if value is not None:
+                bitmap[i >> 3] |= 1 << (i & 7)
+                present.append(value)
+        out += bitmap
+        encode_varints(deltas(present), out)
+    return zlib.compress(bytes(out), 9)
+
+
+def decode_block(block):
+    """
+    Decodes a block encoded by encode_block.
+    :param block: the encoded block.
+    :return: a list of date ordinals, and a dictionary with an array of values and a missing-value mask
+    (bytearray) per history column. missing values are 0 in the arrays.
+    """
+    data = zlib.decompress(block)
+    (days, first), pos = decode_varints(data, 0, 2)
+    gaps, pos = decode_varints(data, pos, days - 1)
+    ordinals = list(accumulate(gaps, initial=first))
+    columns = {}
+    for column in HISTORY_GRAPHS.values():
+        bitmap = data[pos:pos + (days + 7) // 8]
+        pos += len(bitmap)
+        missing = bytearray(not bitmap[i >> 3] & (1 << (i & 7)) for i in range(days))
+        present, pos = decode_varints(data, pos, days - sum(missing))
+        present = iter(accumulate(present))
+        columns[column] = (array('q', [0 if absent else next(present) for absent in missing]), missing)
+    return ordinals, columns
+
+
+class HistoryStore:
+    """
+    Class HistoryStore. A compact on-disk store of the countries history, as an alternative to the wide rows of
+    the history table. The history of every country is split into blocks of consecutive days, each one column
+    oriented, delta and varint encoded and compressed (see encode_block). The blocks are appended to a data
+    file, and a json line with the country, the date range and the location of each block is appended to an
+    index file, which is kept in memory, so a date range read decodes only the blocks of the range.
+    The last block of a country is rewritten when the country's history is stored again, and the earlier blocks
+    are final. Only the 5 main graphs of HISTORY_GRAPHS are stored.
+    Several processes can share a directory (e.g. history workers): the writes and the compactions hold an
+    exclusive flock of the lock file, and the in-memory index catches up with the other processes' blocks
+    whenever the lock is taken (see refresh). Without fcntl (Windows), a directory is for one process only.
+    """
+    DATA_FILE = 'history.dat'
+    INDEX_FILE = 'index.jsonl'
+    LOCK_FILE = 'store.lock'
+    SHARED = fcntl is not None
+
+    def __init__(self, directory, block_days=HISTORY_STORE_BLOCK_DAYS):
+        self.directory = directory
+        self.block_days = block_days
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # country code -> sorted list of index records, and the last date ordinal of each of them (for bisect)
+        self.blocks = {}
+        self.lasts = {}
+        # the bytes of the index file that were read into the in-memory index
+        self.index_position = 0
+        self.data_file = self.index_file = None
+        self.lock_file = open(os.path.join(directory, self.LOCK_FILE), 'a')
+        # Open the files and read the index
+        with self.locked():
+            pass
+
+    @contextmanager
+    def locked(self, exclusive=False):
+        """
+        Locks the store for the threads of the process and, with fcntl, for the other processes that share the
+        directory, and refreshes the in-memory index (see refresh).
+        :param exclusive: True to write the files, False to read them.
+        """
+        with self.lock:
+            if fcntl is not None:
+                fcntl.flock(self.lock_file, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                self.refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """
+        Reads the index records that other processes appended since the index was read. If another process
+        compacted the store, the files are opened again and the whole index is read again.
+        """
+        data_path = os.path.join(self.directory, self.DATA_FILE)
+        index_path = os.path.join(self.directory, self.INDEX_FILE)
+        if self.index_file is None or not os.path.exists(index_path) or \
+                os.stat(index_path).st_ino != os.fstat(self.index_file.fileno()).st_ino:
+            if self.index_file is not None:
+                self.data_file.close()
+                self.index_file.close()
+            self.blocks = {}
+            self.lasts = {}
+            self.index_position = 0
+            self.data_file = open(data_path, 'a+b')
+            self.index_file = open(index_path, 'a')
+        with open(index_path, 'rb') as file:
+            file.seek(self.index_position)
+            appended = file.read()
+        for line in appended.decode().splitlines():
+            if line.strip():
+                self.add_record(json.loads(line))
+        self.index_position += len(appended)
+
+    def add_record(self, record):
+        """
+        Adds a block to the in-memory index. A block replaces the blocks of its country that start on or after
+        its first date.
+        :param record: the index record of the block.
+        """
+        record['first_ordinal'] = date.fromisoformat(record['first']).toordinal()
+        record['last_ordinal'] = date.fromisoformat(record['last']).toordinal()
+        blocks = self.blocks.setdefault(record['country'], [])
+        while blocks and blocks[-1]['first_ordinal'] >= record['first_ordinal']:
+            blocks.pop()
+        blocks.append(record)
+        self.lasts[record['country']] = [block['last_ordinal'] for block in blocks]
+
+    def read_block(self, record):
+        """
+        :param record: the index record of a block.
+        :return: the decoded block (see decode_block).
+        """
+        self.data_file.seek(record['offset'])
+        return decode_block(self.data_file.read(record['length']))
+
+    def store(self, country_code, country_history):
+        """
+        Stores the history of a country. The days from the first date of the country's last block are
+        encoded again, merged with the stored days of that block, and the earlier days are left as they are.
+        A block that is the same as the stored last block is not written again.
+        :param country_code: the country_id (3-letter-based string for a specific country).
+        :param country_history: the country's history, as returned by parsing_country_history.
+        :return: the number of written days.
+        """
+        ordinals, columns = history_columns(country_history)
+        written = 0
+        with self.locked(exclusive=True):
+            blocks = self.blocks.get(country_code, [])
+            last_block = None
+            if blocks:
+                self.data_file.seek(blocks[-1]['offset'])
+                last_block = self.data_file.read(blocks[-1]['length'])
+                # Keep the stored days of the last block that are missing from the new history
+                stored_ordinals, stored_columns = self.read_block(blocks[-1])
+                start = bisect.bisect_left(ordinals, blocks[-1]['first_ordinal'])
+                merged = {ordinal: {column: None if stored_columns[column][1][i] else stored_columns[column][0][i]
+                                    for column in HISTORY_GRAPHS.values()}
+                          for i, ordinal in enumerate(stored_ordinals)}
+                for i in range(start, len(ordinals)):
+                    merged[ordinals[i]] = {column: columns[column][i] for column in HISTORY_GRAPHS.values()}
+                ordinals = sorted(merged)
+                columns = {column: [merged[ordinal][column] for ordinal in ordinals]
+                           for column in HISTORY_GRAPHS.values()}
+
+            for start in range(0, len(ordinals), self.block_days):
+                block_ordinals = ordinals[start:start + self.block_days]
+                block = encode_block(block_ordinals, {column: values[start:start + self.block_days]
+                                                      for column, values in columns.items()})
+                if start == 0 and block == last_block:
+                    continue
+                written += len(block_ordinals)
+                self.data_file.seek(0, os.SEEK_END)
+                offset = self.data_file.tell()
+                self.data_file.write(block)
+                record = {'country': country_code, 'first': date.fromordinal(block_ordinals[0]).isoformat(),
+                          'last': date.fromordinal(block_ordinals[-1]).isoformat(), 'days': len(block_ordinals),
+                          'offset': offset, 'length': len(block)}
+                self.data_file.flush()
+                line = json.dumps(record) + '\n'
+                self.index_file.write(line)
+                self.index_file.flush()
+                self.index_position += len(line.encode())
+                self.add_record(record)
+        return written
+
+    def store_history(self, history_info):
+        """
+        Stores the history of several countries.
+        :param history_info: a dictionary of countries and their history, as returned by get_history.
+        :return: the number of written days.
+        """
+        return sum(self.store(COUNTRIES_NAMES_TO_CODES[country], country_history)
+                   for country, country_history in history_info.items() if country in COUNTRIES_NAMES_TO_CODES)
+
+    def read(self, country_code, start=None, end=None):
+        """
+        Reads the history of a country in a date range, decoding only the blocks that overlap the range.
+        :param country_code: the country_id (3-letter-based string for a specific country).
+        :param start: optional, the first date of the range.
+        :param end: optional, the last date of the range (inclusive).
+        :return: the history in the format of parsing_country_history, a dictionary with a key for each of the
+        5 main graphs, and its dates, instances and missing-value mask.
+        """
+        first = start.toordinal() if start is not None else None
+        last = end.toordinal() if end is not None else None
+        ordinals = []
+        values = {column: (array('q'), bytearray()) for column in HISTORY_GRAPHS.values()}
+        with self.locked():
+            blocks = self.blocks.get(country_code, [])
+            i = bisect.bisect_left(self.lasts.get(country_code, []), first) if first is not None else 0
+            while i < len(blocks) and (last is None or blocks[i]['first_ordinal'] <= last):
+                block_ordinals, block_columns = self.read_block(blocks[i])
+                low = bisect.bisect_left(block_ordinals, first) if first is not None else 0
+                high = bisect.bisect_right(block_ordinals, last) if last is not None else len(block_ordinals)
+                ordinals += block_ordinals[low:high]
+                for column, (instances, missing) in block_columns.items():
+                    values[column][0].extend(instances[low:high])
+                    values[column][1].extend(missing[low:high])
+                i += 1
+        dates = [date.fromordinal(ordinal) for ordinal in ordinals]
+        return {graph: {'dates': dates, 'instances': values[column][0], 'missing': values[column][1]}
+                for graph, column in HISTORY_GRAPHS.items()}
+
+    def date_range(self, country_code):
+        """
+        :param country_code: the country_id (3-letter-based string for a specific country).
+        :return: the first and the last stored dates of the country, or None if it isn't stored.
+        """
+        with self.locked():
+            blocks = self.blocks.get(country_code)
+            if not blocks:
+                return None
+            return date.fromordinal(blocks[0]['first_ordinal']), date.fromordinal(blocks[-1]['last_ordinal'])
+
+    def countries(self):
+        """
+        :return: the codes of the stored countries.
+        """
+        with self.locked():
+            return list(self.blocks)
+
+    def size(self):
+        """
+        :return: the size in bytes of the current blocks, and of the data file including the replaced blocks.
+        """
+        with self.locked():
+            self.data_file.seek(0, os.SEEK_END)
+            return sum(block['length'] for blocks in self.blocks.values() for block in blocks), self.data_file.tell()
+
+    def dead_ratio(self):
+        """
+        :return: the part of the data file taken by replaced blocks (see compact), between 0 and 1.
+        """
+        live, total = self.size()
+        return (total - live) / total if total else 0
+
+    def compact(self):
+        """
+        Rewrites the data and index files with the current blocks only, dropping the replaced ones.
+        """
+        with self.locked(exclusive=True):
+            data_path = os.path.join(self.directory, self.DATA_FILE)
+            index_path = os.path.join(self.directory, self.INDEX_FILE)
+            with open(data_path + '.tmp', 'wb') as data_file, open(index_path + '.tmp', 'w') as index_file:
+                for blocks in self.blocks.values():
+                    for block in blocks:
+                        self.data_file.seek(block['offset'])
+                        body = self.data_file.read(block['length'])
+                        block['offset'] = data_file.tell()
+                        data_file.write(body)
+                        index_file.write(json.dumps({key: value for key, value in block.items()
+                                                     if not key.endswith('_ordinal')}) + '\n')
+            self.data_file.close()
+            self.index_file.close()
+            os.replace(data_path + '.tmp', data_path)
+            os.replace(index_path + '.tmp', index_path)
+            self.data_file = open(data_path, 'a+b')
+            self.index_file = open(index_path, 'a')
+            self.index_position = os.path.getsize(index_path)
+
+    def close(self):
+        """
+        Closes the store files.
+        """
+        self.data_file.close()
+        self.index_file.close()
+        self.lock_file.close()
@@ -0,0 +1,141 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import threading
+from config import HTTP_CACHE_MAX_BYTES
+
+
+class HttpCache:
+    """
+    Class HttpCache. An on-disk cache of HTTP responses used for conditional GET requests.
+    Every cached page is stored as a gzip compressed body next to a small json file with its validators
+    (ETag and Last-Modified). When the total size of the bodies passes max_bytes, the least recently used
+    pages are evicted.
+    """
+    def __init__(self, directory, max_bytes=HTTP_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # key -> [body size, last used time], rebuilt from the files already on disk
+        self.index = {}
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.gz'):
+                stat = entry.stat()
+                self.index[entry.name[:-len('.gz')]] = [stat.st_size, stat.st_mtime]
+        self.size = sum(size for size, _ in self.index.values())
+
+    @staticmethod
+    def key(url):
+        """
+        :param url: a url address.
+        :return: the cache key (file name without extension) of the url.
+        """
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def paths(self, key):
+        """
+        :param key: a cache key.
+        :return: the paths of the body and the metadata files of the key.
+        """
+        base = os.path.join(self.directory, key)
+        return base + '.gz', base + '.json'
+
+    def read_meta(self, url):
+        """
+        :param url: a url address.
+        :return: the stored metadata of the url, or None if it isn't cached.
+        """
+        key = self.key(url)
+        if key not in self.index:
+            return None
+        try:
+            with open(self.paths(key)[1], 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def conditional_headers(self, url):
+        """
+        Returns the request headers for revalidating a cached url.
+        :param url: a url address.
+        :return: a dictionary with If-None-Match and/or If-Modified-Since, empty if the url isn't cached.
+        """
+        meta = self.read_meta(url)
+        headers = {}
+        if meta is not None:
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return headers
+
+    def load(self, url):
+        """
+        Returns the cached page of a url and marks it as recently used.
+        :param url: a url address.
+        :return: the page text, or None if it isn't cached.
+        """
+        meta = self.read_meta(url)
+        if meta is None:
+            return None
+        key = self.key(url)
+        body_path = self.paths(key)[0]
+        try:
+            with gzip.open(body_path, 'rb') as file:
+                content = file.read()
+        except OSError:
+            return None
+        now = time.time()
+        with self.lock:
+            if key in self.index:
+                self.index[key][1] = now
+        os.utime(body_path, (now, now))
+        return content.decode(meta.get('encoding') or 'utf-8', errors='replace')
+
+    def store(self, url, response):
+        """
+        Stores a response in the cache if it has validators, then evicts pages over the size limit.
+        :param url: the url address of the response.
+        :param response: a requests response with status OK.
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if etag is None and last_modified is None:
+            return
+        key = self.key(url)
+        body_path, meta_path = self.paths(key)
+        body = gzip.compress(response.content)
+        meta = {'url': url, 'etag': etag, 'last_modified': last_modified,
+                'encoding': response.encoding, 'stored_at': time.time()}
+        with open(body_path + '.tmp', 'wb') as file:
+            file.write(body)
+        os.replace(body_path + '.tmp', body_path)
+        with open(meta_path, 'w') as file:
+            json.dump(meta, file)
+        with self.lock:
+            if key in self.index:
+                self.size -= self.index[key][0]
+            self.index[key] = [len(body), time.time()]
+            self.size += len(body)
+            self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used pages until the cache is under its size limit.
+        Must be called while holding the lock.
+        """
+        if self.size <= self.max_bytes:
+            return
+        for key in sorted(self.index, key=lambda k: self.index[k][1]):
+            if self.size <= self.max_bytes:
+                break
+            size, _ = self.index.pop(key)
+            self.size -= size
+            for path in self.paths(key):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
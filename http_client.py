@@ -0,0 +1,157 @@
+import time
+import threading
+import importlib.util
+import requests
+from urllib.parse import urlsplit
+from requests.adapters import HTTPAdapter
+from config import HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, RATE_LIMIT_INITIAL, RETRY_TIMES, \
+    RETRY_STATUSES
+from rate_limiter import RateLimiter, backoff_delay
+
+# Brotli is decoded by urllib3 only when the brotli package is installed
+ACCEPT_ENCODING = 'gzip, deflate, br' if importlib.util.find_spec('brotli') is not None else 'gzip, deflate'
+
+
+class HttpClient:
+    """
+    Class HttpClient. A shared HTTP client for the web scraper and the API queries.
+    It keeps one requests session with a pool of keep-alive connections per host, so pages from the same host
+    reuse their TCP+TLS connections, negotiates compressed responses and applies default timeouts.
+    Requests to each host go through an adaptive RateLimiter, and throttled or failed requests
+    (RETRY_STATUSES and connection errors) are retried with a jittered exponential backoff.
+    If the client has a PageArchive, responses are recorded to it, or, in replay mode, served from it
+    without network.
+    """
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, rate=RATE_LIMIT_INITIAL, retries=RETRY_TIMES, logger=None,
+                 archive=None):
+        self.timeout = (connect_timeout, read_timeout)
+        self.archive = archive
+        self.rate = rate
+        self.retries = retries
+        self.logger = logger
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({'Accept-Encoding': ACCEPT_ENCODING, 'Connection': 'keep-alive'})
+
+    def limiter(self, url):
+        """
+        :param url: a url address.
+        :return: the rate limiter of the url's host, created on first use.
+        """
+        host = urlsplit(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                self.limiters[host] = RateLimiter(rate=self.rate)
+            return self.limiters[host]
+
+    def request(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session, after waiting for the host's rate limiter.
+        Throttled and failed requests are retried up to `retries` times. A Retry-After header (in seconds)
+        is respected when it is longer than the backoff.
+        :param method: the HTTP method, e.g. 'GET'.
+        :param url: the url to request.
+        :param kwargs: optional arguments for requests (headers, params, timeout...).
+        :return: the response. the last response is returned if all the retries were throttled.
+        """
+        if self.archive is not None:
+            archive_url = self.archive.full_url(method, url, kwargs.get('params'))
+            if self.archive.mode == 'replay':
+                return self.archive.replay(archive_url)
+            response = self.send(method, url, **kwargs)
+            self.archive.record(archive_url, response)
+            return response
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        """
+        Sends a request through the pooled session with rate limiting and retries (see request).
+        :param method: the HTTP method, e.g. 'GET'.
+        :param url: the url to request.
+        :param kwargs: optional arguments for requests (headers, params, timeout...).
+        :return: the response.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        limiter = self.limiter(url)
+        for attempt in range(self.retries + 1):
+            limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                limiter.on_error(start)
+                if attempt == self.retries:
+                    raise
+                delay = backoff_delay(attempt)
+                self.log_retry(url, ex, delay)
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    limiter.on_success(time.monotonic() - start, start)
+                    return response
+                limiter.on_error(start)
+                if attempt == self.retries:
+                    return response
+                delay = backoff_delay(attempt)
+                retry_after = response.headers.get('Retry-After', '')
+                if retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+                self.log_retry(url, f'status {response.status_code}', delay)
+            time.sleep(delay)
+
+    def log_retry(self, url, reason, delay):
+        """
+        Logs a retry of a request, if the client has a logger.
+        :param url: the url address of the request.
+        :param reason: the reason of the retry (an exception or a status).
+        :param delay: the delay before the retry, in seconds.
+        """
+        if self.logger is not None:
+            self.logger.warning(f'{url} failed ({reason}), retrying in {delay:.1f} seconds')
+
+    def get(self, url, **kwargs):
+        """
+        Sends a GET request through the pooled session.
+        :param url: the url to request.
+        :param kwargs: optional arguments for requests (headers, params, timeout...).
+        :return: the response.
+        """
+        return self.request('GET', url, **kwargs)
+
+    def close(self):
+        """
+        Closes all the pooled connections and the archive.
+        """
+        self.session.close()
+        if self.archive is not None:
+            self.archive.close()
+
+
+_default_client = None
+_default_client_lock = threading.Lock()
+
+
+def get_default_client():
+    """
+    Returns the process wide HTTP client, creating it on first use.
+    :return: the shared HttpClient.
+    """
+    global _default_client
+    with _default_client_lock:
+        if _default_client is None:
+            _default_client = HttpClient()
+        return _default_client
+
+
+def set_default_client(client):
+    """
+    Sets the process wide HTTP client, so every caller that isn't given a client shares it.
+    :param client: an HttpClient.
+    """
+    global _default_client
+    with _default_client_lock:
+        _default_client = client
@@ -0,0 +1,290 @@
+"""
+A durable job queue of the country history pages, for sharding the history collection across worker processes
+(see main's --coordinator and --worker). The queue is a local SQLite file, no broker is needed: the coordinator
+queues a job per country every cycle, and every worker leases a batch of jobs, fetches, parses and writes their
+history, and marks them done. A job whose lease expired (its worker died or hangs) is leased again by another
+worker, up to JOB_MAX_ATTEMPTS times.
+Workers on other hosts need the queue file on a shared filesystem with working file locks (e.g. NFS with its lock
+manager), and the MySQL backend. The queue uses SQLite's rollback journal, since WAL mode needs all the processes
+on one host.
+"""
+import os
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from datetime import date
+from config import JOB_LEASE_SECONDS, JOB_LEASE_BATCH, JOB_MAX_ATTEMPTS, JOB_POLL_SECONDS, JOB_WAIT_SECONDS, \
+    INSERT_CHUNK_SIZE, COUNTRIES_NAMES_TO_CODES, HISTORY_STORE_MAX_DEAD_RATIO
+from creating_db_scraper_api import appending_history_info, query_last_history_dates
+from metrics import JOBS
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, cycle TEXT NOT NULL, country TEXT NOT NULL, '
+    'link TEXT NOT NULL, status TEXT NOT NULL DEFAULT \'pending\', attempts INTEGER NOT NULL DEFAULT 0, '
+    'worker TEXT, lease_until REAL, first_date TEXT, error TEXT, UNIQUE (cycle, country))',
+    'CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, lease_until)',
+]
+
+
+def worker_name():
+    """
+    :return: a name of the current process that is unique across hosts, for the leases.
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class JobQueue:
+    """
+    Class JobQueue. The jobs of the history pages in a SQLite file. A job is pending, leased, done or failed.
+    Leasing is one immediate transaction, so concurrent workers never lease the same job, and a worker can only
+    finish the jobs it still holds the lease of. The file uses the rollback journal (not WAL, whose shared memory
+    index does not work over a network filesystem), so workers on other hosts can share it.
+    """
+    def __init__(self, path, max_attempts=JOB_MAX_ATTEMPTS):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.cycle = None
+        self.connection = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=DELETE')
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def enqueue(self, country_link_dict):
+        """
+        Queues a job for every country of a new cycle. The unfinished jobs of the earlier cycles are dropped,
+        since the new cycle fetches the same pages again.
+        :param country_link_dict: a dictionary with a URL link for each country to its webpage.
+        :return: the id of the cycle.
+        """
+        cycle = uuid.uuid4().hex
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.connection.execute('DELETE FROM jobs WHERE cycle != ?', (cycle,))
+            self.connection.executemany('INSERT OR IGNORE INTO jobs (cycle, country, link) VALUES (?, ?, ?)',
+                                        [(cycle, country, link) for country, link in country_link_dict.items()])
+        self.cycle = cycle
+        return cycle
+
+    def expire_leases(self, now):
+        """
+        Releases the jobs whose lease expired, to be leased again, or fails them if they ran out of attempts.
+        It runs in the caller's transaction.
+        :param now: the current time (see time.time).
+        """
+        failed = self.connection.execute(
+            'UPDATE jobs SET status = \'failed\', error = \'lease expired\' '
+            'WHERE status = \'leased\' AND lease_until < ? AND attempts >= ?', (now, self.max_attempts)).rowcount
+        retried = self.connection.execute(
+            'UPDATE jobs SET status = \'pending\', worker = NULL, lease_until = NULL, error = \'lease expired\' '
+            'WHERE status = \'leased\' AND lease_until < ? AND attempts < ?', (now, self.max_attempts)).rowcount
+        if failed:
+            JOBS.inc(failed, status='failed')
+        if retried:
+            JOBS.inc(retried, status='retried')
+
+    def lease(self, worker, count=JOB_LEASE_BATCH, lease_seconds=JOB_LEASE_SECONDS):
+        """
+        Leases pending jobs, after releasing the jobs whose lease expired (see expire_leases).
+        :param worker: the name of the worker (see worker_name).
+        :param count: the maximal number of jobs to lease.
+        :param lease_seconds: the seconds until the lease expires.
+        :return: a list of (id, country, link) tuples.
+        """
+        now = time.time()
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.expire_leases(now)
+            jobs = self.connection.execute(
+                'SELECT id, country, link FROM jobs WHERE status = \'pending\' ORDER BY id LIMIT ?',
+                (count,)).fetchall()
+            self.connection.executemany(
+                'UPDATE jobs SET status = \'leased\', worker = ?, lease_until = ?, attempts = attempts + 1 '
+                'WHERE id = ?', [(worker, now + lease_seconds, job[0]) for job in jobs])
+        return jobs
+
+    def complete(self, worker, jobs, affected):
+        """
+        Marks leased jobs done, with the first written date of their countries (for the coordinator's rollups).
+        :param worker: the name of the worker that holds the leases.
+        :param jobs: a list of (id, country code) pairs.
+        :param affected: a dictionary with the first written date of every written country.
+        :return: the number of jobs that were still leased by the worker.
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            done = sum(self.connection.execute(
+                'UPDATE jobs SET status = \'done\', first_date = ?, lease_until = NULL '
+                'WHERE id = ? AND worker = ? AND status = \'leased\'',
+                (affected[code].isoformat() if code in affected else None, job_id, worker)).rowcount
+                for job_id, code in jobs)
+        JOBS.inc(done, status='done')
+        return done
+
+    def fail(self, worker, job_ids, error):
+        """
+        Releases leased jobs after an error, to be leased again, or fails them if they ran out of attempts.
+        :param worker: the name of the worker that holds the leases.
+        :param job_ids: the ids of the jobs.
+        :param error: the error message.
+        """
+        counts = {}
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            for status, condition in [('failed', 'attempts >= ?'), ('pending', 'attempts < ?')]:
+                counts[status] = sum(self.connection.execute(
+                    f'UPDATE jobs SET status = \'{status}\', worker = NULL, lease_until = NULL, error = ? '
+                    f'WHERE id = ? AND worker = ? AND status = \'leased\' AND {condition}',
+                    (error, job_id, worker, self.max_attempts)).rowcount for job_id in job_ids)
+        if counts['failed']:
+            JOBS.inc(counts['failed'], status='failed')
+        if counts['pending']:
+            JOBS.inc(counts['pending'], status='retried')
+
+    def counts(self, cycle=None):
+        """
+        :param cycle: the id of the cycle (default: the last enqueued cycle).
+        :return: a dictionary with the number of jobs per status.
+        """
+        rows = self.connection.execute('SELECT status, COUNT(*) FROM jobs WHERE cycle = ? GROUP BY status',
+                                       (cycle or self.cycle,))
+        return dict(rows.fetchall())
+
+    def results(self, cycle=None):
+        """
+        :param cycle: the id of the cycle (default: the last enqueued cycle).
+        :return: a dictionary with the first written date of every country code the workers wrote (see
+        refreshing_rollups), and the list of the countries whose jobs failed.
+        """
+        rows = self.connection.execute('SELECT country, status, first_date FROM jobs WHERE cycle = ? AND '
+                                       'status IN (\'done\', \'failed\')', (cycle or self.cycle,)).fetchall()
+        affected = {COUNTRIES_NAMES_TO_CODES[country]: date.fromisoformat(first_date)
+                    for country, status, first_date in rows
+                    if status == 'done' and first_date is not None}
+        return affected, [country for country, status, _ in rows if status == 'failed']
+
+    def unfinished(self, cycle=None):
+        """
+        :param cycle: the id of the cycle (default: the last enqueued cycle).
+        :return: the list of the countries whose jobs are still pending or leased.
+        """
+        rows = self.connection.execute('SELECT country FROM jobs WHERE cycle = ? AND '
+                                       'status IN (\'pending\', \'leased\')', (cycle or self.cycle,))
+        return [country for country, in rows.fetchall()]
+
+    def check(self):
+        """
+        Releases the expired leases (see expire_leases), so the jobs of dead workers are retried or failed even
+        when no worker leases jobs.
+        :return: the number of jobs per status of the last enqueued cycle (see counts).
+        """
+        with self.connection:
+            self.connection.execute('BEGIN IMMEDIATE')
+            self.expire_leases(time.time())
+        return self.counts()
+
+    def wait(self, logger=None, poll_seconds=JOB_POLL_SECONDS, timeout=JOB_WAIT_SECONDS):
+        """
+        Waits until every job of the last enqueued cycle is done or failed, or until the timeout, checking the
+        queue every poll_seconds (see check).
+        :param logger: optional, logs the progress whenever it changes.
+        :param poll_seconds: the seconds between progress checks.
+        :param timeout: the maximal seconds to wait.
+        :return: the results of the cycle (see results), and the list of the countries that were not finished
+        before the timeout.
+        """
+        deadline = time.time() + timeout
+        progress = None
+        while True:
+            counts = self.check()
+            if counts != progress and logger is not None:
+                logger.info(f'History jobs: {counts}')
+            progress = counts
+            if not counts.get('pending') and not counts.get('leased'):
+                return (*self.results(), [])
+            if time.time() >= deadline:
+                unfinished = self.unfinished()
+                if logger is not None:
+                    logger.warning(f'Stopped waiting for the history jobs of {len(unfinished)} countries '
+                                   f'after {timeout} seconds')
+                return (*self.results(), unfinished)
+            time.sleep(min(poll_seconds, max(deadline - time.time(), 0)))
+
+    def close(self):
+        """
+        Closes the queue file.
+        """
+        self.connection.close()
+
+
+class HistoryWorker:
+    """
+    Class HistoryWorker. Runs the history jobs of a queue: leases a batch, fetches and parses the pages with the
+    fetch workers of the Coronavirus object, appends the new days of the batch in one transaction and marks the
+    jobs done. A country whose page failed is released to be retried on its own, and a failed write releases
+    the whole batch. The watermarks are queried again for every batch, since
+    other workers write the countries between the cycles.
+    """
+    def __init__(self, jobs, cv, engine, history_table, logger, chunk_size=INSERT_CHUNK_SIZE, history_store=None,
+                 name=None, batch=JOB_LEASE_BATCH, lease_seconds=JOB_LEASE_SECONDS):
+        self.jobs = jobs
+        self.cv = cv
+        self.engine = engine
+        self.history_table = history_table
+        self.logger = logger
+        self.chunk_size = chunk_size
+        self.history_store = history_store
+        self.name = name or worker_name()
+        # Lease enough jobs to keep all the fetch workers busy
+        self.batch = max(batch, 2 * cv.workers)
+        self.lease_seconds = lease_seconds
+
+    def run_batch(self, connection):
+        """
+        Leases and runs one batch of jobs.
+        :param connection: the direct connection to the relevant database.
+        :return: the number of leased jobs.
+        """
+        leased = self.jobs.lease(self.name, self.batch, self.lease_seconds)
+        if not leased:
+            return 0
+        country_link_dict = {country: link for _, country, link in leased}
+        errors = {}
+        history = dict(self.cv.iter_countries_history(list(country_link_dict), country_link_dict, errors))
+        for country, ex in errors.items():
+            self.logger.error(f'{self.name} failed the history job of {country}: {ex}')
+            self.jobs.fail(self.name, [job_id for job_id, name, _ in leased if name == country], str(ex))
+        written = [(job_id, country) for job_id, country, _ in leased if country in history]
+        if not written:
+            return len(leased)
+        try:
+            affected = {}
+            with connection.begin():
+                watermarks = query_last_history_dates(connection, self.history_table)
+                appended = appending_history_info(history, self.history_table, connection, watermarks,
+                                                  self.chunk_size, affected)
+            if self.history_store is not None:
+                self.history_store.store_history(history)
+                if self.history_store.dead_ratio() > HISTORY_STORE_MAX_DEAD_RATIO:
+                    self.history_store.compact()
+        except Exception as ex:
+            self.logger.error(f'{self.name} failed {len(written)} history jobs: {ex}')
+            self.jobs.fail(self.name, [job_id for job_id, _ in written], str(ex))
+            return len(leased)
+        done = self.jobs.complete(self.name, [(job_id, COUNTRIES_NAMES_TO_CODES.get(country))
+                                              for job_id, country in written], affected)
+        self.logger.info(f'{self.name} wrote {appended} history rows of {done} countries')
+        return len(leased)
+
+    def run(self, stopped=None):
+        """
+        Runs batches until stopped, waiting JOB_POLL_SECONDS whenever the queue has no jobs to lease.
+        :param stopped: optional, a threading.Event that stops the worker after the current batch.
+        """
+        stopped = stopped or threading.Event()
+        self.logger.info(f'{self.name} is running the history jobs of {self.jobs.path}')
+        with self.engine.connect() as connection:
+            while not stopped.is_set():
+                if not self.run_batch(connection):
+                    stopped.wait(JOB_POLL_SECONDS)
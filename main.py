@@ -2,10 +2,20 @@ from coronavirus import Coronavirus
 from API_data_parsing import *
 from creating_db_scraper_api import *
 from config import *
-from datetime import datetime
+from http_client import HttpClient, set_default_client
+from http_cache import HttpCache
+from archive import PageArchive
+from history_store import HistoryStore
+from rollups import refreshing_rollups
+from query_api import QueryCache, start_query_server
+from pipeline import CycleWriter
+from job_queue import JobQueue, HistoryWorker
+from scheduler import Scheduler, POLICIES, parse_schedule
+from metrics import CYCLE_SECONDS, CYCLES, start_metrics_server
+from sqlalchemy.exc import SQLAlchemyError
 import argparse
-import time
 import sys
+import time
 import logging
 
 
@@ -37,21 +47,6 @@ def set_logger(log_name='logger.log', level=logging.INFO):
     return logger
 
 
-def refresh_data(update_time_list):
-    """
-    Function refresh_data
-    This function receives a list of different time strings in the format of %H:%M:%S and returens True/False if
-    the current time matches one of the items (time string) in the list.
-    :param update_time_list: receives a list of different time strings (%H:%M:%S)
-    :return: True or false if the current time is in the list
-    """
-    current_time = str(datetime.now().strftime("%H:%M:%S"))
-    for time_element in update_time_list:
-        if time_element == current_time:
-            return True
-    return False
-
-
 def get_update_times_list(filename):
     """
     This function receives a file containing update times and returns a list of those times.
@@ -87,11 +82,59 @@ def get_parser():
     """
     parser = argparse.ArgumentParser(description='Data Mining Project.')
     parser.add_argument('--times', metavar='times.txt', type=str,
-                        help='A file containing update times in the format 00:00:00.')
+                        help='A file containing update times in the format 00:00:00, intervals (@every 15m) or '
+                             'cron expressions (*/15 * * * *), one per line.')
+    parser.add_argument('--schedule', metavar='TABLE=SCHEDULE', action='append', default=[],
+                        help='A schedule of one table (world, countries, history or api), e.g. "countries=@every 15m". '
+                             'can be repeated. with schedules, every table is refreshed on its own, '
+                             'instead of --table on the update times.')
+    parser.add_argument('--missed', choices=POLICIES, default=SCHEDULE_POLICY,
+                        help=f'what to do with scheduled cycles that were missed while a cycle was running: run them '
+                             f'once (coalesce) or each of them (catch-up) (default: {SCHEDULE_POLICY})')
     parser.add_argument('--countries', metavar='countries.txt', type=str,
                         help='A file containing names of countries.')
     parser.add_argument('--table', choices=['world', 'countries', 'history', 'api', 'all'],
                         default='all', help='table choice for scraping (default: all)')
+    parser.add_argument('--workers', metavar='N', type=int, default=FETCH_WORKERS,
+                        help=f'number of country pages to fetch in parallel (default: {FETCH_WORKERS})')
+    parser.add_argument('--timeout', metavar='SECONDS', type=float, default=HTTP_READ_TIMEOUT,
+                        help=f'HTTP read timeout in seconds (default: {HTTP_READ_TIMEOUT})')
+    parser.add_argument('--rate', metavar='N', type=float, default=RATE_LIMIT_INITIAL,
+                        help=f'initial requests per second per host, adapted to the server (default: {RATE_LIMIT_INITIAL})')
+    parser.add_argument('--retries', metavar='N', type=int, default=RETRY_TIMES,
+                        help=f'number of retries for a failed request (default: {RETRY_TIMES})')
+    parser.add_argument('--cache', metavar='DIR', type=str,
+                        help='A directory for caching fetched pages and revalidating them on refresh.')
+    parser.add_argument('--chunk-size', metavar='ROWS', type=int, default=INSERT_CHUNK_SIZE,
+                        help=f'maximal number of rows in one database statement (default: {INSERT_CHUNK_SIZE})')
+    parser.add_argument('--transaction-size', metavar='ROWS', type=int, default=TRANSACTION_CHUNK_SIZE,
+                        help=f'maximal number of rows in one transaction of the first full history load '
+                             f'(default: {TRANSACTION_CHUNK_SIZE})')
+    parser.add_argument('--backend', choices=['mysql', 'sqlite'], default='mysql',
+                        help='database backend (default: mysql)')
+    parser.add_argument('--sqlite-path', metavar='corona.db', type=str, default=SQLITE_PATH,
+                        help=f'the SQLite database file of the sqlite backend (default: {SQLITE_PATH})')
+    parser.add_argument('--sync', action='store_true',
+                        help='copy the SQLite database into the MySQL server in bulk, and exit.')
+    parser.add_argument('--metrics-port', metavar='PORT', type=int,
+                        help='A local port for serving the cycle metrics at /metrics (Prometheus text format).')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='write the scraped data into the database while the next pages are still fetched.')
+    parser.add_argument('--api-port', metavar='PORT', type=int,
+                        help='A local port for serving the read-only query API over the scraped data.')
+    parser.add_argument('--history-store', metavar='DIR', type=str,
+                        help='A directory for also keeping the history in a compact, compressed store.')
+    shard = parser.add_mutually_exclusive_group()
+    shard.add_argument('--coordinator', metavar='QUEUE', type=str,
+                       help='Queue the history pages of every cycle as jobs in a queue file, for --worker processes '
+                            'to fetch and write.')
+    shard.add_argument('--worker', metavar='QUEUE', type=str,
+                       help='Run the history jobs of a --coordinator queue file, instead of the refresh cycles.')
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--record', metavar='DIR', type=str,
+                         help='A directory for recording every fetched page into an archive.')
+    archive.add_argument('--replay', metavar='DIR', type=str,
+                         help='A directory of a recorded archive to replay the pages from, without network.')
     return parser
 
 
@@ -112,8 +155,35 @@ def handle_args(args):
         countries_fetch_list = get_countries_list(vars(args)['countries'])
 
     table = vars(args)['table']
+    workers = vars(args)['workers']
+    cache_dir = vars(args)['cache']
+    if vars(args)['record'] is not None:
+        archive = PageArchive(vars(args)['record'], 'record')
+    elif vars(args)['replay'] is not None:
+        archive = PageArchive(vars(args)['replay'], 'replay')
+    else:
+        archive = None
+    http_options = {'read_timeout': vars(args)['timeout'], 'rate': vars(args)['rate'],
+                    'retries': vars(args)['retries'], 'archive': archive}
 
-    return update_times_list, countries_fetch_list, table
+    return update_times_list, countries_fetch_list, table, workers, http_options, cache_dir
+
+
+def get_table_schedules(specs):
+    """
+    This function receives TABLE=SCHEDULE strings and returns the schedules of every table.
+    :param specs: a list of strings, e.g. ['countries=@every 15m', 'history=@daily'].
+    :return: a dictionary with a list of schedules per table, in the order of SCHEDULED_TABLES.
+    """
+    table_schedules = {}
+    for spec in specs:
+        name, separator, schedule = spec.partition('=')
+        name = name.strip()
+        if not separator or name not in SCHEDULED_TABLES:
+            raise ValueError(f'A schedule must be TABLE=SCHEDULE, with a table of '
+                             f'{", ".join(SCHEDULED_TABLES)}: {spec}')
+        table_schedules.setdefault(name, []).append(schedule.strip())
+    return {name: table_schedules[name] for name in SCHEDULED_TABLES if name in table_schedules}
 
 
 def set_connection_mysql(user, pwd, host):
@@ -129,14 +199,26 @@ def set_connection_mysql(user, pwd, host):
     return connection, engine
 
 
+def set_connection_sqlite(path):
+    """
+    This function creates an engine and connects to an embedded SQLite database file.
+    :param path: the path of the database file.
+    :return: the engine and the connection.
+    """
+    engine = make_sqlite_engine(path)
+    connection = create_connection(engine)
+    return connection, engine
+
+
 def create_tables(engine):
     """
-    This function create or use the tables in the database
+    This function create or use the tables in the database, once per process, through the schema registry.
     :param engine: the engine.
     :return: countries and history tables and a boolean variables if they were created (true) or not.
     """
-    countries, table_countries_created = create_or_use(engine, 'countries')
-    history, table_history_created = create_or_use(engine, 'history')
+    registry = get_registry(engine)
+    countries, table_countries_created = registry.table('countries')
+    history, table_history_created = registry.table('history')
     return countries, table_countries_created, history, table_history_created
 
 
@@ -152,74 +234,267 @@ def main():
     # Parse arguments
     parser = get_parser()
     args = parser.parse_args()
+    if args.cache is not None and (args.record is not None or args.replay is not None):
+        parser.error('--cache can not be used with --record or --replay')
+    if args.worker is not None and args.history_store is not None and not HistoryStore.SHARED:
+        parser.error('--history-store can not be shared by --worker processes without fcntl')
+
+    # Copy the SQLite database of an edge collector into the central MySQL
+    if args.sync:
+        connection, engine = set_connection_mysql(USER_NAME, PASSWORD, HOST)
+        countries_synced, history_synced = syncing_databases(make_sqlite_engine(args.sqlite_path), engine,
+                                                             args.chunk_size, args.transaction_size)
+        logger.info(f'{args.sqlite_path} was synced into MySQL: {countries_synced} countries rows, '
+                    f'{history_synced} history rows')
+        return
 
     # create lists from files - times and countries
-    update_times_list, countries_fetch_list, table = handle_args(args)
-    logger.info(f'times={update_times_list}. countries={countries_fetch_list}')
+    update_times_list, countries_fetch_list, table, workers, http_options, cache_dir = handle_args(args)
+    try:
+        table_schedules = get_table_schedules(args.schedule) if args.schedule else TABLE_SCHEDULES
+        for schedules in list(table_schedules.values()) + [update_times_list]:
+            for schedule in schedules:
+                parse_schedule(schedule)
+    except ValueError as ex:
+        parser.error(str(ex))
+    logger.info(f'times={update_times_list}. countries={countries_fetch_list}. workers={workers}')
+
+    # Serve the metrics if asked
+    if args.metrics_port is not None:
+        start_metrics_server(args.metrics_port)
+        logger.info(f'Serving metrics at http://{METRICS_HOST}:{args.metrics_port}/metrics')
+
+    # Create the shared HTTP client, with enough pooled connections for all the workers
+    client = HttpClient(pool_size=max(workers, HTTP_POOL_SIZE), logger=logger, **http_options)
+    set_default_client(client)
+
+    # Create the on-disk pages cache if asked
+    cache = HttpCache(cache_dir) if cache_dir is not None else None
+
+    # Create the compact history store if asked
+    history_store = HistoryStore(args.history_store) if args.history_store is not None else None
 
     # Create a coronavirues instance
-    cv = Coronavirus(URL, logger)
+    cv = Coronavirus(URL, logger, workers, client, cache)
     logger.info(f'Created Coronavirus object')
 
-    # Create engine and connect to a MySQL server
-    connection, engine = set_connection_mysql(USER_NAME, PASSWORD, HOST)
-    logger.info(f'Connection to MySQL was established')
+    # Create engine and connect to a MySQL server, or to the embedded SQLite database
+    if args.backend == 'sqlite':
+        connection, engine = set_connection_sqlite(args.sqlite_path)
+        logger.info(f'Connection to SQLite database {args.sqlite_path} was established')
+    else:
+        connection, engine = set_connection_mysql(USER_NAME, PASSWORD, HOST)
+        logger.info(f'Connection to MySQL was established')
 
-    # Create or use countries and history tables in the MySQL server
+    # Create or use countries and history tables in the database
     countries, table_countries_created, history, table_history_created = create_tables(engine)
     if table_countries_created:
         logger.info(f'countries table was created')
     if table_history_created:
         logger.info(f'history table was created')
 
-    # A loop that parse the data for the first time and every update time
-    data_fetched = False
-    while True:
-        # Check for update time if it's time to refresh data or if the code is running for the first time
-        if refresh_data(update_times_list) or not data_fetched:
-
-            # Starting fetching data with the web scraper
-            logger.info(f'Started web scraping')
-            cv.web_scraper(table, countries_fetch_list)
-            data_fetched = True
-            logger.info(f'Finished web scraping')
-
-            # Starting fetching API data with api query
+    # Run the history jobs of a coordinator's queue, instead of the refresh cycles
+    if args.worker is not None:
+        HistoryWorker(JobQueue(args.worker), cv, engine, history, logger, args.chunk_size, history_store).run()
+        return
+    jobs = JobQueue(args.coordinator) if args.coordinator is not None else None
+
+    # Serve the query API if asked, its cache is invalidated at the end of every cycle
+    query_cache = QueryCache()
+    if args.api_port is not None:
+        start_query_server(engine, query_cache, args.api_port)
+        logger.info(f'Serving the query API at http://{QUERY_API_HOST}:{args.api_port}/')
+
+    # The last stored history date of every country, kept up to date between cycles
+    history_watermarks = query_last_history_dates(connection, history)
+
+    # The previous countries snapshot, kept up to date between cycles, and the last transmission types
+    countries_snapshot = query_countries_snapshot(connection, countries)
+    transmission = {}
+
+    # The time the coordinator stops waiting for the history jobs of the last queued cycle, None once collected
+    jobs_deadline = None
+
+    def collect_jobs(force=False):
+        """
+        Collects the history jobs of the last queued cycle once the workers finished them, or JOB_WAIT_SECONDS
+        after they were queued, and updates the rollups of the days they wrote. It runs as its own scheduled job,
+        so the cycles of the other tables don't wait for the workers.
+        :param force: collect the jobs even if some are not finished, e.g. before the next cycle is queued.
+        """
+        nonlocal history_watermarks, jobs_deadline
+        if jobs_deadline is None:
+            return
+        counts = jobs.check()
+        if (counts.get('pending') or counts.get('leased')) and not force and time.time() < jobs_deadline:
+            logger.info(f'History jobs: {counts}')
+            return
+        jobs_deadline = None
+        affected, failed = jobs.results()
+        unfinished = jobs.unfinished()
+        if failed:
+            logger.error(f'The history jobs of {len(failed)} countries failed: {failed}')
+        if unfinished:
+            logger.error(f'The history jobs of {len(unfinished)} countries were not finished: {unfinished}')
+        try:
+            with connection.begin():
+                rolled = refreshing_rollups(connection, history, countries, affected, args.chunk_size)
+            logger.info(f'{rolled} rollup rows were updated')
+        except SQLAlchemyError as ex:
+            logger.error(f'{ERR_MSG_DB} {ex}')
+        history_watermarks = query_last_history_dates(connection, history)
+        query_cache.invalidate()
+
+    def refresh_cycle(table):
+        """
+        One refresh cycle of a table: scrapes only what the table needs ('all' for everything), writes it into the
+        database and invalidates the query API cache. The in-memory state of the database is kept between cycles.
+        :param table: the table to refresh: 'world', 'countries', 'history', 'api' or 'all'.
+        """
+        nonlocal table_countries_created, table_history_created, countries_snapshot, history_watermarks, transmission, \
+            jobs_deadline
+        scrape_countries = table == 'all' or table == 'countries'
+        scrape_history = table == 'all' or table == 'history'
+        # With a coordinator queue, the country pages are queued for the workers after the cycle is written
+        dispatched = []
+        dispatch = (lambda names, links: dispatched.append({name: links[name] for name in names})) \
+            if jobs is not None else None
+
+        with CYCLE_SECONDS.time(table=table):
+            # Starting fetching API data with api query. it is queried first, so the pipeline can write the countries
+            # as soon as the main page is parsed
             if table == 'all' or table == 'api':
-                transmission = api_query()
                 logger.info(f'Started API query')
+                transmission = api_query(client)
                 print(transmission)
                 logger.info(f'Finished API query')
 
-            # inserting into database
-            logger.info(f'Inserting countries info into table...')
-            if table_countries_created:
-                inserting_country_info(cv.get_countries(), countries, connection, transmission)
-                logger.info(f'countries table was created')
-            else:
-                # updating database countries:
-                for country_dict in cv.get_countries():
-                    country, update_data, country_code = cv.country_update(country_dict)
-                    update_country_info(countries, country_code, update_data, connection)
-                logger.info(f'countries table was updated')
-
-            # insert to history
-            if not table_history_created:
-                for country in countries_fetch_list:
-                    # Update country's history into database
-                    history_update(country, history, cv.get_history()[country],
-                                        connection, engine, countries)
+            if table == 'api':
+                # Without scraping, only the transmission types that changed are written
+                try:
+                    with connection.begin():
+                        changed = refreshing_transmission(countries, connection, countries_snapshot, transmission,
+                                                          args.chunk_size)
+                    logger.info(f'{changed} transmission types were updated')
+                except SQLAlchemyError as ex:
+                    logger.error(f'{ERR_MSG_DB} {ex}')
+                    countries_snapshot = query_countries_snapshot(connection, countries)
+
+            elif args.pipeline:
+                # Stream the scraped data into the database writer while the next pages are fetched. The cycle
+                # is one transaction, and the first full history load is written in size-bounded transactions
+                writer = CycleWriter(engine, countries, history, countries_snapshot, history_watermarks,
+                                     transmission, table_countries_created, args.chunk_size,
+                                     args.transaction_size if table_history_created else None)
+                writer.start()
+                logger.info(f'Started web scraping into the database writer')
+                try:
+                    try:
+                        cv.web_scraper(table, countries_fetch_list, writer.put, dispatch)
+                    except ValueError:
+                        # A failed scraping rolls the cycle back, unless the writer failed first
+                        writer.close(commit=False)
+                        raise
+                    written = writer.close()
+                    logger.info(f'Finished web scraping: {written["countries"]} countries rows, '
+                                f'{written["history"]} history rows and {written["rollups"]} rollup rows '
+                                f'were written')
+                    table_countries_created = writer.countries_created
+                    if scrape_history:
+                        table_history_created = False
+                except SQLAlchemyError as ex:
+                    # The transaction was rolled back, reload the in-memory state from the database
+                    logger.error(f'{ERR_MSG_DB} {ex}')
+                    countries_snapshot = query_countries_snapshot(connection, countries)
+                    history_watermarks = query_last_history_dates(connection, history)
             else:
-                # Insert country's history for the first time into database
-                logger.info(f'Inserting history data for the fetched countries into history table...')
-                inserting_history_info(cv.get_history(), history, connection, engine, countries)
-                logger.info(f'countries history was inserted into history table')
-
-            print('Next update/s will occur at:', update_times_list)
-
-        # interval of 1 second
-        time.sleep(1)
-
+                # Starting fetching data with the web scraper
+                logger.info(f'Started web scraping')
+                cv.web_scraper(table, countries_fetch_list, dispatch=dispatch)
+                logger.info(f'Finished web scraping')
+
+                # Writing the cycle into the database in one transaction, so a failed cycle is rolled back
+                # as a whole. The first full history load is written in size-bounded transactions instead
+                try:
+                    with connection.begin():
+                        # inserting into database
+                        if scrape_countries and table_countries_created:
+                            logger.info(f'Inserting countries info into table...')
+                            inserting_country_info(cv.get_countries(), countries, connection, transmission,
+                                                   args.chunk_size)
+                            logger.info(f'countries table was created')
+                        elif scrape_countries:
+                            # updating only the countries that changed since the previous snapshot
+                            changed, unchanged = refreshing_country_info(cv.get_countries(), countries, connection,
+                                                                         countries_snapshot, transmission,
+                                                                         args.chunk_size)
+                            logger.info(f'countries table was updated: {changed} changed, {unchanged} unchanged')
+
+                        # insert to history
+                        if scrape_history and not table_history_created:
+                            # Append only the days after each country's last stored date
+                            logger.info(f'Appending new history data into history table...')
+                            affected = {}
+                            appended = appending_history_info(cv.get_history(), history, connection,
+                                                              history_watermarks, args.chunk_size, affected)
+                            logger.info(f'{appended} history rows were appended')
+
+                            # Update the rollup tables for the days and countries of this cycle
+                            rolled = refreshing_rollups(connection, history, countries, affected, args.chunk_size)
+                            logger.info(f'{rolled} rollup rows were updated')
+                    if scrape_countries and table_countries_created:
+                        table_countries_created = False
+                        countries_snapshot = query_countries_snapshot(connection, countries)
+
+                    if scrape_history and table_history_created:
+                        # Insert country's history for the first time into database
+                        logger.info(f'Inserting history data for the fetched countries into history table...')
+                        inserting_history_info(cv.get_history(), history, connection, engine, countries,
+                                               args.chunk_size, args.transaction_size)
+                        table_history_created = False
+                        history_watermarks = query_last_history_dates(connection, history)
+                        logger.info(f'countries history was inserted into history table')
+
+                        # Build the rollup tables from all the history
+                        with connection.begin():
+                            rolled = refreshing_rollups(connection, history, countries, None, args.chunk_size)
+                        logger.info(f'{rolled} rollup rows were built')
+                except SQLAlchemyError as ex:
+                    # The transaction was rolled back, reload the in-memory state from the database
+                    logger.error(f'{ERR_MSG_DB} {ex}')
+                    countries_snapshot = query_countries_snapshot(connection, countries)
+                    history_watermarks = query_last_history_dates(connection, history)
+
+            if dispatched:
+                # The jobs are collected by collect_jobs, the jobs of the previous cycle are collected first, since
+                # queuing drops their unfinished jobs
+                collect_jobs(force=True)
+                jobs.enqueue(dispatched[0])
+                jobs_deadline = time.time() + JOB_WAIT_SECONDS
+                logger.info(f'{len(dispatched[0])} history jobs were queued in {jobs.path}')
+
+            if history_store is not None and scrape_history:
+                stored = history_store.store_history(cv.get_history())
+                logger.info(f'{stored} history days were written to the history store')
+                # Every cycle replaces the last block of the countries, drop the replaced blocks once they pile up
+                if history_store.dead_ratio() > HISTORY_STORE_MAX_DEAD_RATIO:
+                    history_store.compact()
+                    logger.info(f'The history store was compacted to {history_store.size()[1]} bytes')
+
+        query_cache.invalidate()
+        CYCLES.inc(table=table)
+
+    # Run a cycle for the first time, and then at every update time. With per-table schedules, every table has
+    # its own job, and each cycle fetches and writes only its table
+    scheduler = Scheduler(logger, args.missed)
+    if table_schedules:
+        for name, schedules in table_schedules.items():
+            scheduler.add(name, schedules, lambda name=name: refresh_cycle(name), run_now=True)
+    else:
+        scheduler.add('refresh', update_times_list, lambda: refresh_cycle(table), run_now=True)
+    if jobs is not None:
+        scheduler.add('history-jobs', [JOB_COLLECT_SCHEDULE], collect_jobs, policy='coalesce')
+    scheduler.run()
 
 if __name__ == '__main__':
     main()
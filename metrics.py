@@ -0,0 +1,196 @@
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_BUCKETS, METRICS_HOST
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def escape_label(value):
+    """
+    :param value: a label value.
+    :return: the value as a string, escaped for the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    """
+    :param labels: a tuple of (name, value) pairs.
+    :return: the labels in the Prometheus text format, e.g. '{page="main"}', or '' without labels.
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in labels) + '}'
+
+
+class Counter:
+    """
+    Class Counter. A thread safe Prometheus counter, with a value for every combination of labels.
+    """
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        """
+        Increments the counter of the given labels.
+        :param amount: the amount to add.
+        :param labels: the labels of the counter, e.g. table='history'.
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        """
+        :return: the counter in the Prometheus text format.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in self.values.items():
+                lines.append(f'{self.name}{format_labels(key)} {value}')
+        return '\n'.join(lines)
+
+
+class Histogram:
+    """
+    Class Histogram. A thread safe Prometheus histogram of durations in seconds,
+    with buckets, a sum and a count for every combination of labels.
+    """
+    def __init__(self, name, documentation, buckets=METRICS_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        """
+        Adds an observation to the histogram of the given labels.
+        :param value: the observed value (seconds).
+        :param labels: the labels of the histogram, e.g. page='main'.
+        """
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        A context manager that observes the duration of its block.
+        :param labels: the labels of the histogram.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        """
+        :return: the histogram in the Prometheus text format.
+        """
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, count) in self.values.items():
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{self.name}_bucket{format_labels(key + (("le", bound),))} {bucket_count}')
+                lines.append(f'{self.name}_bucket{format_labels(key + (("le", "+Inf"),))} {count}')
+                lines.append(f'{self.name}_sum{format_labels(key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(key)} {count}')
+        return '\n'.join(lines)
+
+
+# The metrics of the web scraper
+FETCH_SECONDS = Histogram('coronavirus_fetch_seconds', 'Time to fetch a page, per url.')
+PARSE_SECONDS = Histogram('coronavirus_parse_seconds', 'Time to parse a page, per page type.')
+API_SECONDS = Histogram('coronavirus_api_query_seconds', 'Time to query the transmission API.')
+DB_SECONDS = Histogram('coronavirus_db_seconds', 'Time of a database insert or update function, per function.')
+CYCLE_SECONDS = Histogram('coronavirus_cycle_seconds', 'Time of a whole refresh cycle.')
+FETCHES = Counter('coronavirus_fetches_total', 'Number of fetched pages, per status.')
+ROWS_WRITTEN = Counter('coronavirus_rows_written_total', 'Number of rows written to the database, per table.')
+CYCLES = Counter('coronavirus_cycles_total', 'Number of refresh cycles.')
+COUNTRIES_DIFF = Counter('coronavirus_countries_refreshed_total',
+                         'Number of countries compared with the previous snapshot, per state (changed or unchanged).')
+QUERY_REQUESTS = Counter('coronavirus_query_requests_total',
+                         'Number of query API requests, per endpoint and cache result (hit or miss).')
+SCHEDULE_LAG_SECONDS = Histogram('coronavirus_schedule_lag_seconds',
+                                 'Time between the deadline of a scheduled run and its start, per job.')
+SCHEDULE_MISSED = Counter('coronavirus_schedule_missed_total',
+                          'Number of scheduled runs that were coalesced or skipped, per job.')
+SCHEDULE_FAILED = Counter('coronavirus_schedule_failed_total',
+                          'Number of scheduled runs that raised an error, per job.')
+JOBS = Counter('coronavirus_history_jobs_total',
+               'Number of sharded history jobs, per state (done, retried after an error or an expired lease, '
+               'or failed).')
+METRICS = [FETCH_SECONDS, PARSE_SECONDS, API_SECONDS, DB_SECONDS, CYCLE_SECONDS, FETCHES, ROWS_WRITTEN, CYCLES,
+           COUNTRIES_DIFF, QUERY_REQUESTS, SCHEDULE_LAG_SECONDS, SCHEDULE_MISSED,
+           SCHEDULE_FAILED, JOBS]
+
+
+def timed(histogram, **labels):
+    """
+    A decorator that observes the duration of every call of a function in a histogram.
+    :param histogram: the histogram.
+    :param labels: the labels of the observations.
+    :return: the decorator.
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """
+    :return: all the metrics in the Prometheus text format.
+    """
+    return '\n'.join(metric.render() for metric in METRICS) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """
+    Class MetricsHandler. Serves the metrics on GET /metrics.
+    """
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are frequent, don't print them to the console
+        pass
+
+
+def start_metrics_server(port, host=METRICS_HOST):
+    """
+    Starts serving the metrics in a background thread.
+    :param port: the port of the metrics endpoint.
+    :param host: the host to listen on. only local connections by default.
+    :return: the server.
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,177 @@
+"""
+Versioned schema migrations. Every migration evolves an existing database in place, and the versions that were
+applied are kept in the schema_version table, so each migration runs once per database.
+"""
+from datetime import date, datetime
+from sqlalchemy import MetaData, Table, Column, Integer, String, DateTime, Index, inspect, select, text
+from config import HISTORY_UNIQUE_KEY, HISTORY_FIRST_YEAR, PARTITION_MONTHS_AHEAD
+
+SCHEMA_VERSION_TABLE = 'schema_version'
+
+
+def ensure_history_unique_key(engine, table_name='history'):
+    """
+    Adds the composite (country_id, date) unique key to a history table that was created without it.
+    Duplicate rows of a country and a date are removed first, keeping the earliest one.
+    :param engine: the engine connection.
+    :param table_name: the name of the history table.
+    :return: True if the key was added, False if it already existed.
+    """
+    inspector = inspect(engine)
+    keys = inspector.get_unique_constraints(table_name) + \
+        [index for index in inspector.get_indexes(table_name) if index['unique']]
+    if any(set(key['column_names']) == {'country_id', 'date'} for key in keys):
+        return False
+    # The inner query is wrapped in a derived table, since MySQL can't select from the table it deletes from
+    engine.execute(text(f'DELETE FROM {table_name} WHERE id NOT IN '
+                        f'(SELECT id FROM (SELECT MIN(id) AS id FROM {table_name} '
+                        f'GROUP BY country_id, date) AS keep_rows)'))
+    history_table = Table(table_name, MetaData(), autoload=True, autoload_with=engine)
+    Index(HISTORY_UNIQUE_KEY, history_table.c.country_id, history_table.c.date, unique=True).create(engine)
+    return True
+
+
+def next_month(month):
+    """
+    :param month: the first day of a month.
+    :return: the first day of the next month.
+    """
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def month_partitions(first_month, last_month):
+    """
+    :param first_month: the first day of the first month.
+    :param last_month: the first day of the last month.
+    :return: the MySQL definitions of monthly range partitions from the first month to the last one.
+    """
+    partitions = []
+    month = first_month
+    while month <= last_month:
+        partitions.append(f"PARTITION p{month:%Y%m} VALUES LESS THAN ('{next_month(month):%Y-%m-%d}')")
+        month = next_month(month)
+    return partitions
+
+
+def last_partition_month(engine, table_name='history'):
+    """
+    :param engine: the engine connection (MySQL).
+    :param table_name: the name of the partitioned table.
+    :return: the first day of the last monthly partition, or None if the table isn't partitioned by month.
+    """
+    names = engine.execute(text('SELECT PARTITION_NAME FROM information_schema.PARTITIONS '
+                                'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name '
+                                'AND PARTITION_NAME IS NOT NULL'), table_name=table_name).fetchall()
+    months = [datetime.strptime(name[1:], '%Y%m').date() for name, in names if name != 'pmax']
+    return max(months) if months else None
+
+
+def add_history_partitions(engine, months_ahead=PARTITION_MONTHS_AHEAD, table_name='history'):
+    """
+    Splits the catch-all partition of a partitioned history table, so there is a monthly partition up to
+    months_ahead months from now. Does nothing on databases without partitioning (SQLite).
+    :param engine: the engine connection.
+    :param months_ahead: the number of future months to keep partitions for.
+    :param table_name: the name of the history table.
+    :return: the number of added partitions.
+    """
+    if engine.dialect.name != 'mysql':
+        return 0
+    last_month = last_partition_month(engine, table_name)
+    if last_month is None:
+        return 0
+    until = date.today().replace(day=1)
+    for _ in range(months_ahead):
+        until = next_month(until)
+    partitions = month_partitions(next_month(last_month), until)
+    if partitions:
+        engine.execute(text(f'ALTER TABLE {table_name} REORGANIZE PARTITION pmax INTO '
+                            f'({", ".join(partitions)}, PARTITION pmax VALUES LESS THAN (MAXVALUE))'))
+    return len(partitions)
+
+
+def partition_history_by_month(engine, table_name='history'):
+    """
+    Range partitions the history table by month on MySQL, so per-country date range reads only open the
+    partitions of the range. MySQL requires the partitioning column in every unique key, so the primary key
+    becomes (id, date) and rows without a date are removed. Does nothing on SQLite.
+    :param engine: the engine connection.
+    :param table_name: the name of the history table.
+    """
+    if engine.dialect.name != 'mysql':
+        return
+    first_date = engine.execute(text(f'SELECT MIN(date) FROM {table_name}')).scalar()
+    first_month = (first_date or date(HISTORY_FIRST_YEAR, 1, 1)).replace(day=1)
+    until = date.today().replace(day=1)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+        until = next_month(until)
+    engine.execute(text(f'DELETE FROM {table_name} WHERE date IS NULL'))
+    engine.execute(text(f'ALTER TABLE {table_name} MODIFY date DATE NOT NULL, '
+                        f'DROP PRIMARY KEY, ADD PRIMARY KEY (id, date)'))
+    engine.execute(text(f'ALTER TABLE {table_name} PARTITION BY RANGE COLUMNS(date) '
+                        f'({", ".join(month_partitions(first_month, until))}, '
+                        f'PARTITION pmax VALUES LESS THAN (MAXVALUE))'))
+
+
+def add_countries_continent(engine, table_name='countries'):
+    """
+    Adds the continent column to a countries table that was created without it.
+    :param engine: the engine connection.
+    :param table_name: the name of the countries table.
+    """
+    if 'continent' not in [column['name'] for column in inspect(engine).get_columns(table_name)]:
+        engine.execute(text(f'ALTER TABLE {table_name} ADD COLUMN continent VARCHAR(50)'))
+
+
+# The migrations, in order: (version, description, function of the engine)
+MIGRATIONS = [
+    (1, 'composite (country_id, date) unique key on history', ensure_history_unique_key),
+    (2, 'monthly range partitioning of history', partition_history_by_month),
+    (3, 'continent column on countries', add_countries_continent),
+]
+
+
+def schema_version_table(engine):
+    """
+    Returns the schema_version table, creating it if it doesn't exist.
+    :param engine: the engine connection.
+    :return: the table.
+    """
+    metadata = MetaData()
+    table = Table(SCHEMA_VERSION_TABLE, metadata,
+                  Column('version', Integer, primary_key=True, autoincrement=False),
+                  Column('description', String(255)), Column('applied_at', DateTime))
+    metadata.create_all(engine)
+    return table
+
+
+def current_version(engine):
+    """
+    :param engine: the engine connection.
+    :return: the last applied migration version of the database (0 if none).
+    """
+    table = schema_version_table(engine)
+    return max([row[0] for row in engine.execute(select([table.c.version]))], default=0)
+
+
+def migrate(engine, logger=None):
+    """
+    Applies the pending migrations of a database, in order. Each migration is recorded in the schema_version
+    table right after it runs. The countries and history tables must exist.
+    :param engine: the engine connection.
+    :param logger: optional, a logger to report the applied migrations to.
+    :return: the list of applied versions.
+    """
+    table = schema_version_table(engine)
+    version = current_version(engine)
+    applied = []
+    for migration_version, description, function in MIGRATIONS:
+        if migration_version <= version:
+            continue
+        function(engine)
+        engine.execute(table.insert(), version=migration_version, description=description,
+                       applied_at=datetime.now())
+        applied.append(migration_version)
+        if logger is not None:
+            logger.info(f'Applied migration {migration_version}: {description}')
+    return applied
@@ -0,0 +1,163 @@
+"""
+The overlapped scrape-and-write pipeline: the web scraper streams the parsed countries snapshot and every parsed
+country history into a bounded queue (see web_scraper's sink), and a writer thread batches them into the
+database while the next pages are still downloading. A full queue blocks the scraper, so a slow database holds
+back the fetching instead of filling the memory.
+"""
+import queue
+import threading
+from creating_db_scraper_api import *
+from rollups import refreshing_rollups
+from config import *
+
+
+class PipelineError(Exception):
+    """
+    The writer stage stopped, so the scraper can't stream into it.
+    """
+
+
+class CycleWriter(threading.Thread):
+    """
+    Class CycleWriter. The database stage of one refresh cycle. It writes the countries (inserting them on the
+    first cycle, refreshing the changed ones after that), appends the new history days of every streamed country
+    in chunks of chunk_size rows, flushing a partial chunk whenever the queue runs empty, and updates the rollup
+    tables of the written days at the end.
+    The whole cycle is one transaction, rolled back if the cycle fails. With a transaction_size (the first full
+    history load) a transaction is committed every transaction_size history rows instead.
+    The writer has its own connection to the database, opened in its thread (SQLite connections are bound to the
+    thread that opened them). The snapshot and the watermarks are updated in place, as in refreshing_country_info
+    and appending_history_info.
+    """
+    def __init__(self, engine, countries_table, history_table, snapshot, watermarks, transmission,
+                 countries_created=False, chunk_size=INSERT_CHUNK_SIZE, transaction_size=None,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        super().__init__(name='db-writer', daemon=True)
+        self.engine = engine
+        self.connection = None
+        self.countries_table = countries_table
+        self.history_table = history_table
+        self.snapshot = snapshot
+        self.watermarks = watermarks
+        self.transmission = transmission
+        self.countries_created = countries_created
+        self.chunk_size = chunk_size
+        self.transaction_size = transaction_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.pending = []
+        self.affected = {}
+        self.written = {'countries': 0, 'history': 0, 'rollups': 0}
+        self.error = None
+        self.transaction = None
+        self.transaction_rows = 0
+
+    def put(self, kind, *payload):
+        """
+        Streams parsed data to the writer, waiting while the queue is full. Used as the sink of web_scraper.
+        :param kind: 'countries' or 'history'.
+        :param payload: the countries list, or the country name and its history.
+        """
+        while True:
+            if not self.is_alive():
+                raise PipelineError(f'The database writer stopped: {self.error}')
+            try:
+                self.queue.put((kind, payload), timeout=PIPELINE_PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def close(self, commit=True):
+        """
+        Ends the stream and waits for the writer.
+        :param commit: True to flush and commit the cycle, False to roll it back (e.g. the scraping failed).
+        :return: the number of written rows per stage: countries, history and rollups.
+        """
+        if self.is_alive():
+            self.queue.put(('commit' if commit else 'rollback', ()))
+            self.join()
+        if self.error is not None:
+            raise self.error
+        return self.written
+
+    def write_countries(self, countries_info):
+        """
+        Writes the countries snapshot of the cycle.
+        :param countries_info: the countries snapshot, as returned by parsing_country_page.
+        """
+        if self.countries_created:
+            inserting_country_info(countries_info, self.countries_table, self.connection, self.transmission,
+                                   self.chunk_size)
+            self.snapshot.update(query_countries_snapshot(self.connection, self.countries_table))
+            self.written['countries'] += len(self.snapshot)
+            self.countries_created = False
+        else:
+            changed, unchanged = refreshing_country_info(countries_info, self.countries_table, self.connection,
+                                                         self.snapshot, self.transmission, self.chunk_size)
+            self.written['countries'] += changed
+
+    def add_history(self, country, country_history):
+        """
+        Queues the new days of a country's history (see new_history_rows) for the next flush.
+        :param country: the country name.
+        :param country_history: the country's history, as returned by parsing_country_history.
+        """
+        country_code = COUNTRIES_NAMES_TO_CODES.get(country)
+        if country_code is None:
+            return
+        rows = new_history_rows(country_code, country_history, self.watermarks.get(country_code))
+        if rows:
+            self.pending.extend(rows)
+            self.watermarks[country_code] = rows[-1]['date']
+            self.affected[country_code] = min(self.affected.get(country_code, rows[0]['date']), rows[0]['date'])
+
+    def flush(self):
+        """
+        Writes the pending history rows, and commits a transaction if it reached transaction_size rows.
+        """
+        if not self.pending:
+            return
+        written = upsert_rows(self.connection, self.history_table, self.pending, HISTORY_GRAPHS.values(),
+                              self.chunk_size)
+        self.pending = []
+        self.written['history'] += written
+        self.transaction_rows += written
+        if self.transaction_size and self.transaction_rows >= self.transaction_size:
+            self.transaction.commit()
+            self.transaction = self.connection.begin()
+            self.transaction_rows = 0
+
+    def run(self):
+        try:
+            with self.engine.connect() as self.connection:
+                self.transaction = self.connection.begin()
+                try:
+                    self.consume()
+                except Exception:
+                    self.transaction.rollback()
+                    raise
+        except Exception as ex:
+            self.error = ex
+
+    def consume(self):
+        """
+        Writes the streamed data until the end of the stream, then commits or rolls back the cycle.
+        """
+        while True:
+            kind, payload = self.queue.get()
+            if kind == 'rollback':
+                self.transaction.rollback()
+                return
+            if kind == 'commit':
+                break
+            if kind == 'countries':
+                self.write_countries(*payload)
+            elif kind == 'history':
+                self.add_history(*payload)
+            # Flush a full chunk, or whatever is pending when the scraper has nothing ready
+            if len(self.pending) >= self.chunk_size or self.queue.empty():
+                self.flush()
+
+        self.flush()
+        self.written['rollups'] = refreshing_rollups(self.connection, self.history_table, self.countries_table,
+                                                     self.affected, self.chunk_size)
+        self.transaction.commit()
@@ -0,0 +1,192 @@
+"""
+A local read-only HTTP service over the scraped data, so consumers don't query the database directly.
+Endpoints (json):
+    GET /countries                      the latest snapshot of all the countries
+    GET /countries/<code>               the latest snapshot of one country
+    GET /history/<code>?start=&end=     the history of a country in a date range (YYYY-MM-DD, both optional)
+    GET /top?metric=total_cases&n=10    the top countries by a metric of the countries table
+Responses are kept in an LRU cache with ETags, which main() invalidates at the end of every refresh cycle,
+so repeated reads between cycles don't touch the database.
+"""
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import date
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from creating_db_scraper_api import get_registry, query_db_countries, query_db_history_range, \
+    query_db_top_countries
+from config import QUERY_API_HOST, QUERY_CACHE_ENTRIES, QUERY_TOP_DEFAULT, QUERY_TOP_MAX
+from metrics import QUERY_REQUESTS
+
+CONTENT_TYPE = 'application/json; charset=utf-8'
+# Columns of the countries table that can be ranked by /top
+TOP_METRICS = ['total_cases', 'new_cases', 'total_deaths', 'new_deaths', 'total_recovered', 'active_cases',
+               'critical_cases', 'cases_per_1m', 'deaths_per_1m', 'total_tests', 'tests_per_1m', 'population']
+
+
+class QueryError(Exception):
+    """
+    A bad request to the query API, answered with its status code.
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class QueryCache:
+    """
+    Class QueryCache. A thread safe LRU cache of encoded responses and their ETags, by request path.
+    Every invalidation starts a new generation, and a response queried in an earlier generation isn't cached.
+    """
+    def __init__(self, max_entries=QUERY_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: the request path with its query string.
+        :return: the cached body and ETag, or None.
+        """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+    def put(self, key, body, generation):
+        """
+        Caches a response body, evicting the least recently used entries past max_entries.
+        :param key: the request path with its query string.
+        :param body: the encoded body.
+        :param generation: the generation of the cache when the response was queried.
+        :return: the body and its ETag.
+        """
+        entry = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+        with self.lock:
+            if generation != self.generation:
+                return entry
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    def invalidate(self):
+        """
+        Drops all the cached responses, after the database was written.
+        """
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+
+
+def parse_date(value, name):
+    """
+    :param value: a date string (YYYY-MM-DD), or None.
+    :param name: the name of the query parameter, for the error message.
+    :return: the date, or None.
+    """
+    if value is None:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise QueryError(400, f'{name} must be a date in the format YYYY-MM-DD')
+
+
+def query(engine, path, params):
+    """
+    Runs the database query of a request.
+    :param engine: the engine connection.
+    :param path: the request path, split by '/'.
+    :param params: the query string parameters (see parse_qs).
+    :return: the rows (dictionaries) to answer with, or one row for a single country.
+    """
+    registry = get_registry(engine)
+    countries, history = registry.table('countries')[0], registry.table('history')[0]
+    with engine.connect() as connection:
+        if path == ['countries']:
+            rows = registry.execute(connection, registry.statement('countries_all', lambda: countries.select()))
+            return [dict(row) for row in rows]
+        if len(path) == 2 and path[0] == 'countries':
+            rows = query_db_countries(engine, connection, countries, path[1].upper())
+            if not rows:
+                raise QueryError(404, f'Unknown country {path[1]}')
+            return dict(rows[0])
+        if len(path) == 2 and path[0] == 'history':
+            start = parse_date(params.get('start', [None])[0], 'start')
+            end = parse_date(params.get('end', [None])[0], 'end')
+            rows = query_db_history_range(engine, connection, history, path[1].upper(), start, end)
+            return [dict(row) for row in rows]
+        if path == ['top']:
+            metric = params.get('metric', ['total_cases'])[0]
+            if metric not in TOP_METRICS:
+                raise QueryError(400, f'metric must be one of {", ".join(TOP_METRICS)}')
+            try:
+                limit = int(params.get('n', [QUERY_TOP_DEFAULT])[0])
+            except ValueError:
+                raise QueryError(400, 'n must be a number')
+            rows = query_db_top_countries(engine, connection, countries, metric, max(1, min(limit, QUERY_TOP_MAX)))
+            return [dict(row) for row in rows]
+    raise QueryError(404, 'Unknown endpoint')
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """
+    Class QueryHandler. Serves the query API from the cache of its server, querying the database on a miss.
+    """
+    def do_GET(self):
+        url = urlsplit(self.path)
+        path = [part for part in url.path.split('/') if part]
+        endpoint = path[0] if path else ''
+        entry = self.server.cache.get(self.path)
+        if entry is None:
+            generation = self.server.cache.generation
+            try:
+                rows = query(self.server.engine, path, parse_qs(url.query))
+            except QueryError as ex:
+                self.send_error(ex.status, str(ex))
+                return
+            entry = self.server.cache.put(self.path, json.dumps(rows, default=str).encode('utf-8'),
+                                          generation)
+            QUERY_REQUESTS.inc(endpoint=endpoint, cache='miss')
+        else:
+            QUERY_REQUESTS.inc(endpoint=endpoint, cache='hit')
+
+        body, etag = entry
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Dashboards poll often, don't print every request to the console
+        pass
+
+
+def start_query_server(engine, cache, port, host=QUERY_API_HOST):
+    """
+    Starts serving the query API in a background thread.
+    :param engine: the engine connection of the database to read from.
+    :param cache: the responses cache (QueryCache). invalidate it after every write to the database.
+    :param port: the port of the API.
+    :param host: the host to listen on. only local connections by default.
+    :return: the server.
+    """
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    server.engine = engine
+    server.cache = cache
+    thread = threading.Thread(target=server.serve_forever, name='query-api', daemon=True)
+    thread.start()
+    return server
@@ -0,0 +1,93 @@
+import time
+import random
+import threading
+from config import RATE_LIMIT_INITIAL, RATE_LIMIT_MIN, RATE_LIMIT_MAX, RATE_LIMIT_BURST, RATE_LIMIT_INCREASE, \
+    RATE_LIMIT_DECREASE, RATE_LIMIT_LATENCY, RETRY_BACKOFF, RETRY_BACKOFF_MAX
+
+
+class RateLimiter:
+    """
+    Class RateLimiter. A thread safe token bucket whose rate adapts to the responses of the server (AIMD):
+    every successful fast response increases the rate additively, and every error (429/5xx, connection errors)
+    or slow response decreases it multiplicatively, once per congestion event: the errors of the requests that
+    were already in flight when the rate was decreased don't decrease it again. This keeps the requests close to
+    the highest rate the server accepts.
+    """
+    def __init__(self, rate=RATE_LIMIT_INITIAL, min_rate=RATE_LIMIT_MIN, max_rate=RATE_LIMIT_MAX,
+                 burst=RATE_LIMIT_BURST, increase=RATE_LIMIT_INCREASE, decrease=RATE_LIMIT_DECREASE,
+                 latency_target=RATE_LIMIT_LATENCY):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.last_decrease = 0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        """
+        Adds the tokens earned since the last refill. Must be called while holding the lock.
+        :param now: the current monotonic time.
+        """
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        """
+        Blocks until a request may be sent, and takes a token for it.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self, latency, sent=None):
+        """
+        Reports a successful response. Increases the rate, unless the response was slower than the latency target.
+        :param latency: the response time in seconds.
+        :param sent: optional, the monotonic time the request was sent (see on_error).
+        """
+        if latency > self.latency_target:
+            self.on_error(sent)
+            return
+        with self.lock:
+            # Additive increase: about `increase` requests per second more for every second at the current rate
+            self.rate = min(self.max_rate, self.rate + self.increase / self.rate)
+
+    def on_error(self, sent=None):
+        """
+        Reports a failed or throttled response. Decreases the rate, unless the request was sent before the last
+        decrease, so a burst of errors from the requests in flight counts as one congestion signal.
+        :param sent: optional, the monotonic time the request was sent. Without it, only the errors within
+        1 / rate seconds of the last decrease are ignored.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if sent is not None and sent <= self.last_decrease:
+                return
+            if sent is None and now - self.last_decrease < 1 / self.rate:
+                return
+            self.last_decrease = now
+            self.refill(now)
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self.tokens = min(self.tokens, 0)
+
+
+def backoff_delay(attempt, base=RETRY_BACKOFF, maximum=RETRY_BACKOFF_MAX):
+    """
+    Returns a jittered exponential backoff delay ("full jitter").
+    :param attempt: the number of the failed attempt, starting at 0.
+    :param base: the delay of the first retry, in seconds.
+    :param maximum: the maximal delay, in seconds.
+    :return: a random delay between 0 and min(maximum, base * 2 ** attempt).
+    """
+    return random.uniform(0, min(maximum, base * 2 ** attempt))
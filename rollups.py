@@ -0,0 +1,146 @@
+"""
+Materialized aggregate tables for the dashboards, maintained incrementally after every write cycle:
+rolling 7-day averages and weekly sums of every country, and daily totals of every continent and of the world.
+Only the days from each affected country's first written date on are computed again.
+"""
+from datetime import timedelta
+from sqlalchemy import select, func, and_
+from creating_db_scraper_api import get_registry, upsert_rows
+from config import *
+from metrics import DB_SECONDS, timed
+
+SUMMED_COLUMNS = ['total_cases', 'daily_cases', 'active_cases', 'total_deaths', 'daily_deaths']
+
+
+def week_start(day):
+    """
+    :param day: a date.
+    :return: the Monday of the date's week.
+    """
+    return day - timedelta(days=day.weekday())
+
+
+def present_sum(values):
+    """
+    :param values: an iterable of numbers and None.
+    :return: the sum and the number of the values that are not None.
+    """
+    present = [value for value in values if value is not None]
+    return sum(present), len(present)
+
+
+def country_rollup_rows(country_code, days, first_date):
+    """
+    Computes the rolling averages and the weekly sums of a country from a date on.
+    :param country_code: the country_id (3-letter-based string for a specific country).
+    :param days: a dictionary with a (daily_cases, daily_deaths) pair per date. it must include the
+    ROLLUP_WINDOW_DAYS - 1 days before first_date and the days of first_date's week.
+    :param first_date: the first affected date.
+    :return: the rows of rollup_country_daily and the rows of rollup_country_weekly.
+    """
+    daily_rows = []
+    weeks = {}
+    for day in sorted(days):
+        if day >= first_date:
+            window = [days.get(day - timedelta(days=i), (None, None)) for i in range(ROLLUP_WINDOW_DAYS)]
+            averages = []
+            for values in zip(*window):
+                total, count = present_sum(values)
+                averages.append(total / count if count else None)
+            daily_rows.append({'country_id': country_code, 'date': day,
+                               'daily_cases_avg7': averages[0], 'daily_deaths_avg7': averages[1]})
+        if day >= week_start(first_date):
+            weeks.setdefault(week_start(day), []).append(days[day])
+
+    weekly_rows = []
+    for week, values in sorted(weeks.items()):
+        cases, deaths = [present_sum(series) for series in zip(*values)]
+        weekly_rows.append({'country_id': country_code, 'week': week,
+                            'daily_cases': cases[0] if cases[1] else None,
+                            'daily_deaths': deaths[0] if deaths[1] else None})
+    return daily_rows, weekly_rows
+
+
+def query_affected_history(connection, history_table, affected):
+    """
+    Reads the daily series that the rollups of the affected countries depend on.
+    :param connection: the direct connection to the relevant database.
+    :param history_table: the history table.
+    :param affected: a dictionary with the first affected date of every country, or None for all the history.
+    :return: a dictionary with a {date: (daily_cases, daily_deaths)} dictionary per country_id.
+    """
+    query = select([history_table.c.country_id, history_table.c.date, history_table.c.daily_cases,
+                    history_table.c.daily_deaths]).where(history_table.c.date.isnot(None))
+    if affected is not None:
+        # One range for all the countries, the earlier days of a country are not used
+        first_date = min(affected.values())
+        query = query.where(and_(history_table.c.country_id.in_(list(affected)), history_table.c.date >=
+                                 min(week_start(first_date), first_date - timedelta(days=ROLLUP_WINDOW_DAYS - 1))))
+    history = {}
+    for country_code, day, daily_cases, daily_deaths in connection.execute(query):
+        history.setdefault(country_code, {})[day] = (daily_cases, daily_deaths)
+    return history
+
+
+def continent_rollup_rows(connection, history_table, countries_table, first_date):
+    """
+    Computes the daily totals of every continent and of the world from a date on, in the database.
+    :param connection: the direct connection to the relevant database.
+    :param history_table: the history table.
+    :param countries_table: the countries table, with the continent of every country.
+    :param first_date: the first affected date, or None for all the history.
+    :return: the rows of rollup_continent_daily.
+    """
+    sums = [func.count(history_table.c.country_id)] + [func.sum(history_table.c[column]) for column in SUMMED_COLUMNS]
+    continents = select([countries_table.c.continent, history_table.c.date] + sums).select_from(
+        history_table.join(countries_table, history_table.c.country_id == countries_table.c.id)).where(
+        countries_table.c.continent.isnot(None)).group_by(countries_table.c.continent, history_table.c.date)
+    world = select([history_table.c.date] + sums).group_by(history_table.c.date)
+    date_filter = history_table.c.date.isnot(None)
+    if first_date is not None:
+        date_filter = and_(date_filter, history_table.c.date >= first_date)
+
+    rows = []
+    for row in connection.execute(continents.where(date_filter)):
+        rows.append(dict(zip(['continent', 'date', 'countries'] + SUMMED_COLUMNS, row)))
+    for row in connection.execute(world.where(date_filter)):
+        rows.append(dict(zip(['date', 'countries'] + SUMMED_COLUMNS, row), continent=WORLD))
+    # SUM returns a decimal on MySQL
+    for row in rows:
+        for column in SUMMED_COLUMNS:
+            if row[column] is not None:
+                row[column] = int(row[column])
+    return rows
+
+
+@timed(DB_SECONDS, function='refreshing_rollups')
+def refreshing_rollups(connection, history_table, countries_table, affected=None, chunk_size=INSERT_CHUNK_SIZE):
+    """
+    Updates the rollup tables (ROLLUP_TABLES) after a write cycle. Only the rolling averages and the weekly sums
+    of the affected countries, from their first affected date (and its week) on, and the continents and world
+    totals from the earliest affected date on, are computed again and upserted.
+    :param connection: the direct connection to the relevant database.
+    :param history_table: the history table.
+    :param countries_table: the countries table.
+    :param affected: a dictionary with the first written date of every written country (see
+    appending_history_info), or None to rebuild the rollups from all the history.
+    :param chunk_size: the maximal number of rows in one statement.
+    :return: the number of written rollup rows.
+    """
+    if affected is not None and not affected:
+        return 0
+    registry = get_registry(connection.engine)
+    daily_table, weekly_table, continent_table = [registry.table(name)[0] for name in ROLLUP_TABLES]
+
+    daily_rows, weekly_rows = [], []
+    for country_code, days in query_affected_history(connection, history_table, affected).items():
+        first_date = affected[country_code] if affected is not None else min(days)
+        country_daily, country_weekly = country_rollup_rows(country_code, days, first_date)
+        daily_rows.extend(country_daily)
+        weekly_rows.extend(country_weekly)
+    continent_rows = continent_rollup_rows(connection, history_table, countries_table,
+                                           min(affected.values()) if affected is not None else None)
+
+    return (upsert_rows(connection, daily_table, daily_rows, ['daily_cases_avg7', 'daily_deaths_avg7'], chunk_size) +
+            upsert_rows(connection, weekly_table, weekly_rows, ['daily_cases', 'daily_deaths'], chunk_size) +
+            upsert_rows(connection, continent_table, continent_rows, ['countries'] + SUMMED_COLUMNS, chunk_size))
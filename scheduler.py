@@ -0,0 +1,286 @@
+"""
+A deadline scheduler for the refresh cycles. The jobs are kept in a heap by their next deadline, and the scheduler
+sleeps until the earliest one is due, instead of polling the clock every second.
+Schedules are strings:
+    HH:MM:SS                    every day at this time (the format of the update times file)
+    @every 15m                  a fixed interval, in s, m, h or d
+    */15 * * * *                a cron expression: minute, hour, day of month, month, day of week
+    @hourly, @daily, @weekly    cron shortcuts
+A run that is due while the previous run of the job is still running (or while the process was busy) is missed.
+With the 'coalesce' policy all the missed deadlines of a job are run once, and with the 'catch-up' policy every
+missed deadline is run, up to SCHEDULE_MAX_CATCH_UP runs.
+"""
+import re
+import heapq
+import threading
+from datetime import datetime, timedelta
+from config import SCHEDULE_POLICY, SCHEDULE_MAX_CATCH_UP, SCHEDULE_MAX_SLEEP, SCHEDULE_LAG_WARNING
+from metrics import SCHEDULE_LAG_SECONDS, SCHEDULE_MISSED, SCHEDULE_FAILED
+
+POLICIES = ['coalesce', 'catch-up']
+INTERVAL_PATTERN = re.compile(r'@every\s+(\d+)\s*([smhd])$')
+INTERVAL_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+CRON_SHORTCUTS = {'@hourly': '0 * * * *', '@daily': '0 0 * * *', '@weekly': '0 0 * * 0', '@monthly': '0 0 1 * *'}
+# The ranges of the cron fields: minute, hour, day of month, month, day of week (0 = Sunday, 7 is Sunday too)
+CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+
+class DailyTime:
+    """
+    Class DailyTime. A schedule that is due every day at a time of day.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        self.time = datetime.strptime(spec, '%H:%M:%S').time()
+
+    def next_after(self, moment):
+        """
+        :param moment: a datetime.
+        :return: the first deadline after the moment.
+        """
+        deadline = datetime.combine(moment.date(), self.time)
+        return deadline if deadline > moment else deadline + timedelta(days=1)
+
+
+class Interval:
+    """
+    Class Interval. A schedule that is due every fixed number of seconds, counted from the start of the day,
+    so an interval of 15m is due at :00, :15, :30 and :45.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        match = INTERVAL_PATTERN.match(spec)
+        self.seconds = int(match.group(1)) * INTERVAL_UNITS[match.group(2)]
+        if self.seconds <= 0:
+            raise ValueError(f'The interval of {spec} must be positive')
+
+    def next_after(self, moment):
+        """
+        :param moment: a datetime.
+        :return: the first deadline after the moment.
+        """
+        anchor = datetime.combine(moment.date(), datetime.min.time())
+        if self.seconds > 86400:
+            anchor = datetime(2020, 1, 1)
+        periods = int((moment - anchor).total_seconds() // self.seconds) + 1
+        return anchor + timedelta(seconds=periods * self.seconds)
+
+
+def parse_cron_field(field, low, high):
+    """
+    Parses a field of a cron expression: '*', a number, a range 'a-b', a step '*/n' or 'a-b/n', or a list of them.
+    :param field: the field.
+    :param low: the lowest value of the field.
+    :param high: the highest value of the field.
+    :return: the set of the values of the field.
+    """
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            first, last = low, high
+        elif '-' in part:
+            first, last = [int(value) for value in part.split('-')]
+        else:
+            first = last = int(part)
+        step = int(step) if step else 1
+        if first < low or last > high or first > last or step < 1:
+            raise ValueError(f'Invalid cron field {field}')
+        values.update(range(first, last + 1, step))
+    return values
+
+
+class Cron:
+    """
+    Class Cron. A schedule of a cron expression, with a resolution of a minute. As in cron, when both the day of
+    month and the day of week are restricted, a day matching either of them is due.
+    """
+    def __init__(self, spec):
+        self.spec = spec
+        fields = CRON_SHORTCUTS.get(spec, spec).split()
+        if len(fields) != 5:
+            raise ValueError(f'A cron expression must have 5 fields: {spec}')
+        self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_RANGES)]
+        if 7 in self.weekdays:
+            self.weekdays.add(0)
+        self.any_day = fields[2] == '*'
+        self.any_weekday = fields[4] == '*'
+
+    def day_matches(self, day):
+        """
+        :param day: a datetime.
+        :return: True if the day of month and the day of week fields match the day.
+        """
+        in_days = day.day in self.days
+        in_weekdays = (day.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return in_days and in_weekdays
+        return in_days or in_weekdays
+
+    def next_after(self, moment):
+        """
+        :param moment: a datetime.
+        :return: the first deadline after the moment.
+        """
+        deadline = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = deadline + timedelta(days=366 * 5)
+        while deadline < limit:
+            if deadline.month not in self.months:
+                deadline = (deadline.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self.day_matches(deadline):
+                deadline = deadline.replace(hour=0, minute=0) + timedelta(days=1)
+            elif deadline.hour not in self.hours:
+                deadline = deadline.replace(minute=0) + timedelta(hours=1)
+            elif deadline.minute not in self.minutes:
+                deadline += timedelta(minutes=1)
+            else:
+                return deadline
+        raise ValueError(f'The cron expression {self.spec} is never due')
+
+
+def parse_schedule(spec):
+    """
+    :param spec: a schedule string (see the module documentation).
+    :return: the schedule object.
+    """
+    spec = spec.strip()
+    if INTERVAL_PATTERN.match(spec):
+        return Interval(spec)
+    if re.match(r'\d{1,2}:\d{2}:\d{2}$', spec):
+        return DailyTime(spec)
+    return Cron(spec)
+
+
+class Job:
+    """
+    Class Job. A named callback with one or more schedules. It is due at the earliest deadline of its schedules.
+    """
+    def __init__(self, name, schedules, callback, policy):
+        self.name = name
+        self.schedules = [parse_schedule(spec) if isinstance(spec, str) else spec for spec in schedules]
+        self.callback = callback
+        self.policy = policy
+        self.deadline = None
+
+    def next_after(self, moment):
+        """
+        :param moment: a datetime.
+        :return: the first deadline of any of the job's schedules after the moment.
+        """
+        return min(schedule.next_after(moment) for schedule in self.schedules)
+
+
+class Scheduler:
+    """
+    Class Scheduler. Runs jobs at their deadlines, one job at a time, in the calling thread (see run).
+    The lag of every run (how late it started after its deadline) is observed in the schedule lag metric,
+    and logged when it is more than SCHEDULE_LAG_WARNING seconds.
+    """
+    def __init__(self, logger=None, policy=SCHEDULE_POLICY, max_catch_up=SCHEDULE_MAX_CATCH_UP):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown schedule policy: {policy}')
+        self.logger = logger
+        self.policy = policy
+        self.max_catch_up = max_catch_up
+        self.heap = []
+        self.counter = 0
+        self.stopped = threading.Event()
+
+    def push(self, job, deadline):
+        """
+        Puts a job in the heap with its next deadline.
+        :param job: the job.
+        :param deadline: the datetime it is due at.
+        """
+        job.deadline = deadline
+        self.counter += 1
+        heapq.heappush(self.heap, (deadline, self.counter, job))
+
+    def add(self, name, schedules, callback, policy=None, run_now=False):
+        """
+        Adds a job.
+        :param name: the name of the job, for the logs and the metrics.
+        :param schedules: a list of schedule strings (see parse_schedule) or schedule objects.
+        :param callback: a function without arguments.
+        :param policy: the missed runs policy of the job, 'coalesce' or 'catch-up' (default: the scheduler's).
+        :param run_now: True to run the job once right away, before its first deadline.
+        :return: the job.
+        """
+        job = Job(name, schedules, callback, policy or self.policy)
+        if job.policy not in POLICIES:
+            raise ValueError(f'Unknown schedule policy: {job.policy}')
+        now = datetime.now()
+        self.push(job, now if run_now else job.next_after(now))
+        return job
+
+    def next_deadline(self):
+        """
+        :return: the earliest deadline of all the jobs, or None without jobs.
+        """
+        return self.heap[0][0] if self.heap else None
+
+    def run_due(self):
+        """
+        Runs the earliest job if it is due, and puts it back with its next deadline by its missed runs policy.
+        A job that raises is logged and counted in the metrics, and is rescheduled the same way.
+        :return: True if a job ran.
+        """
+        deadline, _, job = self.heap[0]
+        start = datetime.now()
+        if deadline > start:
+            return False
+        heapq.heappop(self.heap)
+        lag = (start - deadline).total_seconds()
+        SCHEDULE_LAG_SECONDS.observe(lag, job=job.name)
+        if self.logger is not None and lag > SCHEDULE_LAG_WARNING:
+            self.logger.warning(f'{job.name} started {lag:.1f} seconds after its deadline {deadline}')
+        try:
+            job.callback()
+        except Exception as ex:
+            # A failed run doesn't stop the other jobs, and the job runs again at its next deadline
+            SCHEDULE_FAILED.inc(job=job.name)
+            if self.logger is not None:
+                self.logger.exception(f'{job.name} failed: {ex}')
+        finally:
+            end = datetime.now()
+            if job.policy == 'catch-up':
+                # Every missed deadline runs, the oldest ones past max_catch_up are skipped
+                missed = []
+                next_deadline = job.next_after(deadline)
+                while next_deadline <= end:
+                    missed.append(next_deadline)
+                    next_deadline = job.next_after(next_deadline)
+                skipped = max(0, len(missed) - self.max_catch_up)
+                next_deadline = missed[skipped] if missed else next_deadline
+            else:
+                # All the deadlines missed during the run are coalesced into one run
+                next_deadline = job.next_after(start)
+                skipped = 0
+                while job.next_after(next_deadline) <= end:
+                    next_deadline = job.next_after(next_deadline)
+                    skipped += 1
+            if skipped:
+                SCHEDULE_MISSED.inc(skipped, job=job.name)
+                if self.logger is not None:
+                    self.logger.warning(f'{job.name} missed {skipped} scheduled runs ({job.policy})')
+            self.push(job, next_deadline)
+            if self.logger is not None:
+                self.logger.info(f'The next {job.name} run will occur at {next_deadline}')
+        return True
+
+    def run(self):
+        """
+        Runs the jobs at their deadlines until stop is called. Between runs it sleeps until the next deadline,
+        waking at least every SCHEDULE_MAX_SLEEP seconds to follow changes of the wall clock.
+        """
+        while not self.stopped.is_set() and self.heap:
+            if not self.run_due():
+                wait = (self.next_deadline() - datetime.now()).total_seconds()
+                self.stopped.wait(min(max(wait, 0), SCHEDULE_MAX_SLEEP))
+
+    def stop(self):
+        """
+        Stops the run loop after the current job.
+        """
+        self.stopped.set()
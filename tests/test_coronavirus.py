@@ -0,0 +1,48 @@
+import os
+import logging
+from datetime import date, timedelta
+from coronavirus import Coronavirus
+from config import URL, HISTORY_GRAPHS
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+
+def parse_country_page(name):
+    with open(os.path.join(FIXTURES, name)) as file:
+        return Coronavirus(URL, logging.getLogger('test_coronavirus')).parsing_country_history(file.read())
+
+
+def values(series):
+    """
+    :return: the values of a parsed series, None for a missing value.
+    """
+    return [None if missing else value for value, missing in zip(series['instances'], series['missing'])]
+
+
+def test_parsing_a_stored_country_page():
+    # The page has undated categories from Dec 28 to Jan 04, a linear and a logarithmic chart for the totals
+    # (with the same title), and daily charts with moving averages
+    history = parse_country_page('italy.html')
+    dates = [date(2020, 12, 28) + timedelta(days=day) for day in range(8)]
+
+    assert set(HISTORY_GRAPHS) <= set(history)
+    for graph in HISTORY_GRAPHS:
+        assert history[graph]['dates'] == dates
+        assert len(history[graph]['instances']) == len(history[graph]['missing']) == 8
+
+    assert values(history['Total Cases']) == [2038759, 2056277, 2067487, 2083689, 2107166, 2129376, 2141201,
+                                              2155446]
+    assert values(history['Daily New Cases']) == [8585, 11210, 16202, None, 23477, 22210, 11825, 14245]
+    assert values(history['Active Cases']) == [568712, 575979, 570458, 573235, 575065, 576962, 578506, 580000]
+    assert values(history['Total Deaths']) == [72370, 73029, 73604, 74159, 74621, 75332, 75680, 76329]
+    assert values(history['Daily Deaths']) == [445, 659, 575, 555, 462, 711, None, 649]
+    assert bytes(history['Daily Deaths']['missing']) == bytes([0, 0, 0, 0, 0, 0, 1, 0])
+
+    # The other series of a chart are saved under the chart title and the series name, rounded
+    assert values(history['Daily New Cases (7-day moving average)'])[:3] == [14187, 13501, 13271]
+    assert values(history['New Cases vs. New Recoveries (New Recoveries)'])[0] == 10150
+
+
+def test_a_page_without_a_graph_has_an_empty_graph():
+    history = Coronavirus(URL, logging.getLogger('test_coronavirus')).parsing_country_history('<html></html>')
+    assert history == {graph: {} for graph in HISTORY_GRAPHS}
@@ -0,0 +1,85 @@
+from countries_snapshot import CountriesSnapshot, PARSED_COLUMNS
+from creating_db_scraper_api import inserting_country_info, query_countries_snapshot, refreshing_country_info
+from benchmark import local_database, close_database
+
+
+def parsed_values(seed, missing=()):
+    """
+    :param seed: a number to derive the values from.
+    :param missing: the columns whose value is missing.
+    :return: the values of PARSED_COLUMNS, floats for the per 1m columns.
+    """
+    return [None if column in missing else seed * 10 + i + (0.5 if column.endswith('_1m') else 0)
+            for i, column in enumerate(PARSED_COLUMNS)]
+
+
+def make_snapshot():
+    snapshot = CountriesSnapshot()
+    snapshot.append('Italy', parsed_values(1), 'Europe')
+    snapshot.append('Israel', parsed_values(2, missing=('total_recovered', 'tests_per_1m')), 'Asia')
+    snapshot.append('Japan', parsed_values(3, missing=('new_deaths',)), 'Asia')
+    return snapshot
+
+
+def test_a_snapshot_round_trips_through_the_database():
+    engine, connection, countries, _ = local_database()
+    snapshot = make_snapshot()
+    inserting_country_info(snapshot, countries, connection, {'ITA': {'type': 1}})
+
+    stored = query_countries_snapshot(connection, countries)
+    assert list(stored) == ['ITA', 'ISR', 'JPN']
+    assert {code: dict(row) for code, row in stored.items()} == {code: dict(row) for code, row in snapshot.items()}
+    assert stored['ISR']['total_recovered'] is None and stored['ITA']['transmission_type'] == 1
+    assert stored['JPN']['transmission_type'] == -1
+    assert snapshot.diff(stored) == []
+
+    # Only the changed country is written, and the stored transmission types are kept
+    fresh = make_snapshot()
+    fresh['JPN']['total_cases'] += 1
+    assert refreshing_country_info(fresh, countries, connection, stored) == (1, 2)
+    stored_again = query_countries_snapshot(connection, countries)
+    assert stored_again['JPN']['total_cases'] == fresh['JPN']['total_cases']
+    assert stored_again['ITA']['transmission_type'] == 1
+    close_database(engine, connection)
+
+
+def test_diff_finds_the_changed_rows_and_tells_a_missing_value_from_zero():
+    previous = make_snapshot()
+    snapshot = CountriesSnapshot.from_rows(previous.values())
+    assert snapshot.diff(previous) == []
+
+    snapshot['ISR']['total_recovered'] = 0
+    snapshot['JPN']['continent'] = 'Oceania'
+    snapshot.append('Spain', parsed_values(4), 'Europe')
+    assert snapshot.diff(previous) == ['ISR', 'JPN', 'ESP']
+    # A mapping of rows is compared as well
+    assert snapshot.diff({code: dict(row) for code, row in previous.items()}) == ['ISR', 'JPN', 'ESP']
+
+    previous['ITA']['cases_per_1m'] = None
+    assert 'ITA' in snapshot.diff(previous)
+
+
+def test_a_duplicate_code_maps_to_its_first_row():
+    snapshot = CountriesSnapshot()
+    snapshot.append('UK', parsed_values(1), 'Europe')
+    snapshot.append('United Kingdom', parsed_values(2), 'Europe')
+    snapshot.append('Diamond Princess', parsed_values(3), None)
+
+    assert list(snapshot) == ['GBR']
+    assert snapshot['GBR']['name'] == 'UK' and snapshot['GBR']['total_cases'] == 10
+    assert [row['name'] for row in snapshot.rows()] == ['UK', 'United Kingdom', 'Diamond Princess']
+    assert snapshot.rows()[2]['id'] is None
+
+
+def test_setitem_and_set_transmission():
+    snapshot = make_snapshot()
+    row = dict(snapshot['ITA'])
+    row['total_deaths'] = None
+    snapshot['ITA'] = row
+    assert snapshot['ITA']['total_deaths'] is None and len(snapshot.rows()) == 3
+
+    snapshot['ESP'] = dict(row, name='Spain')
+    assert list(snapshot) == ['ITA', 'ISR', 'JPN', 'ESP'] and snapshot['ESP']['name'] == 'Spain'
+
+    snapshot.set_transmission({'ISR': {'type': 2}})
+    assert [snapshot[code]['transmission_type'] for code in snapshot] == [-1, 2, -1, -1]
@@ -0,0 +1,45 @@
+from array import array
+from datetime import date, timedelta
+from sqlalchemy import select
+from countries_snapshot import CountriesSnapshot, PARSED_COLUMNS
+from creating_db_scraper_api import inserting_country_info, inserting_history_info
+from benchmark import local_database, close_database, count_rows
+from config import HISTORY_GRAPHS
+
+
+def make_history(days, first=date(2020, 2, 15)):
+    """
+    :return: a history in the format of parsing_country_history, with every 5th value missing.
+    """
+    dates = [first + timedelta(days=i) for i in range(days)]
+    return {graph: {'dates': dates,
+                    'instances': array('q', [i * 10 + n for i in range(days)]),
+                    'missing': bytearray(i % 5 == 2 for i in range(days))}
+            for n, graph in enumerate(HISTORY_GRAPHS)}
+
+
+def test_inserting_the_same_history_again_updates_the_rows_in_place():
+    engine, connection, countries, history = local_database()
+    snapshot = CountriesSnapshot()
+    for name in ['Italy', 'Spain']:
+        snapshot.append(name, [1] * len(PARSED_COLUMNS), 'Europe')
+    inserting_country_info(snapshot, countries, connection, {})
+    history_info = {'Italy': make_history(30), 'Spain': make_history(20), 'Atlantis': make_history(10)}
+
+    inserting_history_info(history_info, history, connection, engine, countries)
+    assert count_rows(connection, history) == 50
+    ids = dict(connection.execute(select([history.c.id, history.c.total_cases])).fetchall())
+    day = select([history.c.id, history.c.total_cases]).where(history.c.country_id == 'ITA')
+    assert connection.execute(day.where(history.c.date == date(2020, 2, 17))).fetchall()[0][1] is None
+
+    history_info['Italy']['Total Cases']['instances'][3] = 12345
+    history_info['Italy']['Total Cases']['missing'][2] = 0
+    inserting_history_info(history_info, history, connection, engine, countries, chunk_size=7, transaction_size=16)
+    assert count_rows(connection, history) == 50
+
+    rows = connection.execute(day.where(history.c.date == date(2020, 2, 18))).fetchall()
+    assert len(rows) == 1 and rows[0][1] == 12345 and ids[rows[0][0]] == 30
+    # A missing value that appeared is written as well
+    assert connection.execute(day.where(history.c.date == date(2020, 2, 17))).fetchall()[0][1] == 20
+    assert set(dict(connection.execute(select([history.c.id, history.c.total_cases])).fetchall())) == set(ids)
+    close_database(engine, connection)
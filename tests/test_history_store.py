@@ -0,0 +1,76 @@
+import os
+from array import array
+from datetime import date, timedelta
+from history_store import HistoryStore
+from config import HISTORY_GRAPHS
+
+
+def make_history(days, first=date(2020, 2, 15)):
+    """
+    :param days: the number of days.
+    :param first: the first date.
+    :return: a history in the format of parsing_country_history, with every 7th value missing.
+    """
+    dates = [first + timedelta(days=i) for i in range(days)]
+    return {graph: {'dates': dates,
+                    'instances': array('q', [i * 10 + n for i in range(days)]),
+                    'missing': bytearray(i % 7 == 3 for i in range(days))}
+            for n, graph in enumerate(HISTORY_GRAPHS)}
+
+
+def data_size(directory):
+    return os.path.getsize(os.path.join(directory, HistoryStore.DATA_FILE))
+
+
+def test_storing_the_same_history_again_does_not_grow_the_store(tmp_path):
+    store = HistoryStore(str(tmp_path), block_days=16)
+    history = make_history(40)
+    assert store.store('AFG', history) == 40
+    size, index_size = data_size(tmp_path), os.path.getsize(tmp_path / HistoryStore.INDEX_FILE)
+
+    assert store.store('AFG', history) == 0
+    assert data_size(tmp_path) == size
+    assert os.path.getsize(tmp_path / HistoryStore.INDEX_FILE) == index_size
+    assert store.dead_ratio() == 0
+    store.close()
+
+
+def test_a_new_day_rewrites_only_the_last_block_and_compact_drops_it(tmp_path):
+    store = HistoryStore(str(tmp_path), block_days=16)
+    store.store('AFG', make_history(40))
+    assert store.store('AFG', make_history(41)) == 9
+    assert store.dead_ratio() > 0
+
+    store.compact()
+    assert store.dead_ratio() == 0
+    assert data_size(tmp_path) == store.size()[0]
+    read = store.read('AFG')
+    expected = make_history(41)
+    for graph in HISTORY_GRAPHS:
+        assert read[graph]['dates'] == expected[graph]['dates']
+        assert bytes(read[graph]['missing']) == bytes(expected[graph]['missing'])
+        assert [value for value, missing in zip(read[graph]['instances'], read[graph]['missing']) if not missing] == \
+            [value for value, missing in zip(expected[graph]['instances'], expected[graph]['missing']) if not missing]
+    store.close()
+
+    reopened = HistoryStore(str(tmp_path), block_days=16)
+    assert reopened.date_range('AFG') == (date(2020, 2, 15), date(2020, 2, 15) + timedelta(days=40))
+    reopened.close()
+
+
+def test_stores_that_share_a_directory_see_each_others_blocks(tmp_path):
+    first = HistoryStore(str(tmp_path), block_days=16)
+    second = HistoryStore(str(tmp_path), block_days=16)
+    first.store('AFG', make_history(40))
+    second.store('ITA', make_history(40))
+    first.store('AFG', make_history(41))
+    first.compact()
+    assert second.store('ITA', make_history(41)) == 9
+    first.close()
+    second.close()
+
+    reopened = HistoryStore(str(tmp_path), block_days=16)
+    assert sorted(reopened.countries()) == ['AFG', 'ITA']
+    assert len(reopened.read('AFG')['Total Cases']['dates']) == 41
+    assert len(reopened.read('ITA')['Total Cases']['dates']) == 41
+    reopened.close()
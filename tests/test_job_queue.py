@@ -0,0 +1,57 @@
+import logging
+from benchmark import synthetic_country_page, local_database, count_rows
+from coronavirus import Coronavirus
+from config import URL
+from job_queue import JobQueue, HistoryWorker
+
+
+def test_wait_reclaims_expired_leases_and_stops_at_the_timeout(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.db'), max_attempts=2)
+    jobs.enqueue({'Italy': 'italy', 'Spain': 'spain'})
+
+    # A worker leases both jobs and dies, the second lease of Spain exhausts its attempts
+    assert len(jobs.lease('dead', count=2, lease_seconds=-1)) == 2
+    jobs.wait(poll_seconds=0, timeout=0)
+    assert jobs.counts() == {'pending': 2}
+    leased = jobs.lease('dead', count=1, lease_seconds=-1)
+    assert [country for _, country, _ in leased] == ['Italy']
+    jobs.complete('dead', [(leased[0][0], 'IT')], {})
+    assert len(jobs.lease('dead', count=1, lease_seconds=-1)) == 1
+
+    affected, failed, unfinished = jobs.wait(poll_seconds=0, timeout=0)
+    assert (affected, failed, unfinished) == ({}, ['Spain'], [])
+    jobs.close()
+
+
+def test_wait_returns_the_unfinished_countries_after_the_timeout(tmp_path):
+    jobs = JobQueue(str(tmp_path / 'jobs.db'))
+    jobs.enqueue({'Italy': 'italy', 'Spain': 'spain'})
+    jobs.lease('worker', count=1)
+
+    affected, failed, unfinished = jobs.wait(poll_seconds=0, timeout=0)
+    assert (affected, failed) == ({}, [])
+    assert sorted(unfinished) == ['Italy', 'Spain']
+    jobs.close()
+
+
+def test_a_failing_page_only_fails_its_own_job(tmp_path):
+    pages = {'/italy': synthetic_country_page(30), '/france': synthetic_country_page(30, seed=1)}
+
+    class Pages(Coronavirus):
+        def html(self, url):
+            if url == self.url + '/spain':
+                raise ValueError('Failed to fetch data')
+            return pages[url[len(self.url):]]
+
+    logger = logging.getLogger('test_job_queue')
+    engine, connection, _, history = local_database()
+    jobs = JobQueue(str(tmp_path / 'jobs.db'))
+    jobs.enqueue({'Italy': '/italy', 'Spain': '/spain', 'France': '/france'})
+    worker = HistoryWorker(jobs, Pages(URL, logger, workers=2), engine, history, logger, name='worker')
+
+    assert worker.run_batch(connection) == 3
+    assert jobs.counts() == {'done': 2, 'pending': 1}
+    affected, failed = jobs.results()
+    assert sorted(affected) == ['FRA', 'ITA'] and failed == []
+    assert count_rows(connection, history) == 60
+    jobs.close()
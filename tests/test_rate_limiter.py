@@ -0,0 +1,23 @@
+import time
+from rate_limiter import RateLimiter
+
+
+def test_the_errors_of_the_requests_in_flight_decrease_the_rate_once():
+    limiter = RateLimiter(rate=5, decrease=0.5)
+    sent = [time.monotonic() for _ in range(10)]
+    for request_sent in sent:
+        time.sleep(0.05)
+        limiter.on_error(request_sent)
+    assert limiter.rate == 2.5
+
+    # A request sent after the decrease is a new congestion signal
+    limiter.on_error(time.monotonic())
+    assert limiter.rate == 1.25
+
+
+def test_a_slow_response_decreases_the_rate_and_a_fast_one_increases_it():
+    limiter = RateLimiter(rate=5, increase=0.5, decrease=0.5, latency_target=1)
+    limiter.on_success(0.1, time.monotonic())
+    assert limiter.rate == 5.1
+    limiter.on_success(2, time.monotonic())
+    assert limiter.rate == 2.55
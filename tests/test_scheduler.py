@@ -0,0 +1,31 @@
+from datetime import datetime
+from scheduler import Scheduler, Cron, Interval
+from metrics import SCHEDULE_FAILED
+
+
+def test_a_failing_job_is_rescheduled_and_the_other_jobs_keep_running():
+    runs = []
+
+    def failing():
+        runs.append('countries')
+        raise ValueError('Failed to fetch data')
+
+    scheduler = Scheduler()
+    scheduler.add('countries', ['@every 15m'], failing, run_now=True)
+    scheduler.add('history', ['@daily'], lambda: runs.append('history'), run_now=True)
+    failed = SCHEDULE_FAILED.values.get((('job', 'countries'),), 0)
+
+    assert scheduler.run_due()
+    assert scheduler.run_due()
+    assert sorted(runs) == ['countries', 'history']
+    assert SCHEDULE_FAILED.values.get((('job', 'countries'),), 0) == failed + 1
+    deadlines = {job.name: job.deadline for _, _, job in scheduler.heap}
+    assert deadlines['countries'] > datetime.now()
+    assert deadlines['history'] > datetime.now()
+
+
+def test_cron_and_interval_deadlines():
+    moment = datetime(2024, 3, 4, 10, 7, 30)
+    assert Interval('@every 15m').next_after(moment) == datetime(2024, 3, 4, 10, 15)
+    assert Cron('0 6 * * 1').next_after(moment) == datetime(2024, 3, 11, 6, 0)
+    assert Cron('@daily').next_after(moment) == datetime(2024, 3, 5, 0, 0)